@@ -0,0 +1,308 @@
+'''
+Benchmark harness for the preprocessing, rasterization and OCR hot paths.
+
+Builds synthetic test documents locally (rendered text at several font sizes and
+skews, and a multi-page PDF) and times every stage separately. Reports
+throughput, p50/p95 latency and the peak RSS growth per stage, sampled while
+the stage runs.
+
+    python -m benchmarks.bench                          # run and print the report
+    python -m benchmarks.bench --save baseline.json     # store a baseline
+    python -m benchmarks.bench --compare baseline.json  # fail on regressions, same scale and stages only
+
+Stages whose dependencies are missing (tesseract binary, poppler, easyocr) are
+reported as skipped. The opencv stages run every step inline, the round trip of
+the heavy steps to the started offload worker processes is timed by the offload
+stages.
+'''
+import argparse
+import io
+import json
+import platform
+import resource
+import shutil
+import statistics
+import sys
+import threading
+import time
+from collections.abc import Callable
+
+import cv2
+import numpy as np
+from PIL import Image
+
+import helpers.offload as offload
+import helpers.opencv as opencv
+
+
+sample_text = "The quick brown fox jumps over the lazy dog 0123456789"
+
+
+def render_document(width: int, height: int, font_scale: float, skew: float = 0.0) -> np.ndarray:
+    """Render a BGR page full of text lines, optionally rotated by skew degrees."""
+    img = np.full((height, width, 3), 255, dtype=np.uint8)
+    thickness = max(1, int(font_scale * 2))
+    (_, text_height), _ = cv2.getTextSize(sample_text, cv2.FONT_HERSHEY_SIMPLEX, font_scale, thickness)
+    line_height = int(text_height * 2.2)
+    for y in range(line_height, height - line_height, line_height):
+        cv2.putText(img, sample_text, (width // 20, y), cv2.FONT_HERSHEY_SIMPLEX, font_scale, (0, 0, 0), thickness, cv2.LINE_AA)
+    if skew:
+        img = opencv.Pipeline([("rotate", {"angle": skew})]).run(img)
+    return img
+
+
+def render_pdf(pages: list[np.ndarray], dpi: int = 300) -> bytes:
+    images = [Image.fromarray(cv2.cvtColor(page, cv2.COLOR_BGR2RGB)) for page in pages]
+    buffer = io.BytesIO()
+    images[0].save(buffer, format="PDF", save_all=True, append_images=images[1:], resolution=dpi)
+    return buffer.getvalue()
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on linux and in bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / (1024 * 1024) if platform.system() == "Darwin" else maxrss / 1024
+
+
+def current_rss_mb() -> float:
+    """Resident set size of the process now, None without /proc (e.g. macOS)."""
+    try:
+        with open("/proc/self/statm", encoding="ascii") as file:
+            return int(file.read().split()[1]) * resource.getpagesize() / (1024 * 1024)
+    except OSError:
+        return None
+
+
+class RssSampler:
+    """Peak RSS growth while a stage runs. The current RSS is sampled on a thread, ru_maxrss
+    is the peak of the whole process and stays the same for stages after a bigger one.
+    Without /proc the growth of ru_maxrss is reported.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.start = current_rss_mb()
+        self.peak = self.start
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss_mb())
+
+    def __enter__(self) -> "RssSampler":
+        if self.start is None:
+            self.start = self.peak = peak_rss_mb()
+        else:
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self._thread.is_alive():
+            self._stop.set()
+            self._thread.join()
+            self.peak = max(self.peak, current_rss_mb())
+        else:
+            self.peak = peak_rss_mb()
+
+    @property
+    def growth_mb(self) -> float:
+        return self.peak - self.start
+
+
+def run_stage(name: str, fn: Callable, inputs: list, repeat: int, pixels: Callable = None) -> dict:
+    """Time fn over all inputs repeat times, returns the stage statistics."""
+    fn(inputs[0])  # warm up, e.g. lazy initialization and caches of the libraries
+    timings, total_pixels = [], 0
+    with RssSampler() as rss:
+        for _ in range(repeat):
+            for item in inputs:
+                start = time.perf_counter()
+                fn(item)
+                timings.append(time.perf_counter() - start)
+                total_pixels += pixels(item) if pixels else 0
+    timings.sort()
+    total = sum(timings)
+    return {
+        "stage": name,
+        "runs": len(timings),
+        "p50_ms": statistics.median(timings) * 1000,
+        "p95_ms": timings[min(len(timings) - 1, int(round(0.95 * (len(timings) - 1))))] * 1000,
+        "mean_ms": total / len(timings) * 1000,
+        "per_sec": len(timings) / total if total else float("inf"),
+        "mpix_per_sec": total_pixels / total / 1e6 if total and pixels else None,
+        "peak_rss_growth_mb": rss.growth_mb,
+    }
+
+
+def skipped(name: str, reason: str) -> dict:
+    return {"stage": name, "skipped": reason}
+
+
+def build_documents(scale: float) -> dict:
+    width, height = int(2480 * scale), int(3508 * scale)  # A4 at 300 dpi
+    docs = {
+        f"font{font_scale}_skew{skew}": render_document(width, height, font_scale * scale * 2, skew)
+        for font_scale in (0.6, 1.0, 1.6)
+        for skew in (0.0, 3.0, -7.0)
+    }
+    return docs
+
+
+def benchmark(scale: float, repeat: int, stages: list[str] = None) -> list[dict]:
+    docs = build_documents(scale)
+    images = list(docs.values())
+    gray = [cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) for img in images]
+    encoded = [cv2.imencode(".png", img)[1].tobytes() for img in images]
+    pixels = lambda img: img.shape[0] * img.shape[1]  # noqa: E731
+    results = []
+
+    def want(name: str) -> bool:
+        return not stages or any(name.startswith(stage) for stage in stages)
+
+    if want("decode"):
+        results.append(run_stage("decode.png", opencv.decode_image, encoded, repeat))
+    # every opencv step on its own, through the uncached pipeline implementation
+    opencv_steps = [
+        ("opencv.grayscale", [("grayscale", {})], images),
+        ("opencv.remove_noise", [("remove_noise", {})], gray),
+        ("opencv.denoising", [("denoising", {"strength": 10})], gray[:2]),
+        ("opencv.thresholding", [("thresholding", {"threshold": 128})], gray),
+        ("opencv.rotate90", [("rotate90", {"angle": 90})], gray),
+        ("opencv.rotate", [("rotate", {"angle": 5})], gray),
+        ("opencv.rotate_scipy", [("rotate_scipy", {"angle": 5, "reshape": True})], gray[:2]),
+        ("opencv.deskew", [("deskew", {})], gray),
+        ("opencv.crop", [("crop", {"left": 10, "right": 10, "top": 10, "bottom": 10})], gray),
+        ("opencv.opening", [("opening", {})], gray),
+    ]
+    workers, min_pixels = offload.max_workers, offload.min_pixels
+    offload.configure(workers=0)
+    for name, steps, inputs in opencv_steps:
+        if want(name):
+            results.append(run_stage(name, opencv.Pipeline(steps).run, inputs, repeat, pixels))
+    offload.configure(workers=workers)
+    offload_steps = [
+        ("offload.denoising", [("denoising", {"strength": 10})], gray[:2]),
+        ("offload.rotate_scipy", [("rotate_scipy", {"angle": 5, "reshape": True})], gray[:2]),
+    ]
+    if workers > 0 and any(want(name) for name, _, _ in offload_steps):
+        # every page goes to the pool whatever its size, the workers are spawned before the timing
+        offload.min_pixels = 0
+        offload.start()
+        for name, steps, inputs in offload_steps:
+            if want(name):
+                results.append(run_stage(name, opencv.Pipeline(steps).run, inputs, repeat, pixels))
+        offload.min_pixels = min_pixels
+    if want("opencv.estimate_skew"):
+        results.append(run_stage("opencv.estimate_skew", opencv.estimate_skew, gray, repeat, pixels))
+
+    if want("pdf"):
+        if shutil.which("pdftoppm") is None:
+            results.append(skipped("pdf.rasterize", "poppler (pdftoppm) is not installed"))
+        else:
+            import helpers.pdfimage as pdfimage
+
+            pdf = render_pdf(images[:4])
+            for dpi in (150, 300):
+                results.append(run_stage(
+                    f"pdf.rasterize.{dpi}dpi", lambda data, dpi=dpi: list(pdfimage.iter_pages(data, dpi=dpi)), [pdf], repeat
+                ))
+
+    if want("ocr.tesseract"):
+        import helpers.tesseract as tesseract
+
+        binary = tesseract.find_tesseract_binary()
+        if not binary:
+            results.append(skipped("ocr.tesseract", "tesseract binary is not installed"))
+        else:
+            tesseract.set_tesseract_path(binary)
+            config = tesseract.get_tesseract_config(oem_index=3, psm_index=3)
+            results.append(run_stage(
+                f"ocr.tesseract.{tesseract.backend}",
+                lambda img: tesseract.extract_text(image=img, language_short="eng", config=config, timeout=120),
+                gray[:3], max(1, repeat // 2), pixels,
+            ))
+
+    if want("ocr.easyocr"):
+        try:
+            import helpers.easy_ocr as easy_ocr
+        except ImportError as e:
+            results.append(skipped("ocr.easyocr", f"easyocr is not installed ({e})"))
+        else:
+            reader = easy_ocr.easyocr_reader("en")
+            rgb = [cv2.cvtColor(img, cv2.COLOR_BGR2RGB) for img in images[:3]]
+            results.append(run_stage("ocr.easyocr", reader.readtext, rgb, max(1, repeat // 2), pixels))
+            # all pages in one call, crops of similar width share recognizer batches
+            results.append(run_stage(
+                "ocr.easyocr.batch", lambda items: easy_ocr.readtext_batch(items, "en"), [rgb], max(1, repeat // 2)
+            ))
+    return results
+
+
+def print_report(results: list[dict], baseline: dict = None):
+    print(f"{'stage':32} {'runs':>5} {'p50 ms':>10} {'p95 ms':>10} {'1/s':>8} {'MP/s':>8} {'RSS+ MB':>8} {'vs base':>8}")
+    for result in results:
+        if "skipped" in result:
+            print(f"{result['stage']:32} skipped: {result['skipped']}")
+            continue
+        base = (baseline or {}).get(result["stage"])
+        ratio = f"{result['p50_ms'] / base['p50_ms']:.2f}x" if base and base.get("p50_ms") else ""
+        mpix = f"{result['mpix_per_sec']:.1f}" if result["mpix_per_sec"] else ""
+        print(
+            f"{result['stage']:32} {result['runs']:>5} {result['p50_ms']:>10.2f} {result['p95_ms']:>10.2f} "
+            f"{result['per_sec']:>8.2f} {mpix:>8} {result['peak_rss_growth_mb']:>8.1f} {ratio:>8}"
+        )
+
+
+def regressions(results: list[dict], baseline: dict, tolerance: float) -> list[str]:
+    """Stages whose p50 latency is more than tolerance slower than in the baseline."""
+    failed = []
+    for result in results:
+        base = baseline.get(result["stage"])
+        if "skipped" in result or not base or "p50_ms" not in base:
+            continue
+        if result["p50_ms"] > base["p50_ms"] * (1 + tolerance):
+            failed.append(f"{result['stage']}: p50 {result['p50_ms']:.2f} ms vs baseline {base['p50_ms']:.2f} ms")
+    return failed
+
+
+def main(argv: list[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the preprocessing, rasterization and OCR stages.")
+    parser.add_argument("--scale", type=float, default=0.5, help="page size relative to A4 at 300 dpi (default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=3, help="repetitions per input (default: %(default)s)")
+    parser.add_argument("--stages", nargs="*", help="only run stages starting with these names, e.g. opencv pdf ocr")
+    parser.add_argument("--save", metavar="JSON", help="store the results as baseline")
+    parser.add_argument("--compare", metavar="JSON", help="compare with a stored baseline and fail on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed p50 slowdown vs baseline (default: %(default)s)")
+    options = parser.parse_args(argv)
+
+    results = benchmark(scale=options.scale, repeat=options.repeat, stages=options.stages)
+    baseline = None
+    if options.compare:
+        with open(options.compare, encoding="utf-8") as file:
+            stored = json.load(file)
+        # latencies of other page sizes or another set of stages are no baseline
+        stored_stages = [result["stage"] for result in stored["results"]]
+        stages = [result["stage"] for result in results]
+        if stored.get("scale") != options.scale or stored_stages != stages:
+            print(
+                f"Baseline {options.compare} does not match this run: scale {stored.get('scale')} vs {options.scale}, "
+                f"stages {stored_stages} vs {stages}.",
+                file=sys.stderr,
+            )
+            return 2
+        baseline = {result["stage"]: result for result in stored["results"]}
+    print_report(results, baseline)
+    if options.save:
+        with open(options.save, "w", encoding="utf-8") as file:
+            json.dump({"scale": options.scale, "python": sys.version, "results": results}, file, indent=2)
+    if baseline:
+        failed = regressions(results, baseline, options.tolerance)
+        for line in failed:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        return 1 if failed else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,104 @@
+'''
+Scaling benchmark for batched EasyOCR recognition on CPU.
+
+Reads the same synthetic pages with every combination of worker processes and
+torch threads per worker and reports images/sec, next to the baseline of one
+readtext call per image with the default torch settings. The worker pool of a
+combination is started once and every worker loads its model before the timing,
+so only the reads are timed, not the process spawn and model loading.
+
+    python -m benchmarks.easyocr_scaling                            # 1, 2, 4 workers x 1, 2, 4 threads
+    python -m benchmarks.easyocr_scaling --workers 1 2 --threads 2 4 --images 16
+    python -m benchmarks.easyocr_scaling --save scaling.json
+
+Combinations with more threads in total than cores are skipped unless --oversubscribe is given.
+'''
+import argparse
+import json
+import os
+import sys
+import time
+
+import cv2
+
+from benchmarks.bench import build_documents
+
+
+def run(fn, images: list) -> dict:
+    start = time.perf_counter()
+    fn(images)
+    seconds = time.perf_counter() - start
+    return {"seconds": seconds, "images_per_sec": len(images) / seconds if seconds else float("inf")}
+
+
+def benchmark(
+    easy_ocr, images: list, lang: str, workers: list[int], threads: list[int], batch_size: int, oversubscribe: bool
+) -> list[dict]:
+    cores = os.cpu_count() or 1
+    reader = easy_ocr.easyocr_reader(lang)
+    reader.readtext(images[0])  # warm up
+    results = [{"mode": "readtext", "workers": 1, "threads": None, **run(lambda items: [reader.readtext(img) for img in items], images)}]
+    for worker_count in workers:
+        for thread_count in threads:
+            if worker_count * thread_count > cores and not oversubscribe:
+                continue
+            result = {"mode": "batch", "workers": worker_count, "threads": thread_count}
+            if worker_count <= 1:
+                # read in this process, its reader is loaded already
+                results.append({**result, **run(lambda items: easy_ocr.readtext_parallel(
+                    items, lang, workers=1, threads=thread_count, batch_size=batch_size
+                ), images)})
+                continue
+            with easy_ocr.worker_pool(worker_count, thread_count) as executor:
+
+                def read(items):
+                    return easy_ocr.readtext_parallel(
+                        items, lang, workers=worker_count, threads=thread_count, batch_size=batch_size, executor=executor
+                    )
+
+                # one image per worker at the same time: every worker is spawned and loads its model
+                read([images[i % len(images)] for i in range(worker_count)])
+                results.append({**result, **run(read, images)})
+    return results
+
+
+def print_report(results: list[dict]):
+    base = results[0]["images_per_sec"]
+    print(f"{'mode':10} {'workers':>8} {'threads':>8} {'seconds':>9} {'img/s':>8} {'vs readtext':>12}")
+    for result in results:
+        threads = result["threads"] if result["threads"] is not None else "default"
+        print(
+            f"{result['mode']:10} {result['workers']:>8} {threads:>8} {result['seconds']:>9.2f} "
+            f"{result['images_per_sec']:>8.2f} {result['images_per_sec'] / base:>11.2f}x"
+        )
+
+
+def main(argv: list[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Images/sec of batched EasyOCR by worker processes and torch threads.")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="worker processes (default: %(default)s)")
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4], help="torch threads per worker (default: %(default)s)")
+    parser.add_argument("--images", type=int, default=8, help="number of pages to read (default: %(default)s)")
+    parser.add_argument("--scale", type=float, default=0.3, help="page size relative to A4 at 300 dpi (default: %(default)s)")
+    parser.add_argument("--batch-size", type=int, default=32, help="text crops per recognizer batch (default: %(default)s)")
+    parser.add_argument("--lang", default="en", help="easyocr language (default: %(default)s)")
+    parser.add_argument("--oversubscribe", action="store_true", help="also run combinations with more threads than cores")
+    parser.add_argument("--save", metavar="JSON", help="store the results")
+    options = parser.parse_args(argv)
+
+    try:
+        import helpers.easy_ocr as easy_ocr
+    except ImportError as e:
+        print(f"easyocr is not installed ({e})", file=sys.stderr)
+        return 1
+    pages = [cv2.cvtColor(img, cv2.COLOR_BGR2RGB) for img in build_documents(options.scale).values()]
+    images = [pages[i % len(pages)] for i in range(options.images)]
+    results = benchmark(easy_ocr, images, options.lang, options.workers, options.threads, options.batch_size, options.oversubscribe)
+    print_report(results)
+    if options.save:
+        with open(options.save, "w", encoding="utf-8") as file:
+            json.dump({"cores": os.cpu_count(), "images": options.images, "scale": options.scale, "results": results}, file, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
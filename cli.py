@@ -0,0 +1,330 @@
+'''
+Headless batch OCR over directories, glob patterns and zip/tar archives.
+
+Example:
+    python cli.py scans/ invoices.zip "more/**/*.png" --output ocr_out --lang aze --format json
+
+Every input file gets one output file below --output with the same relative path
+and a .txt, .tsv, .hocr or .json suffix, TSV, hOCR and JSON also contain the
+word boxes and confidences. With --format pdf every input is written as a
+searchable PDF with an invisible text layer (needs PyMuPDF). Inputs whose output already exists are skipped, so an
+interrupted run can simply be started again.
+'''
+import argparse
+import fnmatch
+import glob
+import json
+import os
+import sys
+import tarfile
+import zipfile
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import wait
+from dataclasses import dataclass
+from dataclasses import field
+from pathlib import Path
+
+import cv2
+
+import helpers.ocrresult as ocrresult
+import helpers.offload as offload
+import helpers.opencv as opencv
+import helpers.pdfocr as pdfocr
+import helpers.pdftext as pdftext
+import helpers.quality as quality
+import helpers.searchablepdf as searchablepdf
+import helpers.tesseract as tesseract
+import helpers.tiling as tiling
+
+
+image_extensions = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff")
+pdf_extensions = (".pdf",)
+archive_patterns = ("*.zip", "*.tar", "*.tar.gz", "*.tgz", "*.tar.bz2", "*.tar.xz")
+
+
+@dataclass(frozen=True)
+class Task:
+    source: str  # path of the file or of the archive
+    member: str  # name of the archive member, None for plain files
+    relname: str  # relative name used for the output file
+    # content of tar members, read in one sequential pass over the archive by the parent process
+    data: bytes = field(default=None, repr=False, compare=False)
+
+
+# zip archives opened by this worker process, the central directory is read once per archive
+_zip_files = {}
+
+
+def available_cores() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def safe_relname(name: str) -> str:
+    """Relative output name without absolute or parent directory parts."""
+    parts = [part for part in Path(name).parts if part not in ("", ".", "..") and part != Path(name).anchor]
+    return os.path.join(*parts) if parts else "unnamed"
+
+
+def is_supported(name: str) -> bool:
+    return name.lower().endswith(image_extensions + pdf_extensions)
+
+
+def is_archive(path: str) -> bool:
+    return any(fnmatch.fnmatch(path.lower(), pattern) for pattern in archive_patterns)
+
+
+def archive_tasks(path: str):
+    """Tasks of the supported members of an archive.
+    Zip members are read by the workers (random access), tar members are read here in archive order:
+    a compressed tar can only be read from the start, reopening it per member would decompress it again each time.
+    """
+    archive_name = Path(path).name
+    if path.lower().endswith(".zip"):
+        with zipfile.ZipFile(path) as archive:
+            names = [info.filename for info in archive.infolist() if not info.is_dir()]
+        for name in sorted(names):
+            if is_supported(name):
+                yield Task(source=path, member=name, relname=os.path.join(archive_name, safe_relname(name)))
+        return
+    # stream mode, the members are decompressed once in one pass
+    with tarfile.open(path, mode="r|*") as archive:
+        for member in archive:
+            if member.isfile() and is_supported(member.name):
+                data = archive.extractfile(member).read()
+                yield Task(source=path, member=member.name, relname=os.path.join(archive_name, safe_relname(member.name)), data=data)
+
+
+def collect_tasks(inputs: list[str]):
+    """Expand directories, glob patterns and archives to single OCR tasks."""
+    for item in inputs:
+        if os.path.isdir(item):
+            for path in sorted(Path(item).rglob("*")):
+                if path.is_file() and is_supported(path.name):
+                    yield Task(source=str(path), member=None, relname=str(path.relative_to(item)))
+                elif path.is_file() and is_archive(path.name):
+                    yield from archive_tasks(str(path))
+            continue
+        paths = [item] if os.path.isfile(item) else sorted(glob.glob(item, recursive=True))
+        if not paths:
+            print(f"WARNING: no files found for {item}", file=sys.stderr)
+        for path in paths:
+            if is_archive(path):
+                yield from archive_tasks(path)
+            elif os.path.isfile(path) and is_supported(path):
+                yield Task(source=path, member=None, relname=safe_relname(os.path.relpath(path)))
+
+
+def output_path(task: Task, output_dir: str, output_format: str) -> Path:
+    return Path(output_dir) / f"{task.relname}.{output_format}"
+
+
+def read_task(task: Task) -> bytes:
+    if task.data is not None:
+        return task.data
+    if task.member is None:
+        return Path(task.source).read_bytes()
+    archive = _zip_files.get(task.source)
+    if archive is None:
+        archive = _zip_files[task.source] = zipfile.ZipFile(task.source)
+    return archive.read(task.member)
+
+
+def ocr_task(task: Task, options: argparse.Namespace) -> list[tuple[int, str, str, str]]:
+    """OCR one input file, returns a list of (page, text, error, source), see pdfocr.ocr_pdf.
+    For the structured output formats the pages are ocrresult.OcrResult instead of text.
+    """
+    data = read_task(task)
+    structured = options.format != "txt"
+    if task.relname.lower().endswith(pdf_extensions):
+        # the process pool already uses all cores, so OCR the pages of one PDF sequentially
+        return list(pdfocr.ocr_pdf(
+            pdf_bytes=data,
+            language_short=options.lang,
+            config=options.config,
+            timeout=options.timeout,
+            preprocess=options.pipeline,
+            max_workers=1,
+            dpi=options.dpi,
+            structured=structured,
+            use_text_layer=not options.force_ocr,
+        ))
+    ocr_image = tiling.ocr_image_result if structured else tiling.ocr_image
+    result, error = ocr_image(
+        opencv.decode_image(data),
+        language_short=options.lang,
+        config=options.config,
+        timeout=options.timeout,
+        preprocess=options.pipeline,
+    )
+    return [(1, result, error, pdftext.OCR)]
+
+
+def write_output(task: Task, pages: list[tuple[int, str, str, str]], options: argparse.Namespace):
+    path = output_path(task, options.output, options.format)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if options.format == "json":
+        content = json.dumps(
+            {
+                "source": task.source,
+                "member": task.member,
+                "pages": [
+                    {"page": page, "source": source, "text": result.to_text(), "words": result.to_dict(), "error": error}
+                    for page, result, error, source in pages
+                ],
+            },
+            ensure_ascii=False,
+            indent=2,
+        )
+    elif options.format != "txt":
+        content = ocrresult.render_pages([result for _, result, _, _ in pages], options.format)
+    else:
+        content = "\f".join(text or "" for _, text, _, _ in pages)
+    # write to a temporary file first, so an interrupted run never leaves a partial output behind
+    tmp_path = path.with_name(path.name + ".tmp")
+    tmp_path.write_text(content, encoding="utf-8")
+    os.replace(tmp_path, path)
+
+
+def write_searchable_pdf(task: Task, options: argparse.Namespace) -> str:
+    """Write the input as searchable PDF, images are converted to a PDF page first. Returns the error."""
+    data = read_task(task)
+    if not task.relname.lower().endswith(pdf_extensions):
+        data = searchablepdf.image_to_pdf(data, filetype=Path(task.relname).suffix.lstrip(".").lower())
+    path = output_path(task, options.output, options.format)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + ".tmp")
+    _, error = searchablepdf.make_searchable(
+        data,
+        str(tmp_path),
+        language_short=options.lang,
+        config=options.config,
+        timeout=options.timeout,
+        preprocess=options.pipeline,
+        max_workers=1,
+        dpi=options.dpi,
+    )
+    if error:
+        tmp_path.unlink(missing_ok=True)
+        return error
+    os.replace(tmp_path, path)
+    return None
+
+
+def process_task(task: Task, options: argparse.Namespace) -> tuple[Task, str]:
+    """Worker entry point, returns (task, error). Nothing is written on errors, so the task is retried next run."""
+    if options.format == "pdf":
+        try:
+            return (task, write_searchable_pdf(task, options))
+        except Exception as e:
+            return (task, str(e))
+    try:
+        pages = ocr_task(task, options)
+    except Exception as e:
+        return (task, str(e))
+    errors = [f"page {page}: {error}" if page else error for page, _, error, _ in pages if error]
+    if errors:
+        return (task, "; ".join(errors))
+    write_output(task, pages, options)
+    return (task, None)
+
+
+def init_worker():
+    # pytesseract needs the binary path in every worker process
+    tesseract.set_tesseract_path(tesseract.find_tesseract_binary())
+    # one tesseract/opencv thread per process, the process pool does the parallelism
+    os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+    cv2.setNumThreads(1)
+    # no nested process pool for the heavy preprocessing steps
+    offload.configure(workers=0)
+
+
+def parse_args(argv: list[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Batch OCR for images and PDFs with Tesseract.")
+    parser.add_argument("inputs", nargs="+", help="directories, files, glob patterns or zip/tar archives")
+    parser.add_argument("-o", "--output", default="ocr_output", help="output directory (default: %(default)s)")
+    parser.add_argument("-f", "--format", choices=ocrresult.formats + ("pdf",), default="txt", help="output format (default: %(default)s)")
+    parser.add_argument("-l", "--lang", default="eng", help="tesseract language, e.g. eng or aze (default: %(default)s)")
+    parser.add_argument("--oem", type=int, default=3, help="tesseract OCR engine mode (default: %(default)s)")
+    parser.add_argument("--psm", type=int, default=3, help="tesseract page segmentation mode (default: %(default)s)")
+    parser.add_argument("--timeout", type=int, default=60, help="tesseract timeout per page in seconds (default: %(default)s)")
+    parser.add_argument(
+        "--dpi",
+        type=lambda value: None if value == "auto" else int(value),
+        default="auto",
+        help="PDF rasterization resolution, auto chooses it per page from page size and text height (default: %(default)s)",
+    )
+    parser.add_argument("--force-ocr", action="store_true", help="OCR PDF pages even if they have a text layer")
+    parser.add_argument("--no-grayscale", dest="grayscale", action="store_false", help="do not convert images to grayscale")
+    parser.add_argument("--auto-rotate", action="store_true", help="detect the orientation with tesseract OSD and deskew")
+    parser.add_argument("--denoise", type=int, metavar="STRENGTH", help="apply denoising with the given strength")
+    parser.add_argument("--threshold", type=int, metavar="LEVEL", help="apply thresholding with the given level")
+    parser.add_argument(
+        "--auto-preprocess",
+        action="store_true",
+        help="choose denoising and thresholding per image from its measured noise, contrast and lighting",
+    )
+    parser.add_argument("-j", "--workers", type=int, default=available_cores(), help="worker processes (default: %(default)s)")
+    parser.add_argument("--overwrite", action="store_true", help="process inputs even if their output exists")
+    options = parser.parse_args(argv)
+    if options.format == "pdf" and not searchablepdf.available:
+        parser.error("--format pdf needs PyMuPDF, please install it with pip install PyMuPDF")
+    options.config = tesseract.get_tesseract_config(oem_index=options.oem, psm_index=options.psm)
+    steps = []
+    if options.grayscale:
+        steps.append(("grayscale", {}))
+    if options.auto_rotate:
+        steps.append(("orient", {"timeout": options.timeout}))
+        steps.append(("deskew", {}))
+    if options.denoise:
+        steps.append(("denoising", {"strength": options.denoise}))
+    if options.threshold is not None:
+        steps.append(("thresholding", {"threshold": options.threshold}))
+    if options.auto_preprocess and (options.denoise or options.threshold is not None):
+        parser.error("--auto-preprocess chooses denoising and thresholding itself, do not combine it with --denoise or --threshold")
+    options.pipeline = quality.AutoPipeline(steps) if options.auto_preprocess else opencv.Pipeline(steps)
+    if options.format == "pdf" and not options.pipeline.pixelwise:
+        parser.error("--format pdf can not be combined with --auto-rotate, the text layer must match the original pages")
+    return options
+
+
+def main(argv: list[str] = None) -> int:
+    options = parse_args(argv)
+    if not tesseract.find_tesseract_binary():
+        print("ERROR: Tesseract binary not found in PATH. Please install Tesseract.", file=sys.stderr)
+        return 2
+    done, skipped, failed = 0, 0, 0
+    max_pending = 4 * options.workers
+    with ProcessPoolExecutor(max_workers=options.workers, initializer=init_worker) as executor:
+        pending = set()
+
+        def collect(futures):
+            nonlocal done, failed
+            for future in futures:
+                task, error = future.result()
+                if error:
+                    failed += 1
+                    print(f"FAILED {task.relname}: {error}", file=sys.stderr)
+                else:
+                    done += 1
+                    print(f"OK {task.relname}")
+
+        for task in collect_tasks(options.inputs):
+            if not options.overwrite and output_path(task, options.output, options.format).exists():
+                skipped += 1
+                continue
+            pending.add(executor.submit(process_task, task, options))
+            # bounded number of queued tasks, so huge backfills do not build up in memory
+            if len(pending) >= max_pending:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(finished)
+        collect(pending)
+    print(f"done: {done}, skipped: {skipped}, failed: {failed}", file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -26,6 +26,7 @@ languages_easyocr = {
     "por": "pt",
     "ces": "cs",
     "pol": "pl",
+    "aze": "az",
 }
 
 flags = {
@@ -1,14 +1,40 @@
 '''
-This module is curently NOT used in the main app.
-It is a helper module to test the easyocr library with streamlit in the future.
+Helper module for the easyocr library.
+The reader registry below is used by the main app, the rest of the module
+can be run directly to test easyocr with streamlit.
+With EASYOCR_BACKEND=onnx the registry loads the exported ONNX models (see
+onnx_easyocr) instead of the torch models, torch and easyocr are not needed then.
 '''
+import math
+import multiprocessing
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
 import cv2
-import easyocr
 import numpy as np
 import pandas as pd
 import requests
 import streamlit as st
-import torch
+
+import helpers.metrics as metrics
+import helpers.ocrresult as ocrresult
+import helpers.onnx_easyocr as onnx_easyocr
+
+# "torch" (easyocr) or "onnx" (exported int8 models on onnxruntime)
+backend = os.environ.get("EASYOCR_BACKEND", "torch")
+
+try:
+    import easyocr
+    import torch
+    from easyocr.recognition import get_text
+    from easyocr.utils import get_image_list
+    from easyocr.utils import reformat_input
+except ImportError:  # the onnx backend runs without torch and easyocr
+    if backend != "onnx":
+        raise
+    easyocr = torch = None
 
 # st.set_page_config(page_title="EasyOCR", page_icon="📝", layout="wide", initial_sidebar_state="collapsed")
 
@@ -26,19 +52,214 @@ def download_sample_image(url: str) -> np.ndarray:
     return cv2_rgb
 
 
-@st.cache_resource
-def easyocr_reader(lang: str) -> easyocr.easyocr.Reader:
-    """Create an easyocr reader object
-    params: lang: language to use
+# maximum number of easyocr readers kept loaded at the same time
+max_readers = int(os.environ.get("EASYOCR_MAX_READERS", "2"))
+# torch intra-op threads per worker, 0 to divide the cores by the number of workers
+torch_threads = int(os.environ.get("EASYOCR_TORCH_THREADS", "0"))
+# text crops per recognizer batch
+batch_size = int(os.environ.get("EASYOCR_BATCH_SIZE", "32"))
+# the recognizer input height, every crop is scaled to it
+model_height = 64
+
+
+def configure_torch_threads(workers: int = 1, threads: int = None) -> int:
+    """Set the torch thread counts of this process, so parallel workers do not oversubscribe the cores.
+    Every worker gets threads intra-op threads, by default the cores divided by workers, and one
+    inter-op thread. Returns the intra-op thread count.
+    """
+    threads = threads or torch_threads or max(1, (os.cpu_count() or 1) // max(1, workers))
+    # the onnx sessions get the same thread count
+    onnx_easyocr.session_threads = threads
+    if torch is None:
+        return threads
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # can only be set once per process, before the first inter-op parallel work
+        pass
+    return threads
+
+
+class ReaderRegistry:
+    """Process wide pool of loaded easyocr readers, keyed by language set.
+    Loading a reader means reading the detector and recognizer weights from disk,
+    so every reader is loaded only once and shared by all streamlit sessions.
+    The least recently used reader is evicted when more than max_readers are loaded.
     """
-    if torch.cuda.is_available():
-        return easyocr.Reader([lang], gpu=True)
-    else:
-        return easyocr.Reader([lang], gpu=False)
+
+    def __init__(self, max_readers: int = 2):
+        self.max_readers = max(1, max_readers)
+        self._readers: OrderedDict[tuple[str, ...], "easyocr.easyocr.Reader"] = OrderedDict()
+        self._loading: dict[tuple[str, ...], threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(languages: list[str] | tuple[str, ...] | str) -> tuple[str, ...]:
+        if isinstance(languages, str):
+            languages = [languages]
+        return tuple(sorted(set(languages)))
+
+    def get(self, languages: list[str] | tuple[str, ...] | str) -> "easyocr.easyocr.Reader":
+        """Return the reader for the language set, load it if needed."""
+        key = self.key(languages)
+        with self._lock:
+            reader = self._readers.get(key)
+            if reader is not None:
+                self._readers.move_to_end(key)
+                return reader
+            # one lock per language set, so concurrent sessions wait for the same load
+            loading = self._loading.setdefault(key, threading.Lock())
+        with loading:
+            with self._lock:
+                reader = self._readers.get(key)
+                if reader is not None:
+                    self._readers.move_to_end(key)
+                    return reader
+            with metrics.timed("easyocr.load"):
+                reader = load_reader(key)
+            with self._lock:
+                self._readers[key] = reader
+                self._readers.move_to_end(key)
+                while len(self._readers) > self.max_readers:
+                    self._readers.popitem(last=False)
+                self._loading.pop(key, None)
+        return reader
+
+    def warmup(self, *language_sets: list[str] | tuple[str, ...] | str):
+        """Load the readers for the given language sets in advance."""
+        for languages in language_sets:
+            self.get(languages)
+
+    def loaded(self) -> list[tuple[str, ...]]:
+        with self._lock:
+            return list(self._readers.keys())
+
+    def clear(self):
+        with self._lock:
+            self._readers.clear()
+
+
+def load_reader(key: tuple[str, ...]) -> "easyocr.easyocr.Reader":
+    """Load the models of a language set with the configured backend."""
+    if backend == "onnx":
+        return onnx_easyocr.OnnxReader(key)
+    return easyocr.Reader(list(key), gpu=torch.cuda.is_available())
+
+
+registry = ReaderRegistry(max_readers=max_readers)
+
+
+def easyocr_reader(lang: str | list[str]) -> "easyocr.easyocr.Reader":
+    """Get a shared easyocr reader object from the registry
+    params: lang: language or list of languages to use
+    """
+    return registry.get(lang)
+
+
+def readtext_batch(
+    images: list[np.ndarray],
+    lang: str | list[str],
+    boxes: list[list[tuple[int, int, int, int]] | None] = None,
+    batch_size: int = batch_size,
+) -> list[ocrresult.OcrResult]:
+    """Read many images with one reader, the recognizer runs on batches of text crops of all images
+    params: images: RGB or gray images
+    params: lang: language or list of languages to use
+    params: boxes: per image the text boxes as (left, top, right, bottom) to skip the detector, or None
+    params: batch_size: text crops per recognizer batch
+    On CPU readtext recognizes one crop after the other, and a batch is padded to its widest crop.
+    Here the crops of all images are sorted by width, so a batch holds crops of similar width.
+    """
+    reader = easyocr_reader(lang)
+    if isinstance(reader, onnx_easyocr.OnnxReader):
+        return [
+            ocrresult.OcrResult.from_easyocr(reading, image_width=image.shape[1], image_height=image.shape[0])
+            for reading, image in zip(reader.readtext_batch(images, boxes=boxes, batch_size=batch_size), images)
+        ]
+    ignore_char = "".join(set(reader.character) - set(reader.lang_char))
+    crops, sizes = [], []
+    for index, image in enumerate(images):
+        img, gray = reformat_input(image)
+        sizes.append(gray.shape[:2])
+        if boxes is not None and boxes[index] is not None:
+            # easyocr boxes are [x_min, x_max, y_min, y_max]
+            horizontal_list = [[int(left), int(right), int(top), int(bottom)] for left, top, right, bottom in boxes[index]]
+            free_list = []
+        else:
+            with metrics.timed("easyocr.detect", image):
+                horizontal_list, free_list = reader.detect(img)
+            horizontal_list, free_list = horizontal_list[0], free_list[0]
+        image_list, _ = get_image_list(horizontal_list, free_list, gray, model_height=model_height)
+        crops.extend((index, box, crop) for box, crop in image_list)
+    crops.sort(key=lambda item: item[2].shape[1])
+    readings = [[] for _ in images]
+    for start in range(0, len(crops), max(1, batch_size)):
+        batch = crops[start : start + batch_size]
+        # the batch is padded to its widest crop, in steps of the model height like easyocr does
+        max_width = max(model_height, math.ceil(batch[-1][2].shape[1] / model_height) * model_height)
+        with metrics.timed("easyocr.recognize"):
+            # private easyocr function, written against the pinned easyocr version (requirements.txt)
+            result = get_text(
+                reader.character, model_height, max_width, reader.recognizer, reader.converter,
+                [(box, crop) for _, box, crop in batch],
+                ignore_char=ignore_char, decoder="greedy", beamWidth=5, batch_size=len(batch),
+                contrast_ths=0.1, adjust_contrast=0.5, filter_ths=0.003, workers=0, device=reader.device,
+            )
+        for (index, _, _), reading in zip(batch, result):
+            readings[index].append(reading)
+    return [
+        ocrresult.OcrResult.from_easyocr(reading, image_width=width, image_height=height)
+        for reading, (height, width) in zip(readings, sizes)
+    ]
+
+
+def _init_worker(threads: int):
+    configure_torch_threads(threads=threads)
+
+
+def worker_pool(workers: int, threads: int = None) -> ProcessPoolExecutor:
+    """Process pool for readtext_parallel, every worker gets threads torch threads, by default the cores divided by workers."""
+    threads = threads or max(1, (os.cpu_count() or 1) // workers)
+    # spawn, torch does not survive a fork after its thread pools are started
+    context = multiprocessing.get_context("spawn")
+    return ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker, initargs=(threads,))
+
+
+def readtext_parallel(
+    images: list[np.ndarray],
+    lang: str | list[str],
+    workers: int = 1,
+    threads: int = None,
+    boxes: list[list[tuple[int, int, int, int]] | None] = None,
+    batch_size: int = batch_size,
+    executor: ProcessPoolExecutor = None,
+) -> list[ocrresult.OcrResult]:
+    """readtext_batch on a pool of worker processes, each with its own reader and threads torch threads
+    params: workers: number of processes, every process loads the model once
+    params: threads: torch intra-op threads per process, by default the cores divided by workers
+    params: executor: pool of worker_pool(workers, threads) to reuse, without it a pool is started and shut down per call
+    """
+    if executor is None and (workers <= 1 or len(images) <= 1):
+        configure_torch_threads(workers=1, threads=threads)
+        return readtext_batch(images, lang, boxes=boxes, batch_size=batch_size)
+    if executor is None:
+        with worker_pool(workers, threads) as executor:
+            return readtext_parallel(images, lang, workers, threads, boxes, batch_size, executor)
+    size = math.ceil(len(images) / max(1, workers))
+    chunks = [range(start, min(start + size, len(images))) for start in range(0, len(images), size)]
+    futures = [
+        executor.submit(
+            readtext_batch, [images[i] for i in chunk], lang,
+            [boxes[i] for i in chunk] if boxes is not None else None, batch_size,
+        )
+        for chunk in chunks
+    ]
+    return [result for future in futures for result in future.result()]
 
 
 @st.cache_data
-def easyocr_read(img: np.ndarray, _reader: easyocr.easyocr.Reader, detail: int = 0):
+def easyocr_read(img: np.ndarray, _reader: "easyocr.easyocr.Reader", detail: int = 0):
     """Read text from image using easyocr
     params: img: image to read
             reader: easyocr reader object
@@ -71,6 +292,15 @@ def easyocr_get_text_from_result(result: list) -> str:
     return "\r".join([text for box, text, conf in result])
 
 
+def easyocr_get_ocr_result(result: list, image: np.ndarray = None) -> ocrresult.OcrResult:
+    """Get the columnar OcrResult (boxes, confidences, lines) from easyocr verbose result
+    params: result: easyocr verbose result with detail=1
+    params: image: the OCRed image, for the page size
+    """
+    height, width = image.shape[:2] if image is not None else (0, 0)
+    return ocrresult.OcrResult.from_easyocr(result, image_width=width, image_height=height)
+
+
 # Test the functions above with streamlit and easyocr
 if __name__ == "__main__":
     st.title("EasyOCR")
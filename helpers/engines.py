@@ -0,0 +1,256 @@
+'''
+OCR engine abstraction with an ensemble and a fast path policy.
+Every engine turns an image into an ocrresult.OcrResult. Besides the single
+engines there are two combinations of tesseract and easyocr:
+- EnsembleEngine runs both engines concurrently on the same image, aligns their
+  boxes and keeps the reading with the higher confidence per region.
+- FastPathEngine accepts the tesseract result if its confidence is high enough
+  and runs only the recognizer of easyocr on the low confidence lines.
+With regions=True the single engines only read the detected text regions of the
+image (see regions), blank margins and photos are skipped.
+Language codes are the tesseract ones (e.g. "aze"), easyocr codes are mapped.
+Color images are RGB like for easyocr, TesseractEngine hands them to the
+tesseract helpers as BGR like the other opencv images. The timeout of a call
+bounds the tesseract run, the easyocr model can not be interrupted.
+'''
+import os
+from abc import ABC
+from abc import abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+import helpers.constants as constants
+import helpers.metrics as metrics
+import helpers.ocrresult as ocrresult
+import helpers.opencv as opencv
+import helpers.regions as regions
+import helpers.tesseract as tesseract
+
+
+# tesseract results with a mean word confidence above this are accepted by the fast path
+fast_path_confidence = float(os.environ.get("OCR_FAST_PATH_CONFIDENCE", "0.80"))
+# boxes of two engines overlapping by more than this fraction of the smaller box cover the same region
+min_overlap = 0.5
+
+ensemble_choices = metrics.Counter(
+    "ocr_ensemble_choices_total", "Regions by the engine whose reading was chosen.", ("policy", "engine")
+)
+metrics.registry.append(ensemble_choices)
+
+
+def easyocr_language(language_short: str) -> str:
+    return constants.languages_easyocr.get(language_short, language_short[:2])
+
+
+class Engine(ABC):
+    """Base class, recognize returns (OcrResult, error) like the helper functions."""
+
+    name = "engine"
+
+    @abstractmethod
+    def recognize(self, image: np.ndarray, language_short: str, timeout: float = None) -> tuple[ocrresult.OcrResult, str]:
+        """Read an RGB or gray image, timeout (seconds) overrides the timeout of the engine for this call."""
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}()"
+
+
+class TesseractEngine(Engine):
+    name = "tesseract"
+
+    def __init__(self, config: str = "--oem 3 --psm 3", timeout: int = 20, regions: bool = False):
+        self.config = config
+        self.timeout = timeout
+        self.regions = regions
+
+    def recognize(self, image: np.ndarray, language_short: str, timeout: float = None) -> tuple[ocrresult.OcrResult, str]:
+        timeout = timeout or self.timeout
+        if image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+        if self.regions:
+            return regions.ocr_regions(image, language_short=language_short, config=self.config, timeout=timeout)
+        return tesseract.extract_result(image=image, language_short=language_short, config=self.config, timeout=timeout)
+
+
+class EasyOcrEngine(Engine):
+    name = "easyocr"
+
+    def __init__(self, batch_size: int = None, regions: bool = False):
+        # easyocr pulls in torch, so it is only imported if the engine is used
+        import helpers.easy_ocr as easy_ocr
+        self._easy_ocr = easy_ocr
+        self.batch_size = batch_size or easy_ocr.batch_size
+        self.regions = regions
+
+    def recognize(self, image: np.ndarray, language_short: str, timeout: float = None) -> tuple[ocrresult.OcrResult, str]:
+        boxes = self.region_boxes(image)
+        if boxes is not None:
+            return self.recognize_boxes(image, boxes, language_short)
+        results, error = self.recognize_many([image], language_short)
+        return (results[0] if results else None, error)
+
+    def region_boxes(self, image: np.ndarray) -> list[tuple[int, int, int, int]] | None:
+        """With regions=True the detected text lines of the image, None if the CRAFT detector has to run."""
+        if not self.regions:
+            return None
+        # the morphological line detection replaces the CRAFT detector, only the recognizer runs
+        with metrics.timed("regions.detect", image):
+            boxes = opencv.detect_text_regions(image, level="line", padding=4)
+        return boxes if regions.use_regions(boxes, *image.shape[:2]) else None
+
+    def recognize_many(
+        self, images: list[np.ndarray], language_short: str, boxes: list[list[tuple[int, int, int, int]] | None] = None
+    ) -> tuple[list[ocrresult.OcrResult], str]:
+        """Read several images (or given boxes of them) at once, the recognizer runs on batches of crops of all images."""
+        try:
+            with metrics.timed("easyocr.readtext"):
+                results = self._easy_ocr.readtext_batch(
+                    images, easyocr_language(language_short), boxes=boxes, batch_size=self.batch_size
+                )
+        except Exception as e:
+            return (None, str(e))
+        return (results, None)
+
+    def recognize_boxes(
+        self, image: np.ndarray, boxes: list[tuple[int, int, int, int]], language_short: str
+    ) -> tuple[ocrresult.OcrResult, str]:
+        """Run only the easyocr recognizer on the given (left, top, right, bottom) boxes, the detector is skipped."""
+        if not boxes:
+            return (ocrresult.OcrResult(image_width=image.shape[1], image_height=image.shape[0], engine=self.name), None)
+        results, error = self.recognize_many([image], language_short, boxes=[boxes])
+        return (results[0] if results else None, error)
+
+
+def region_overlap(a: ocrresult.OcrResult, boxes: np.ndarray) -> np.ndarray:
+    """Overlap of every word of a with every box (left, top, right, bottom) as fraction of the smaller area.
+    Returns an array of shape (len(a), len(boxes)).
+    """
+    if not len(a) or not len(boxes):
+        return np.zeros((len(a), len(boxes)))
+    x0, y0 = a.left[:, None].astype(np.float64), a.top[:, None].astype(np.float64)
+    x1, y1 = x0 + a.width[:, None], y0 + a.height[:, None]
+    bx0, by0, bx1, by1 = (boxes[:, i][None, :].astype(np.float64) for i in range(4))
+    inter = np.clip(np.minimum(x1, bx1) - np.maximum(x0, bx0), 0, None) * np.clip(np.minimum(y1, by1) - np.maximum(y0, by0), 0, None)
+    area_a = (x1 - x0) * (y1 - y0)
+    area_b = (bx1 - bx0) * (by1 - by0)
+    return inter / np.maximum(np.minimum(area_a, area_b), 1.0)
+
+
+def vote(primary: ocrresult.OcrResult, secondary: ocrresult.OcrResult, policy: str = "ensemble") -> ocrresult.OcrResult:
+    """Align the readings of two engines and keep the one with the higher confidence per region.
+    The regions are the lines of the primary result. The words of the secondary result are assigned to
+    the line they overlap most. Words of the secondary result without a line (missed by the primary engine)
+    are added.
+    """
+    lines = primary.line_boxes()
+    line_ids = np.asarray([line[0] for line in lines], dtype=np.int64)
+    boxes = np.asarray([line[1:] for line in lines], dtype=np.float64).reshape(-1, 4)
+    overlap = region_overlap(secondary, boxes)
+    assigned = overlap.argmax(axis=1) if len(boxes) else np.zeros(len(secondary), dtype=np.int64)
+    matched = overlap.max(axis=1) >= min_overlap if len(boxes) else np.zeros(len(secondary), dtype=bool)
+    keep_primary = np.ones(len(primary), dtype=bool)
+    keep_secondary = ~matched
+    for index, line in enumerate(line_ids):
+        in_line = primary.line == line
+        candidates = matched & (assigned == index)
+        if not candidates.any():
+            ensemble_choices.inc(policy=policy, engine=primary.engine)
+            continue
+        if secondary.conf[candidates].mean() > primary.conf[in_line].mean():
+            keep_primary &= ~in_line
+            keep_secondary |= candidates
+            ensemble_choices.inc(policy=policy, engine=secondary.engine)
+        else:
+            ensemble_choices.inc(policy=policy, engine=primary.engine)
+    result = ocrresult.OcrResult.concat(
+        [primary.select(keep_primary), secondary.select(keep_secondary)],
+        image_width=primary.image_width or secondary.image_width,
+        image_height=primary.image_height or secondary.image_height,
+    )
+    result = result.assign_lines()
+    result.engine = f"{primary.engine}+{secondary.engine}"
+    return result
+
+
+class EnsembleEngine(Engine):
+    """Tesseract and easyocr concurrently on the same image, the reading with the higher confidence wins per region.
+    Tesseract runs as a subprocess and torch releases the GIL, so two threads run both engines in parallel.
+    """
+
+    name = "ensemble"
+
+    def __init__(self, primary: Engine = None, secondary: Engine = None):
+        self.primary = primary or TesseractEngine()
+        self.secondary = secondary or EasyOcrEngine()
+        # the secondary engine runs on these threads, the primary on the calling thread. The threads are
+        # started on demand, one per concurrent recognize call (e.g. the workers of the service)
+        self._executor = ThreadPoolExecutor(thread_name_prefix="ocr-ensemble")
+
+    def recognize(self, image: np.ndarray, language_short: str, timeout: float = None) -> tuple[ocrresult.OcrResult, str]:
+        secondary = self._executor.submit(self.secondary.recognize, image, language_short, timeout)
+        primary_result, primary_error = self.primary.recognize(image, language_short, timeout)
+        secondary_result, secondary_error = secondary.result()
+        # one failing engine does not fail the ensemble
+        if primary_error and secondary_error:
+            return (None, primary_error)
+        if primary_error:
+            return (secondary_result, None)
+        if secondary_error:
+            return (primary_result, None)
+        return (vote(primary_result, secondary_result, policy=self.name), None)
+
+
+class FastPathEngine(Engine):
+    """Tesseract first, accepted as is if its mean confidence is at least threshold.
+    Otherwise only the lines below the threshold are read again by the easyocr recognizer
+    (without its detector) and the better reading is kept per line.
+    """
+
+    name = "fast_path"
+
+    def __init__(self, primary: TesseractEngine = None, fallback: EasyOcrEngine = None, threshold: float = None, padding: int = 4):
+        self.primary = primary or TesseractEngine()
+        self.fallback = fallback
+        self.threshold = fast_path_confidence if threshold is None else threshold
+        self.padding = padding
+
+    def recognize(self, image: np.ndarray, language_short: str, timeout: float = None) -> tuple[ocrresult.OcrResult, str]:
+        result, error = self.primary.recognize(image, language_short, timeout)
+        if error:
+            return (None, error)
+        if not len(result) or result.mean_confidence() >= self.threshold:
+            ensemble_choices.inc(policy=self.name, engine=result.engine or self.primary.name)
+            return (result, None)
+        height, width = image.shape[:2]
+        boxes = []
+        for line, left, top, right, bottom in result.line_boxes():
+            if result.conf[result.line == line].mean() < self.threshold:
+                pad = self.padding
+                boxes.append((max(0, left - pad), max(0, top - pad), min(width, right + pad), min(height, bottom + pad)))
+        # the easyocr model is loaded only if a page needs it
+        self.fallback = self.fallback or EasyOcrEngine()
+        second, error = self.fallback.recognize_boxes(image, boxes, language_short)
+        if error:
+            # the tesseract result is still usable
+            return (result, None)
+        return (vote(result, second, policy=self.name), None)
+
+
+engine_names = ["easyocr", "tesseract", "ensemble", "fast_path"]
+
+
+def get_engine(name: str, config: str = "--oem 3 --psm 3", timeout: int = 20, regions: bool = False) -> Engine:
+    """Engine by name, see engine_names.
+    param regions: OCR only the detected text regions instead of the whole image
+    """
+    if name == "tesseract":
+        return TesseractEngine(config=config, timeout=timeout, regions=regions)
+    if name == "easyocr":
+        return EasyOcrEngine(regions=regions)
+    if name == "ensemble":
+        return EnsembleEngine(TesseractEngine(config=config, timeout=timeout, regions=regions), EasyOcrEngine(regions=regions))
+    if name == "fast_path":
+        return FastPathEngine(TesseractEngine(config=config, timeout=timeout, regions=regions))
+    raise ValueError(f"Unknown OCR engine {name}, use one of {engine_names}.")
@@ -0,0 +1,214 @@
+'''
+Incremental re-OCR after crop and 90 degree rotation edits.
+The OcrResult of the last full pass is kept in the coordinates of its base image,
+the preprocessed image without the view steps (crop, autocrop, rotate90). A new
+view of the same base image is answered from it instead of another full OCR:
+- words of the lines inside the new crop are kept, lines outside are dropped
+- only the lines cut by the crop border are read again, one tesseract line read each
+- the boxes are rotated and moved into the coordinates of the new view
+Views which reach beyond the area of the last full pass need a full OCR again.
+'''
+import re
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+import cv2
+import numpy as np
+
+import helpers.metrics as metrics
+import helpers.ocrresult as ocrresult
+import helpers.opencv as opencv
+import helpers.tesseract as tesseract
+import helpers.tiling as tiling
+
+
+view_steps = ("crop", "autocrop", "rotate90")
+# pixels around a cut line which are read with it, clipped to the crop
+line_padding = 4
+
+
+@dataclass
+class View:
+    """Geometry of a view of the base image: rotated clockwise by angle, then cropped to box.
+    The box (left, top, right, bottom) is in the coordinates of the rotated base image.
+    """
+
+    angle: int
+    box: tuple[int, int, int, int]
+
+
+@dataclass
+class Snapshot:
+    """Result of a full OCR pass in base image coordinates and the base image area it covers."""
+
+    result: ocrresult.OcrResult
+    covered: tuple[int, int, int, int]
+
+
+def split_steps(steps: list[tuple[str, dict]]) -> tuple[list[tuple[str, dict]], list[tuple[str, dict]]]:
+    """Split pipeline steps into (base steps, view steps). Returns None if a free rotation follows
+    a view step, then the view is no crop or 90 degree rotation of a base image.
+    """
+    base, view = [], []
+    for name, params in steps:
+        if name in view_steps:
+            view.append((name, params))
+        elif view and name in opencv.free_rotation_steps:
+            return None
+        else:
+            base.append((name, params))
+    return (base, view)
+
+
+def rotate_box(box: tuple[int, int, int, int], angle: int, width: int, height: int) -> tuple[int, int, int, int]:
+    """Box of an image of width x height after rotating the image clockwise by angle (0, 90, 180 or 270)."""
+    left, top, right, bottom = box
+    angle %= 360
+    if angle == 90:
+        return (height - bottom, left, height - top, right)
+    if angle == 180:
+        return (width - right, height - bottom, width - left, height - top)
+    if angle == 270:
+        return (top, width - right, bottom, width - left)
+    return box
+
+
+def rotate_result(result: ocrresult.OcrResult, angle: int) -> ocrresult.OcrResult:
+    """Word boxes after rotating the image clockwise by angle, the reading order is kept."""
+    angle %= 360
+    if angle == 0:
+        return result
+    width, height = result.image_width, result.image_height
+    left, top, word_width, word_height = result.left, result.top, result.width, result.height
+    rotated = result.select(slice(None))
+    if angle == 90:
+        rotated.left, rotated.top = height - top - word_height, left
+    elif angle == 180:
+        rotated.left, rotated.top = width - left - word_width, height - top - word_height
+    else:
+        rotated.left, rotated.top = top, width - left - word_width
+    if angle != 180:
+        rotated.width, rotated.height = word_height, word_width
+        rotated.image_width, rotated.image_height = height, width
+    return rotated
+
+
+def locate(base: np.ndarray, steps: list[tuple[str, dict]]) -> View:
+    """View of the base image produced by the view steps, like opencv.Pipeline runs them."""
+    height, width = base.shape[:2]
+    angle, box = 0, (0, 0, width, height)
+    for name, params in steps:
+        if name == "rotate90":
+            step_angle = params.get("angle", 0) % 360
+            box = rotate_box(box, step_angle, width, height)
+            angle = (angle + step_angle) % 360
+            if step_angle % 180:
+                width, height = height, width
+        elif name == "crop":
+            box_width, box_height = box[2] - box[0], box[3] - box[1]
+            box = (
+                box[0] + int(box_width * params.get("left", 0) / 100),
+                box[1] + int(box_height * params.get("top", 0) / 100),
+                box[2] - int(box_width * params.get("right", 0) / 100),
+                box[3] - int(box_height * params.get("bottom", 0) / 100),
+            )
+        elif name == "autocrop":
+            left, top, right, bottom = opencv.text_bounds(view_image(base, View(angle, box)), **params)
+            box = (box[0] + left, box[1] + top, box[0] + right, box[1] + bottom)
+    return View(angle, box)
+
+
+def view_image(base: np.ndarray, view: View) -> np.ndarray:
+    if view.angle:
+        base = cv2.rotate(base, opencv.angles[view.angle])
+    left, top, right, bottom = view.box
+    return base[top:bottom, left:right]
+
+
+def snapshot(result: ocrresult.OcrResult, view: View, base_shape: tuple) -> Snapshot:
+    """Keep the result of a full OCR pass of a view, in base image coordinates."""
+    height, width = base_shape[:2]
+    rotated_width, rotated_height = (height, width) if view.angle % 180 else (width, height)
+    left, top, _, _ = view.box
+    moved = result.offset(left, top, image_width=rotated_width, image_height=rotated_height)
+    back = (360 - view.angle) % 360
+    return Snapshot(rotate_result(moved, back), rotate_box(view.box, back, rotated_width, rotated_height))
+
+
+def _contains(outer: tuple[int, int, int, int], inner: tuple[int, int, int, int]) -> bool:
+    return outer[0] <= inner[0] and outer[1] <= inner[1] and inner[2] <= outer[2] and inner[3] <= outer[3]
+
+
+def line_config(config: str) -> str:
+    """Tesseract config for reading a single text line (psm 7), the other options are kept."""
+    if re.search(r"--psm\s+\d+", config or ""):
+        return re.sub(r"--psm\s+\d+", "--psm 7", config)
+    return f"{config or ''} --psm 7".strip()
+
+
+def _read_line(base, box, original, language_short, config, timeout):
+    """Read the part box of a cut line, the words get the block, paragraph and line of the original line."""
+    left, top, right, bottom = box
+    result, error = tesseract.extract_result(image=base[top:bottom, left:right], language_short=language_short, config=config, timeout=timeout)
+    if error:
+        return (None, error)
+    result = result.offset(left, top, image_width=original.image_width, image_height=original.image_height)
+    result.block[:] = original.block[0]
+    result.par[:] = original.par[0]
+    result.line[:] = original.line[0]
+    result.word = np.arange(len(result), dtype=np.int32)
+    return (result, None)
+
+
+def _join(parts: list[ocrresult.OcrResult], image_width: int, image_height: int, engine: str) -> ocrresult.OcrResult:
+    """Concatenate results keeping their block, paragraph and line ids (OcrResult.concat keeps them apart)."""
+    parts = [part for part in parts if len(part)]
+    if not parts:
+        return ocrresult.OcrResult(image_width=image_width, image_height=image_height, engine=engine)
+    columns = {name: np.concatenate([getattr(part, name) for part in parts]) for name in ("text", "conf") + ocrresult.int_columns}
+    return ocrresult.OcrResult(**columns, image_width=image_width, image_height=image_height, engine=engine)
+
+
+def derive(
+    previous: Snapshot, base: np.ndarray, view: View, language_short: str, config: str, timeout: int, max_workers: int = None
+) -> tuple[ocrresult.OcrResult, int, str]:
+    """Result of a new view from the snapshot of a full pass over the same base image.
+    Returns (result in view coordinates, number of re-read lines, error). The result is None
+    if the view reaches beyond the area covered by the snapshot, then a full OCR is needed.
+    """
+    height, width = base.shape[:2]
+    rotated_width, rotated_height = (height, width) if view.angle % 180 else (width, height)
+    back = (360 - view.angle) % 360
+    crop = rotate_box(view.box, back, rotated_width, rotated_height)
+    if not _contains(previous.covered, crop):
+        return (None, 0, None)
+    with metrics.timed("incremental.derive", base):
+        words = previous.result
+        pieces, cut = [], []
+        for line, left, top, right, bottom in words.line_boxes():
+            in_line = words.line == line
+            if _contains(crop, (left, top, right, bottom)):
+                pieces.append(words.select(in_line))
+            elif left < crop[2] and crop[0] < right and top < crop[3] and crop[1] < bottom:
+                box = (
+                    max(crop[0], left - line_padding),
+                    max(crop[1], top - line_padding),
+                    min(crop[2], right + line_padding),
+                    min(crop[3], bottom + line_padding),
+                )
+                cut.append((len(pieces), box, words.select(in_line)))
+                pieces.append(None)
+        if cut:
+            read_config = line_config(config)
+            with ThreadPoolExecutor(max_workers=max_workers or tiling.default_workers, thread_name_prefix="ocr-line") as executor:
+                reads = list(executor.map(
+                    lambda item: _read_line(base, item[1], item[2], language_short, read_config, timeout), cut
+                ))
+            for (index, _, _), (result, error) in zip(cut, reads):
+                if error:
+                    return (None, len(cut), error)
+                pieces[index] = result
+        merged = _join(pieces, width, height, words.engine)
+        rotated = rotate_result(merged, view.angle)
+        left, top, right, bottom = view.box
+        return (rotated.offset(-left, -top, image_width=right - left, image_height=bottom - top), len(cut), None)
@@ -0,0 +1,178 @@
+'''
+Background job queue for long running OCR work.
+The streamlit script submits a job and polls its status instead of blocking its
+script thread on the OCR call. A job submitted for a group (e.g. a streamlit
+session) cancels the older jobs of that group, so a rerun supersedes the work
+of the previous run. The queue is bounded, a full queue rejects new jobs.
+'''
+import itertools
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from collections.abc import Callable
+from typing import Any
+
+
+default_workers = int(os.environ.get("OCR_JOB_WORKERS", str(max(1, min(4, os.cpu_count() or 1)))))
+default_max_queued = int(os.environ.get("OCR_JOB_MAX_QUEUED", "32"))
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = "queued", "running", "done", "failed", "cancelled"
+
+
+class JobQueueFull(Exception):
+    """Raised by submit when the queue holds max_queued jobs already."""
+
+
+class Job:
+    """State of one background job. The job function receives it as first argument
+    to report progress and to check for cancellation.
+    """
+
+    def __init__(self, priority: int = 0, group: str = None):
+        self.id = uuid.uuid4().hex
+        self.priority = priority
+        self.group = group
+        self.status = QUEUED
+        self.progress = 0.0
+        self.message = ""
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self._cancel = threading.Event()
+        self._done = threading.Event()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+    @property
+    def finished(self) -> bool:
+        return self._done.is_set()
+
+    def set_progress(self, progress: float, message: str = ""):
+        self.progress = min(max(progress, 0.0), 1.0)
+        self.message = message
+
+    def wait(self, timeout: float = None) -> bool:
+        return self._done.wait(timeout)
+
+    def _finish(self, status: str, result: Any = None, error: str = None):
+        self.status, self.result, self.error = status, result, error
+        if status == DONE:
+            self.progress = 1.0
+        self._done.set()
+
+
+class JobQueue:
+    """Priority job queue on a pool of worker threads, lower priority values run first.
+    Tesseract runs as a subprocess and torch releases the GIL, so threads are enough
+    to keep the streamlit script threads free.
+    """
+
+    def __init__(self, workers: int = default_workers, max_queued: int = default_max_queued, max_finished: int = 256):
+        self.max_queued = max_queued
+        self.max_finished = max_finished
+        self._queue = queue.PriorityQueue()
+        self._jobs: OrderedDict[str, Job] = OrderedDict()
+        self._calls: dict[str, tuple] = {}
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._workers = [
+            threading.Thread(target=self._worker, name=f"ocr-job-{i}", daemon=True) for i in range(max(1, workers))
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, fn: Callable, *args, priority: int = 0, group: str = None, **kwargs) -> str:
+        """Queue fn(job, *args, **kwargs) and return the job id.
+        Older unfinished jobs of the same group are cancelled.
+        """
+        job = Job(priority=priority, group=group)
+        with self._lock:
+            if self._queued >= self.max_queued:
+                raise JobQueueFull(f"OCR job queue is full ({self.max_queued} jobs), please try again later.")
+            if group is not None:
+                for other in self._jobs.values():
+                    if other.group == group and not other.finished:
+                        self._cancel(other)
+            self._jobs[job.id] = job
+            self._calls[job.id] = (fn, args, kwargs)
+            self._queued += 1
+            self._forget_finished()
+        self._queue.put((priority, next(self._counter), job.id))
+        return job.id
+
+    def poll(self, job_id: str) -> Job | None:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> bool:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.finished:
+                return False
+            self._cancel(job)
+            return True
+
+    def result(self, job_id: str, timeout: float = None) -> tuple[Any, str]:
+        """Wait for the job and return (result, error)."""
+        job = self.poll(job_id)
+        if job is None:
+            return (None, "Unknown job.")
+        if not job.wait(timeout):
+            return (None, "Job did not finish in time.")
+        return (job.result, job.error)
+
+    def queued(self) -> int:
+        return self._queued
+
+    def _cancel(self, job: Job):
+        job._cancel.set()
+        if job.status == QUEUED:
+            # frees its place in the queue now, the worker drops it when it comes out of the queue
+            self._queued -= 1
+            self._calls.pop(job.id, None)
+            job._finish(CANCELLED, error="Job was cancelled.")
+
+    def _forget_finished(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished]
+        for job_id in finished[: max(0, len(finished) - self.max_finished)]:
+            del self._jobs[job_id]
+
+    def _worker(self):
+        while True:
+            _, _, job_id = self._queue.get()
+            with self._lock:
+                job = self._jobs.get(job_id)
+                if job is None or job.finished:
+                    # cancelled while queued, _cancel uncounted it already
+                    continue
+                self._queued -= 1
+                fn, args, kwargs = self._calls.pop(job_id)
+                job.status = RUNNING
+            try:
+                result = fn(job, *args, **kwargs)
+            except Exception as e:
+                job._finish(FAILED, error=str(e))
+            else:
+                if job.cancelled:
+                    job._finish(CANCELLED, error="Job was cancelled.")
+                else:
+                    job._finish(DONE, result=result)
+
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+
+
+def get_job_queue() -> JobQueue:
+    """Process wide job queue shared by all streamlit sessions."""
+    global _job_queue
+    with _job_queue_lock:
+        if _job_queue is None:
+            _job_queue = JobQueue()
+        return _job_queue
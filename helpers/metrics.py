@@ -0,0 +1,204 @@
+'''
+Lightweight per-stage instrumentation with a Prometheus style exporter.
+The helpers modules record stage durations, image sizes, cache hits/misses and
+engine errors here. The metrics are exposed in the Prometheus text format on
+http://<host>:$OCR_METRICS_PORT/metrics and every stage can also be written as
+a structured (JSON) log line with OCR_METRICS_LOG=1.
+Recording a stage costs two perf_counter calls and a dictionary update under a lock.
+'''
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+
+logger = logging.getLogger("b_rabbit.metrics")
+log_stages = os.environ.get("OCR_METRICS_LOG", "0") not in ("0", "false", "False", "no", "")
+metrics_port = os.environ.get("OCR_METRICS_PORT")
+if log_stages and not logger.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO)
+
+duration_buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+megapixel_buckets = (0.1, 0.5, 1.0, 2.0, 4.0, 8.0, 16.0, 32.0, 64.0, 128.0)
+
+
+def _labels_text(labelnames: tuple, labelvalues: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{str(value)}"'.replace("\n", " ") for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name, self.documentation, self.labelnames = name, documentation, labelnames
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(tuple(labels.get(name, "") for name in self.labelnames), 0.0)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels_text(self.labelnames, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = duration_buckets):
+        self.name, self.documentation, self.labelnames = name, documentation, labelnames
+        self.buckets = tuple(sorted(buckets))
+        # per label set: bucket counts (last one is +Inf), sum
+        self._values: dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts[0][index] += 1
+            counts[1] += value
+
+    def count(self, **labels) -> int:
+        counts = self._values.get(tuple(labels.get(name, "") for name in self.labelnames))
+        return sum(counts[0]) if counts else 0
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                    lines.append(f"{self.name}_bucket{_labels_text(self.labelnames, key, le)} {cumulative}")
+                lines.append(f"{self.name}_sum{_labels_text(self.labelnames, key)} {total}")
+                lines.append(f"{self.name}_count{_labels_text(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+stage_duration = Histogram("ocr_stage_duration_seconds", "Duration of the OCR pipeline stages.", ("stage",))
+stage_megapixels = Histogram("ocr_stage_image_megapixels", "Image size handed to the OCR pipeline stages.", ("stage",), megapixel_buckets)
+stage_errors = Counter("ocr_stage_errors_total", "Errors of the OCR pipeline stages by error type.", ("stage", "error"))
+cache_requests = Counter("ocr_cache_requests_total", "Cache lookups by cache and result (hit or miss).", ("cache", "result"))
+
+registry = [stage_duration, stage_megapixels, stage_errors, cache_requests]
+
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def error_type(error: str) -> str:
+    """Short error type of an error message like "RuntimeError: Tesseract timed out"."""
+    head = str(error).split(":", 1)[0].strip()
+    return head if head.isidentifier() else "Error"
+
+
+def record_error(stage: str, error: str):
+    stage_errors.inc(stage=stage, error=error_type(error))
+    if log_stages:
+        logger.info(json.dumps({"event": "error", "stage": stage, "error": str(error)}, ensure_ascii=False))
+
+
+def record_cache(cache: str, hit: bool):
+    cache_requests.inc(cache=cache, result="hit" if hit else "miss")
+
+
+@contextmanager
+def timed(stage: str, image=None):
+    """Record the duration of a stage, the size of the image it works on and its exceptions."""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        record_error(stage, f"{type(e).__name__}: {e}")
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        stage_duration.observe(duration, stage=stage)
+        megapixels = None
+        if image is not None and hasattr(image, "shape"):
+            megapixels = image.shape[0] * image.shape[1] / 1e6
+            stage_megapixels.observe(megapixels, stage=stage)
+        if log_stages:
+            logger.info(json.dumps({"event": "stage", "stage": stage, "seconds": round(duration, 6), "megapixels": megapixels}))
+
+
+def instrument(stage: str, image_arg: str = "image"):
+    """Decorator for helper functions: records the duration and image size of every call.
+    For functions returning a (result, error) tuple a returned error is counted as well.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            image = kwargs.get(image_arg, args[0] if args else None)
+            with timed(stage, image):
+                result = fn(*args, **kwargs)
+            if isinstance(result, tuple) and len(result) == 2 and result[1]:
+                record_error(stage, result[1])
+            return result
+        return wrapper
+    return decorator
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # no access log for every scrape
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def start_exporter(port: int = None, host: str = "0.0.0.0") -> ThreadingHTTPServer | None:
+    """Start the /metrics endpoint in a daemon thread, once per process.
+    Without a port the OCR_METRICS_PORT environment variable is used, if it is not set nothing is started.
+    """
+    global _server
+    port = port or (int(metrics_port) if metrics_port else None)
+    if not port:
+        return None
+    with _server_lock:
+        if _server is None:
+            try:
+                _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+            except OSError as e:
+                logger.warning(f"Metrics exporter could not listen on port {port}: {e}")
+                return None
+            threading.Thread(target=_server.serve_forever, name="metrics-exporter", daemon=True).start()
+        return _server
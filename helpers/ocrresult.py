@@ -0,0 +1,308 @@
+'''
+Structured OCR result with word boxes and confidences.
+One engine call per page produces an OcrResult, plain text, hOCR, TSV and JSON
+are derived from it without running OCR again. The words are stored column wise
+in numpy arrays instead of lists of tuples or data frames.
+'''
+import json
+from html import escape
+
+import numpy as np
+
+
+int_columns = ("left", "top", "width", "height", "block", "par", "line", "word")
+
+
+class OcrResult:
+    """Words of one image or page in reading order.
+    Columns: text, left, top, width, height (pixels), conf (0..1, -1 if unknown),
+    block, par, line (line ids are unique within the result) and word (index within the line).
+    """
+
+    def __init__(self, text=(), left=(), top=(), width=(), height=(), conf=(), block=None, par=None, line=None, word=None,
+                 image_width: int = 0, image_height: int = 0, engine: str = ""):
+        self.text = np.asarray(list(text), dtype=object)
+        count = len(self.text)
+        self.left = np.asarray(left, dtype=np.int32).reshape(count)
+        self.top = np.asarray(top, dtype=np.int32).reshape(count)
+        self.width = np.asarray(width, dtype=np.int32).reshape(count)
+        self.height = np.asarray(height, dtype=np.int32).reshape(count)
+        self.conf = np.asarray(conf, dtype=np.float32).reshape(count)
+        self.block = np.zeros(count, np.int32) if block is None else np.asarray(block, dtype=np.int32).reshape(count)
+        self.par = np.zeros(count, np.int32) if par is None else np.asarray(par, dtype=np.int32).reshape(count)
+        self.line = np.zeros(count, np.int32) if line is None else np.asarray(line, dtype=np.int32).reshape(count)
+        self.word = np.zeros(count, np.int32) if word is None else np.asarray(word, dtype=np.int32).reshape(count)
+        self.image_width = int(image_width)
+        self.image_height = int(image_height)
+        self.engine = engine
+
+    def __len__(self) -> int:
+        return len(self.text)
+
+    def __repr__(self) -> str:
+        return f"OcrResult({len(self)} words, {self.image_width}x{self.image_height}, engine={self.engine!r})"
+
+    # ---------- constructors ----------
+
+    @classmethod
+    def from_tesseract(cls, data: dict, image_width: int = 0, image_height: int = 0) -> "OcrResult":
+        """From the pytesseract.image_to_data dict output, only the word level entries are kept."""
+        level = np.asarray(data["level"], dtype=np.int32)
+        text = np.asarray([str(t) for t in data["text"]], dtype=object)
+        keep = (level == 5) & np.array([bool(t.strip()) for t in text], dtype=bool)
+
+        def column(name):
+            return np.asarray(data[name], dtype=np.float64)[keep]
+
+        block, par, line_num = column("block_num"), column("par_num"), column("line_num")
+        # tesseract numbers the lines per paragraph, make them unique within the result
+        line_keys = np.stack([block, par, line_num], axis=1) if len(block) else np.zeros((0, 3))
+        _, line = np.unique(line_keys, axis=0, return_inverse=True)
+        return cls(
+            text=text[keep],
+            left=column("left"),
+            top=column("top"),
+            width=column("width"),
+            height=column("height"),
+            conf=np.where(column("conf") < 0, -1.0, column("conf") / 100.0),
+            block=block,
+            par=par,
+            line=np.asarray(line).reshape(-1),
+            word=column("word_num"),
+            image_width=image_width,
+            image_height=image_height,
+            engine="tesseract",
+        )
+
+    @classmethod
+    def from_easyocr(cls, result: list, image_width: int = 0, image_height: int = 0) -> "OcrResult":
+        """From the easyocr readtext result with detail=1: [(box points, text, confidence), ...]."""
+        left, top, width, height, text, conf = [], [], [], [], [], []
+        for box, box_text, box_conf in result:
+            points = np.asarray(box, dtype=np.float64)
+            x0, y0 = points.min(axis=0)
+            x1, y1 = points.max(axis=0)
+            left.append(x0)
+            top.append(y0)
+            width.append(x1 - x0)
+            height.append(y1 - y0)
+            text.append(box_text)
+            conf.append(box_conf)
+        ocr_result = cls(text, left, top, width, height, conf, image_width=image_width, image_height=image_height, engine="easyocr")
+        return ocr_result.assign_lines()
+
+    @classmethod
+    def concat(cls, results: list["OcrResult"], image_width: int = 0, image_height: int = 0) -> "OcrResult":
+        """Join results, e.g. of tiles or regions, the line ids are kept apart."""
+        results = [result for result in results if len(result)]
+        if not results:
+            return cls(image_width=image_width, image_height=image_height)
+        blocks, lines, block_offset, line_offset = [], [], 0, 0
+        for result in results:
+            blocks.append(result.block + block_offset)
+            lines.append(result.line + line_offset)
+            block_offset += int(result.block.max()) + 1
+            line_offset += int(result.line.max()) + 1
+        return cls(
+            text=np.concatenate([result.text for result in results]),
+            left=np.concatenate([result.left for result in results]),
+            top=np.concatenate([result.top for result in results]),
+            width=np.concatenate([result.width for result in results]),
+            height=np.concatenate([result.height for result in results]),
+            conf=np.concatenate([result.conf for result in results]),
+            block=np.concatenate(blocks),
+            par=np.concatenate([result.par for result in results]),
+            line=np.concatenate(lines),
+            word=np.concatenate([result.word for result in results]),
+            image_width=image_width or max(result.image_width for result in results),
+            image_height=image_height or max(result.image_height for result in results),
+            engine=results[0].engine,
+        )
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "OcrResult":
+        return cls(**{key: data[key] for key in ("text", "conf", "image_width", "image_height", "engine") + int_columns if key in data})
+
+    @classmethod
+    def from_json(cls, text: str) -> "OcrResult":
+        return cls.from_dict(json.loads(text))
+
+    # ---------- transformations ----------
+
+    def select(self, mask) -> "OcrResult":
+        """Subset of the words, mask is a boolean array or an index array."""
+        return OcrResult(
+            self.text[mask], self.left[mask], self.top[mask], self.width[mask], self.height[mask], self.conf[mask],
+            self.block[mask], self.par[mask], self.line[mask], self.word[mask],
+            image_width=self.image_width, image_height=self.image_height, engine=self.engine,
+        )
+
+    def offset(self, dx: int, dy: int, image_width: int = None, image_height: int = None) -> "OcrResult":
+        """Move the boxes, e.g. from tile or region coordinates to page coordinates."""
+        result = self.select(slice(None))
+        result.left = result.left + np.int32(dx)
+        result.top = result.top + np.int32(dy)
+        if image_width is not None:
+            result.image_width = image_width
+        if image_height is not None:
+            result.image_height = image_height
+        return result
+
+    @property
+    def center_x(self) -> np.ndarray:
+        return self.left + self.width / 2
+
+    @property
+    def center_y(self) -> np.ndarray:
+        return self.top + self.height / 2
+
+    def assign_lines(self) -> "OcrResult":
+        """Group the words to lines by their vertical centers and sort them into reading order
+        (lines top down, words left to right). Used for engines and merges without line information.
+        """
+        count = len(self)
+        if not count:
+            return self
+        center = self.center_y
+        height = np.maximum(self.height, 1)
+        order = np.argsort(center, kind="stable")
+        # a word starts a new line if its center is below the center of the current line by more than half a word height
+        line, lines = 0, np.zeros(count, dtype=np.int32)
+        line_center = center[order[0]]
+        for index in order:
+            if center[index] - line_center > height[index] / 2:
+                line += 1
+                line_center = center[index]
+            lines[index] = line
+        order = np.lexsort((self.left, lines))
+        result = self.select(order)
+        result.line = lines[order]
+        result.block = np.zeros(count, np.int32)
+        result.par = np.zeros(count, np.int32)
+        starts = np.r_[True, result.line[1:] != result.line[:-1]]
+        result.word = (np.arange(count) - np.maximum.accumulate(np.where(starts, np.arange(count), 0))).astype(np.int32)
+        return result
+
+    # ---------- derived outputs ----------
+
+    def mean_confidence(self) -> float:
+        known = self.conf[self.conf >= 0]
+        return float(known.mean()) if len(known) else 0.0
+
+    def line_boxes(self) -> list[tuple[int, int, int, int, int]]:
+        """(line id, left, top, right, bottom) of every line in reading order."""
+        boxes = []
+        for line in dict.fromkeys(self.line.tolist()):
+            mask = self.line == line
+            boxes.append((
+                line,
+                int(self.left[mask].min()),
+                int(self.top[mask].min()),
+                int((self.left[mask] + self.width[mask]).max()),
+                int((self.top[mask] + self.height[mask]).max()),
+            ))
+        return boxes
+
+    def to_text(self) -> str:
+        """Plain text: words joined by spaces, lines by newlines, blocks and paragraphs by an empty line."""
+        lines, previous = [], None
+        for i, text in enumerate(self.text):
+            key = (self.block[i], self.par[i], self.line[i])
+            if previous is None or key != previous:
+                if previous is not None and key[:2] != previous[:2]:
+                    lines.append([])
+                lines.append([])
+            lines[-1].append(str(text))
+            previous = key
+        return "\n".join(" ".join(words) for words in lines)
+
+    def to_tsv(self, page_number: int = 1, header: bool = True) -> str:
+        """Tesseract compatible TSV with the word level rows."""
+        rows = ["level\tpage_num\tblock_num\tpar_num\tline_num\tword_num\tleft\ttop\twidth\theight\tconf\ttext"] if header else []
+        for i, text in enumerate(self.text):
+            conf = -1 if self.conf[i] < 0 else round(float(self.conf[i]) * 100, 2)
+            rows.append(
+                f"5\t{page_number}\t{self.block[i]}\t{self.par[i]}\t{self.line[i]}\t{self.word[i]}\t"
+                f"{self.left[i]}\t{self.top[i]}\t{self.width[i]}\t{self.height[i]}\t{conf}\t{text}"
+            )
+        return "\n".join(rows) + "\n"
+
+    def hocr_page(self, page_number: int = 1) -> str:
+        """hOCR page element with line and word boxes and word confidences."""
+        out = [f"<div class=\"ocr_page\" id=\"page_{page_number}\" title=\"bbox 0 0 {self.image_width} {self.image_height}; ppageno {page_number - 1}\">"]
+        for line, x0, y0, x1, y1 in self.line_boxes():
+            out.append(f"<span class=\"ocr_line\" id=\"line_{page_number}_{line}\" title=\"bbox {x0} {y0} {x1} {y1}\">")
+            for i in np.flatnonzero(self.line == line):
+                x, y = self.left[i], self.top[i]
+                conf = max(0, int(round(float(self.conf[i]) * 100)))
+                out.append(
+                    f"<span class=\"ocrx_word\" id=\"word_{page_number}_{i}\" "
+                    f"title=\"bbox {x} {y} {x + self.width[i]} {y + self.height[i]}; x_wconf {conf}\">"
+                    f"{escape(str(self.text[i]))}</span>"
+                )
+            out.append("</span>")
+        out.append("</div>")
+        return "\n".join(out)
+
+    def to_hocr(self, title: str = "OCR result") -> str:
+        return hocr_document([self], title=title)
+
+    def to_dict(self) -> dict:
+        data = {"engine": self.engine, "image_width": self.image_width, "image_height": self.image_height}
+        data["text"] = [str(text) for text in self.text]
+        data["conf"] = [round(float(conf), 4) for conf in self.conf]
+        for key in int_columns:
+            data[key] = getattr(self, key).tolist()
+        return data
+
+    def to_json(self) -> str:
+        """Compact column wise JSON, can be read back with from_json."""
+        return json.dumps(self.to_dict(), ensure_ascii=False, separators=(",", ":"))
+
+
+def hocr_document(pages: list[OcrResult], title: str = "OCR result") -> str:
+    """hOCR document with one ocr_page element per result."""
+    engine = next((page.engine for page in pages if page.engine), "b-rabbit")
+    head = [
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        '<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN" '
+        '"http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">',
+        '<html xmlns="http://www.w3.org/1999/xhtml"><head>',
+        f"<title>{escape(title)}</title>",
+        '<meta http-equiv="Content-Type" content="text/html;charset=utf-8"/>',
+        f'<meta name="ocr-system" content="{escape(engine)}"/>',
+        '<meta name="ocr-capabilities" content="ocr_page ocr_line ocrx_word"/>',
+        "</head><body>",
+    ]
+    body = [page.hocr_page(page_number) for page_number, page in enumerate(pages, start=1)]
+    return "\n".join(head + body + ["</body></html>"]) + "\n"
+
+
+def pages_to_json(pages: list[OcrResult]) -> str:
+    return json.dumps([page.to_dict() for page in pages], ensure_ascii=False, separators=(",", ":"))
+
+
+def pages_from_json(text: str) -> list[OcrResult]:
+    return [OcrResult.from_dict(page) for page in json.loads(text)]
+
+
+def render_pages(pages: list[OcrResult], output_format: str = "txt") -> str:
+    """Text (pages separated by form feeds), TSV, hOCR or JSON of the pages of a document."""
+    if output_format == "txt":
+        return "\f".join(page.to_text() for page in pages)
+    if output_format == "tsv":
+        return "".join(page.to_tsv(page_number, header=page_number == 1) for page_number, page in enumerate(pages, start=1))
+    if output_format == "hocr":
+        return hocr_document(pages)
+    if output_format == "json":
+        return pages_to_json(pages)
+    raise ValueError(f"Unknown output format {output_format}, use one of {formats}.")
+
+
+formats = ("txt", "tsv", "hocr", "json")
+mime_types = {
+    "txt": "text/plain",
+    "tsv": "text/tab-separated-values",
+    "hocr": "text/html",
+    "json": "application/json",
+}
@@ -0,0 +1,179 @@
+'''
+Process pool for the CPU heavy preprocessing steps.
+Denoising and free rotation of large images run for seconds. Under
+streamlit they run on the script thread of the session, so a few heavy uploads
+take all cores from the other sessions. opencv.Pipeline hands these steps to a
+small pool of worker processes instead, which bounds the cores they use to
+workers x threads. The pixels are passed through multiprocessing.shared_memory,
+one copy in and one copy out, instead of pickling the arrays through a pipe.
+Consecutive heavy steps are sent in one round trip. Images below min_pixels and
+the cheap steps (morphology with small kernels, thresholding) are processed inline,
+for them the dispatch costs more than the step: a 5x5 dilate of an A4 page at 300 dpi
+takes 9 ms inline and 32 ms through the pool. The apps call start() when they start,
+so the first upload does not wait for the workers to spawn (about 1.5 s).
+The workers and the opencv threads per worker are configured together, so that
+workers x threads does not exceed the cores, the app process running the cheap
+steps inline gets the threads of one worker:
+    OCR_OFFLOAD_WORKERS=0           run every step inline
+    OCR_OFFLOAD_WORKERS=4 OCR_OFFLOAD_THREADS=2
+'''
+import atexit
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+
+import cv2
+import numpy as np
+
+import helpers.metrics as metrics
+
+
+try:
+    cores = len(os.sched_getaffinity(0))
+except AttributeError:
+    cores = os.cpu_count() or 1
+max_workers = int(os.environ.get("OCR_OFFLOAD_WORKERS", str(max(1, min(4, cores // 2)))))
+# opencv threads per worker process, 0 to share the cores between the workers
+threads = int(os.environ.get("OCR_OFFLOAD_THREADS", "0"))
+# smaller images are processed inline, 2 megapixels is about an A4 page at 150 dpi
+min_pixels = int(os.environ.get("OCR_OFFLOAD_MIN_PIXELS", str(2_000_000)))
+# pipeline steps which are worth a round trip to a worker
+steps = ("denoising", "rotate_scipy")
+
+offloaded = metrics.Counter("ocr_offload_steps_total", "Heavy preprocessing steps by where they ran.", ("step", "where"))
+metrics.registry.append(offloaded)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def threads_per_worker(workers: int = None) -> int:
+    workers = max_workers if workers is None else workers
+    return threads or max(1, cores // max(1, workers))
+
+
+def configure(workers: int = None, threads_per_process: int = None):
+    """Set the number of worker processes and opencv threads per worker, the pool is recreated on next use.
+    workers=0 runs every step inline, e.g. in processes which are pool workers themselves.
+    """
+    global max_workers, threads
+    shutdown()
+    if workers is not None:
+        max_workers = workers
+    if threads_per_process is not None:
+        threads = threads_per_process
+    _set_threads()
+
+
+def _set_threads():
+    # -1 restores the opencv default (all cores) when every step runs inline
+    cv2.setNumThreads(threads_per_worker() if max_workers > 0 else -1)
+
+
+def _init_worker(thread_count: int):
+    cv2.setNumThreads(thread_count)
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn, a forked copy of a streamlit server with its threads is not safe
+            _pool = ProcessPoolExecutor(
+                max_workers=max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(threads_per_worker(),),
+            )
+        return _pool
+
+
+def start():
+    """Spawn the worker processes in the background instead of on the first heavy step, later calls do nothing."""
+    if max_workers <= 0:
+        return
+    with _pool_lock:
+        if _pool is not None:
+            return
+    _set_threads()
+    pool = _get_pool()
+    # every queued call spawns one more worker, up to max_workers
+    for _ in range(max_workers):
+        pool.submit(os.getpid)
+
+
+def shutdown():
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+atexit.register(shutdown)
+
+
+def use_pool(img: np.ndarray) -> bool:
+    return max_workers > 0 and img.shape[0] * img.shape[1] >= min_pixels
+
+
+def apply_steps(img: np.ndarray, step_list: list[tuple[str, dict]]) -> np.ndarray:
+    """Run pipeline steps one after the other, without reordering and without offloading."""
+    # imported here, opencv imports this module
+    import helpers.opencv as opencv
+    buffers = opencv._Buffers()
+    for name, params in step_list:
+        img = opencv.pipeline_steps[name](img, buffers, **params)
+    return img
+
+
+def _run_shared(name: str, shape: tuple, dtype: str, step_list: list[tuple[str, dict]]) -> tuple[str, tuple, str]:
+    """Worker: run the steps on the image in shared memory, returns the shared memory block of the result."""
+    source = shared_memory.SharedMemory(name=name)
+    try:
+        img = apply_steps(np.ndarray(shape, dtype=dtype, buffer=source.buf), step_list)
+        target = shared_memory.SharedMemory(create=True, size=max(1, img.nbytes))
+        np.ndarray(img.shape, dtype=img.dtype, buffer=target.buf)[...] = img
+        result = (target.name, img.shape, img.dtype.str)
+        # the result may be a view of the source, no array may reference the blocks when they are closed
+        del img
+        target.close()
+    finally:
+        source.close()
+    return result
+
+
+def _run_pool(img: np.ndarray, step_list: list[tuple[str, dict]]) -> np.ndarray:
+    source = shared_memory.SharedMemory(create=True, size=max(1, img.nbytes))
+    try:
+        np.ndarray(img.shape, dtype=img.dtype, buffer=source.buf)[...] = img
+        name, shape, dtype = _get_pool().submit(_run_shared, source.name, img.shape, img.dtype.str, step_list).result()
+    finally:
+        source.close()
+        source.unlink()
+    target = shared_memory.SharedMemory(name=name)
+    try:
+        return np.ndarray(shape, dtype=dtype, buffer=target.buf).copy()
+    finally:
+        target.close()
+        target.unlink()
+
+
+def run_steps(img: np.ndarray, step_list: list[tuple[str, dict]]) -> np.ndarray:
+    """Run heavy pipeline steps on a worker process, small images and a broken pool fall back to inline."""
+    where = "pool" if use_pool(img) else "inline"
+    if where == "pool":
+        try:
+            result = _run_pool(img, step_list)
+        except BrokenProcessPool:
+            # a worker died (e.g. out of memory), the next call starts a new pool
+            shutdown()
+            where = "inline"
+    if where == "inline":
+        result = apply_steps(img, step_list)
+    for name, _ in step_list:
+        offloaded.inc(step=name, where=where)
+    return result
@@ -0,0 +1,384 @@
+'''
+ONNX Runtime backend for the easyocr models.
+The CRAFT detector and the CRNN recognizer of easyocr are exported once to ONNX
+and quantized to int8 weights (dynamic quantization). At runtime only
+onnxruntime, numpy and opencv are needed, neither torch nor easyocr is imported,
+so the reader loads in a fraction of the time and memory.
+Export (needs torch and easyocr) and check the accuracy against the torch models:
+
+    python -m helpers.onnx_easyocr export --lang az en --output models/easyocr-onnx
+    python -m helpers.onnx_easyocr check --lang az --model-dir models/easyocr-onnx [images ...]
+
+The reader registry in easy_ocr uses this backend with EASYOCR_BACKEND=onnx,
+the models are loaded from EASYOCR_ONNX_DIR.
+Differences to the torch path: text boxes are axis aligned and the second
+recognition pass with contrast adjustment for low confidence crops is skipped.
+'''
+import argparse
+import json
+import math
+import os
+import sys
+
+import cv2
+import numpy as np
+
+try:
+    import onnxruntime
+except ImportError:  # optional dependency, the torch models are used without it
+    onnxruntime = None
+
+
+available = onnxruntime is not None
+
+model_dir = os.environ.get("EASYOCR_ONNX_DIR", "models/easyocr-onnx")
+# intra-op threads of every onnx session, 0 for the onnxruntime default (all cores)
+session_threads = int(os.environ.get("EASYOCR_ONNX_THREADS", "0"))
+
+# detector settings of easyocr's readtext
+canvas_size = 2560
+text_threshold = 0.7
+low_text = 0.4
+link_threshold = 0.4
+# detected boxes on one line with a gap below this many box heights are merged, like easyocr's width_ths
+width_ths = 0.5
+model_height = 64
+# a recognition batch holds crops of similar width, see easy_ocr.readtext_batch
+batch_size = 32
+
+# text samples for the parity check, one per language of the apps
+sample_texts = {
+    "en": "The quick brown fox jumps over the lazy dog",
+    "az": "Azərbaycan Respublikasının paytaxtı Bakı şəhəridir",
+    "de": "Größere Änderungen müssen übermorgen geprüft werden",
+    "fr": "Le cœur déçu mais l'âme plutôt naïve",
+    "es": "El pingüino Wenceslao hizo kilómetros bajo exhaustiva lluvia",
+    "it": "Quel vituperabile xenofobo zelante assaggia il whisky",
+    "pt": "À noite, vovô Kowalsky vê o ímã cair no pé do pingüim",
+    "cs": "Příliš žluťoučký kůň úpěl ďábelské ódy",
+    "pl": "Zażółć gęślą jaźń pchnąć w tę łódź jeża",
+}
+
+
+def language_key(languages: list[str] | tuple[str, ...] | str) -> tuple[str, ...]:
+    if isinstance(languages, str):
+        languages = [languages]
+    return tuple(sorted(set(languages)))
+
+
+def model_path(languages, directory: str = None) -> str:
+    """Directory of the exported models of a language set, e.g. models/easyocr-onnx/az-en."""
+    return os.path.join(directory or model_dir, "-".join(language_key(languages)))
+
+
+def export(languages: list[str], output_dir: str = None, quantize: bool = True) -> tuple[str, str]:
+    """Export the easyocr detector and recognizer of a language set to ONNX, returns (directory, error).
+    Needs torch and easyocr, the quantization needs onnxruntime.
+    """
+    try:
+        import easyocr
+        import torch
+    except ImportError as e:
+        return (None, f"ImportError: {e}")
+    path = model_path(languages, output_dir)
+    os.makedirs(path, exist_ok=True)
+    try:
+        # the torch reader must not be quantized, dynamically quantized torch models can not be exported
+        reader = easyocr.Reader(list(language_key(languages)), gpu=False, quantize=False, verbose=False)
+        detector = getattr(reader.detector, "module", reader.detector).eval()
+        recognizer = getattr(reader.recognizer, "module", reader.recognizer).eval()
+
+        class Recognizer(torch.nn.Module):
+            # the CTC recognizer ignores its text argument
+            def __init__(self, model):
+                super().__init__()
+                self.model = model
+
+            def forward(self, image):
+                return self.model(image, None)
+
+        with torch.no_grad():
+            torch.onnx.export(
+                detector, torch.zeros(1, 3, 640, 640), os.path.join(path, "detector.onnx"),
+                input_names=["image"], output_names=["score", "feature"], opset_version=17,
+                dynamic_axes={"image": {0: "batch", 2: "height", 3: "width"}, "score": {0: "batch", 1: "rows", 2: "cols"}},
+            )
+            torch.onnx.export(
+                Recognizer(recognizer), torch.zeros(1, 1, model_height, 256), os.path.join(path, "recognizer.onnx"),
+                input_names=["image"], output_names=["logits"], opset_version=17,
+                dynamic_axes={"image": {0: "batch", 3: "width"}, "logits": {0: "batch", 1: "steps"}},
+            )
+        models = {"detector": "detector.onnx", "recognizer": "recognizer.onnx"}
+        if quantize:
+            from onnxruntime.quantization import QuantType
+            from onnxruntime.quantization import quantize_dynamic
+
+            for name, file_name in list(models.items()):
+                quantized = file_name.replace(".onnx", ".int8.onnx")
+                quantize_dynamic(os.path.join(path, file_name), os.path.join(path, quantized), weight_type=QuantType.QInt8)
+                models[name] = quantized
+        meta = {
+            "languages": list(language_key(languages)),
+            "character": reader.character,
+            "lang_char": "".join(reader.lang_char),
+            "model_height": model_height,
+            "quantized": quantize,
+            "models": models,
+        }
+        with open(os.path.join(path, "meta.json"), "w", encoding="utf-8") as file:
+            json.dump(meta, file, ensure_ascii=False, indent=2)
+    except Exception as e:
+        return (None, str(e))
+    return (path, None)
+
+
+def _session(path: str, threads: int = None):
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    threads = session_threads if threads is None else threads
+    if threads:
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+    return onnxruntime.InferenceSession(path, sess_options=options, providers=["CPUExecutionProvider"])
+
+
+def ctc_greedy_decode(probs: np.ndarray, character: list[str]) -> tuple[str, float]:
+    """Greedy CTC decoding of the softmax output (steps, classes) of one crop, class 0 is the blank.
+    The confidence is computed like easyocr's custom_mean of the chosen characters' probabilities.
+    """
+    indices = probs.argmax(axis=1)
+    values = probs.max(axis=1)
+    keep = indices != 0
+    keep[1:] &= indices[1:] != indices[:-1]
+    text = "".join(character[i - 1] for i in indices[keep])
+    chosen = values[indices != 0]
+    confidence = float(np.prod(chosen) ** (2.0 / math.sqrt(len(chosen)))) if len(chosen) else 0.0
+    return (text, confidence)
+
+
+def group_lines(boxes: list[tuple[int, int, int, int]]) -> list[tuple[int, int, int, int]]:
+    """Merge word boxes (left, top, right, bottom) of the same text line with small gaps to line boxes."""
+    lines = []
+    # left to right, so every box can only extend a line to the right
+    for box in sorted(boxes, key=lambda box: box[0]):
+        for i, (left, top, right, bottom) in enumerate(lines):
+            height = min(bottom - top, box[3] - box[1])
+            overlap = min(bottom, box[3]) - max(top, box[1])
+            gap = box[0] - right
+            if overlap > 0.5 * height and gap < width_ths * height:
+                lines[i] = (min(left, box[0]), min(top, box[1]), max(right, box[2]), max(bottom, box[3]))
+                break
+        else:
+            lines.append(tuple(box))
+    return sorted(lines, key=lambda box: (box[1], box[0]))
+
+
+class OnnxReader:
+    """Drop in for the easyocr Reader in the registry, with readtext and readtext_batch."""
+
+    def __init__(self, languages: list[str] | tuple[str, ...] | str, directory: str = None, threads: int = None):
+        if not available:
+            raise ImportError("onnxruntime is not installed.")
+        path = model_path(languages, directory)
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as file:
+            meta = json.load(file)
+        self.languages = meta["languages"]
+        self.character = meta["character"]
+        self.lang_char = meta["lang_char"]
+        self.model_height = meta.get("model_height", model_height)
+        self.detector = _session(os.path.join(path, meta["models"]["detector"]), threads)
+        self.recognizer = _session(os.path.join(path, meta["models"]["recognizer"]), threads)
+        # characters of the recognition model outside the reader languages, like easyocr's ignore_char
+        ignore = set(self.character) - set(self.lang_char)
+        self.ignore_index = np.asarray([i + 1 for i, char in enumerate(self.character) if char in ignore], dtype=np.int64)
+
+    def __repr__(self) -> str:
+        return f"OnnxReader({self.languages!r})"
+
+    def detect_boxes(self, image: np.ndarray, padding: int = 2) -> list[tuple[int, int, int, int]]:
+        """Text line boxes (left, top, right, bottom) of an RGB or gray image with the CRAFT detector."""
+        if image.ndim == 2:
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
+        height, width = image.shape[:2]
+        ratio = min(canvas_size, max(height, width)) / max(height, width)
+        resized = cv2.resize(image, (max(1, int(width * ratio)), max(1, int(height * ratio))), interpolation=cv2.INTER_LINEAR)
+        # the network needs sides divisible by 32
+        canvas = np.zeros((math.ceil(resized.shape[0] / 32) * 32, math.ceil(resized.shape[1] / 32) * 32, 3), dtype=np.float32)
+        canvas[: resized.shape[0], : resized.shape[1]] = resized
+        canvas -= np.array([0.485, 0.456, 0.406], dtype=np.float32) * 255.0
+        canvas /= np.array([0.229, 0.224, 0.225], dtype=np.float32) * 255.0
+        score = self.detector.run(["score"], {"image": canvas.transpose(2, 0, 1)[None]})[0][0]
+        text_map, link_map = score[:, :, 0], score[:, :, 1]
+        text_score, link_score = text_map > low_text, link_map > link_threshold
+        count, labels, stats, _ = cv2.connectedComponentsWithStats(
+            (text_score | link_score).astype(np.uint8), connectivity=4
+        )
+        # the score map has half the resolution of the network input
+        scale = 2.0 / ratio
+        boxes = []
+        for k in range(1, count):
+            x, y, w, h, size = stats[k]
+            if size < 10 or text_map[labels == k].max() < text_threshold:
+                continue
+            # grow the character regions by about the stroke width, like easyocr's dilation
+            grow = int(math.sqrt(size * min(w, h) / (w * h)) * 2)
+            boxes.append((
+                max(0, int((x - grow) * scale) - padding),
+                max(0, int((y - grow) * scale) - padding),
+                min(width, int((x + w + grow) * scale) + padding),
+                min(height, int((y + h + grow) * scale) + padding),
+            ))
+        return group_lines(boxes)
+
+    def _crop(self, gray: np.ndarray, box: tuple[int, int, int, int]) -> np.ndarray:
+        left, top, right, bottom = box
+        crop = gray[top:bottom, left:right]
+        height, width = crop.shape[:2]
+        new_width = max(1, math.ceil(self.model_height * width / max(1, height)))
+        return cv2.resize(crop, (new_width, self.model_height), interpolation=cv2.INTER_LANCZOS4)
+
+    def recognize_boxes(self, gray: np.ndarray, boxes: list[tuple[int, int, int, int]], batch_size: int = batch_size) -> list:
+        """Read the text of the boxes on a gray image, returns [(box points, text, confidence), ...]."""
+        crops = [(box, self._crop(gray, box)) for box in boxes if box[2] > box[0] and box[3] > box[1]]
+        return [reading for _, reading in self._recognize(list(enumerate(crops)), batch_size)]
+
+    def _recognize(self, crops: list, batch_size: int) -> list:
+        """crops: [(tag, (box, crop)), ...], returns [(tag, (points, text, confidence)), ...] in the same order."""
+        order = sorted(range(len(crops)), key=lambda i: crops[i][1][1].shape[1])
+        readings = [None] * len(crops)
+        for start in range(0, len(order), max(1, batch_size)):
+            batch = order[start : start + batch_size]
+            max_width = max(self.model_height, math.ceil(max(crops[i][1][1].shape[1] for i in batch) / self.model_height) * self.model_height)
+            tensor = np.empty((len(batch), 1, self.model_height, max_width), dtype=np.float32)
+            for row, i in enumerate(batch):
+                crop = crops[i][1][1].astype(np.float32) / 127.5 - 1.0
+                tensor[row, 0, :, : crop.shape[1]] = crop
+                # pad with the last column, like easyocr's NormalizePAD
+                tensor[row, 0, :, crop.shape[1] :] = crop[:, -1:]
+            logits = self.recognizer.run(["logits"], {"image": tensor})[0]
+            probs = np.exp(logits - logits.max(axis=2, keepdims=True))
+            probs[:, :, self.ignore_index] = 0.0
+            probs /= probs.sum(axis=2, keepdims=True)
+            for row, i in enumerate(batch):
+                tag, (box, _) = crops[i]
+                left, top, right, bottom = box
+                text, confidence = ctc_greedy_decode(probs[row], self.character)
+                readings[i] = (tag, ([[left, top], [right, top], [right, bottom], [left, bottom]], text, confidence))
+        return readings
+
+    def readtext_batch(
+        self, images: list[np.ndarray], boxes: list[list[tuple[int, int, int, int]] | None] = None, batch_size: int = batch_size
+    ) -> list[list]:
+        """Read many images, the crops of all images share the recognizer batches.
+        Returns per image the readings [(box points, text, confidence), ...] like easyocr's readtext with detail=1.
+        """
+        crops = []
+        for index, image in enumerate(images):
+            gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY) if image.ndim == 3 else image
+            image_boxes = boxes[index] if boxes is not None and boxes[index] is not None else self.detect_boxes(image)
+            crops.extend((index, (box, self._crop(gray, box))) for box in image_boxes if box[2] > box[0] and box[3] > box[1])
+        readings = [[] for _ in images]
+        for index, reading in self._recognize(crops, batch_size):
+            readings[index].append(reading)
+        return readings
+
+    def readtext(self, image: np.ndarray, detail: int = 1, **kwargs) -> list:
+        readings = self.readtext_batch([image])[0]
+        return readings if detail else [text for _, text, _ in readings]
+
+
+def edit_distance(a: str, b: str) -> int:
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, start=1):
+        current = [i]
+        for j, char_b in enumerate(b, start=1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        previous = current
+    return previous[-1]
+
+
+def character_error_rate(reference: str, hypothesis: str) -> float:
+    return edit_distance(reference, hypothesis) / max(1, len(reference))
+
+
+def render_sample(text: str, font_size: int = 36) -> np.ndarray:
+    """RGB image of a text line, rendered with PyMuPDF for the non-ASCII letters (ə, ş, ğ, ...).
+    The font is the one of the searchable PDF text layer, see searchablepdf.text_font.
+    """
+    import pymupdf
+
+    import helpers.searchablepdf as searchablepdf
+
+    font = pymupdf.Font(searchablepdf.text_font)
+    missing = sorted({char for char in text if not char.isspace() and not font.has_glyph(ord(char))})
+    if missing:
+        raise ValueError(f"The font {font.name} has no glyphs for {''.join(missing)}, please install pymupdf-fonts.")
+    width = font.text_length(text, fontsize=font_size) + 2 * font_size
+    with pymupdf.open() as doc:
+        page = doc.new_page(width=width, height=font_size * 3)
+        writer = pymupdf.TextWriter(page.rect)
+        writer.append((font_size, font_size * 2), text, font=font, fontsize=font_size)
+        writer.write_text(page)
+        pixmap = page.get_pixmap(colorspace=pymupdf.csRGB, alpha=False)
+        return np.frombuffer(pixmap.samples, dtype=np.uint8).reshape(pixmap.height, pixmap.width, 3).copy()
+
+
+def check_parity(languages: list[str], images: list[tuple[str, np.ndarray]] = None, directory: str = None) -> list[dict]:
+    """Read the same (name, RGB image) pairs with the torch and the onnx reader and compare the text.
+    Without images the sample texts of the languages are rendered and used as reference too.
+    Returns per image {"image", "cer_torch", "cer_onnx", "cer_between"}, cer_torch/cer_onnx only with a reference.
+    """
+    import easyocr
+
+    torch_reader = easyocr.Reader(list(language_key(languages)), gpu=False, verbose=False)
+    onnx_reader = OnnxReader(languages, directory)
+    samples = [(name, image, None) for name, image in images or []]
+    if not samples:
+        samples = [(lang, render_sample(sample_texts[lang]), sample_texts[lang]) for lang in language_key(languages) if lang in sample_texts]
+    report = []
+    for name, image, reference in samples:
+        torch_text = " ".join(text for _, text, _ in torch_reader.readtext(image))
+        onnx_text = " ".join(text for _, text, _ in onnx_reader.readtext(image))
+        row = {"image": name, "torch": torch_text, "onnx": onnx_text, "cer_between": character_error_rate(torch_text, onnx_text)}
+        if reference is not None:
+            row["cer_torch"] = character_error_rate(reference, torch_text)
+            row["cer_onnx"] = character_error_rate(reference, onnx_text)
+        report.append(row)
+    return report
+
+
+def main(argv: list[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Export the easyocr models to ONNX and check their accuracy.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export_parser = commands.add_parser("export", help="export and quantize the models of a language set")
+    export_parser.add_argument("--lang", nargs="+", default=["az", "en"], help="easyocr languages (default: %(default)s)")
+    export_parser.add_argument("--output", default=model_dir, help="model directory (default: %(default)s)")
+    export_parser.add_argument("--no-quantize", action="store_true", help="keep the float32 models")
+    check_parser = commands.add_parser("check", help="compare the onnx models with the torch models")
+    check_parser.add_argument("images", nargs="*", help="images to read, the language samples are rendered without")
+    check_parser.add_argument("--lang", nargs="+", default=["az", "en"], help="easyocr languages (default: %(default)s)")
+    check_parser.add_argument("--model-dir", default=model_dir, help="model directory (default: %(default)s)")
+    check_parser.add_argument("--max-cer", type=float, default=0.02, help="allowed error rate increase vs torch (default: %(default)s)")
+    options = parser.parse_args(argv)
+
+    if options.command == "export":
+        path, error = export(options.lang, options.output, quantize=not options.no_quantize)
+        if error:
+            print(error, file=sys.stderr)
+            return 1
+        print(f"exported to {path}")
+        return 0
+    images = [(path, cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2RGB)) for path in options.images]
+    report = check_parity(options.lang, images, options.model_dir)
+    failed = False
+    for row in report:
+        # with a reference the onnx error rate is compared, else the difference to the torch text
+        increase = row["cer_onnx"] - row["cer_torch"] if "cer_onnx" in row else row["cer_between"]
+        failed |= increase > options.max_cer
+        print(f"{row['image']}: cer torch {row.get('cer_torch', float('nan')):.3f} onnx {row.get('cer_onnx', float('nan')):.3f} "
+              f"between {row['cer_between']:.3f}{'  FAILED' if increase > options.max_cer else ''}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,3 +1,6 @@
+import hashlib
+import threading
+from collections.abc import Callable
 from io import BytesIO
 
 import cv2
@@ -5,6 +8,10 @@ import numpy as np
 import streamlit as st
 from scipy.ndimage import rotate as rotate_image
 
+import helpers.metrics as metrics
+import helpers.offload as offload
+import helpers.tesseract as tesseract
+
 
 angles = {
     0: None,
@@ -14,11 +21,33 @@ angles = {
 }
 
 
-# make numpy array from image
-@st.cache_data(show_spinner=False)
+# decode encoded image bytes (png, jpg, ...) in memory to a numpy array
+def decode_image(buffer: bytes | bytearray | memoryview, flags: int = cv2.IMREAD_COLOR) -> np.ndarray:
+    """Decode an encoded image from a memory buffer without any file I/O.
+    The buffer is wrapped by numpy without copying it.
+    param flags: cv2.IMREAD_* flags, default is a 3 channel BGR image
+    """
+    file_bytes = np.frombuffer(buffer, dtype=np.uint8)
+    img = cv2.imdecode(file_bytes, flags)
+    if img is None:
+        raise ValueError("Image could not be decoded, unsupported or damaged image file.")
+    return img
+
+
+def freeze(img: np.ndarray) -> np.ndarray:
+    """Mark an image read-only and return it.
+    Images in st.cache_resource are shared by all reruns and sessions instead of being unpickled
+    as a copy on every hit, so nobody may modify them in place.
+    """
+    img.setflags(write=False)
+    return img
+
+
+# make numpy array from image, the upload buffer is decoded without copying the encoded bytes
+@st.cache_resource(show_spinner=False, max_entries=8)
 def load_image(image_file: BytesIO) -> np.ndarray:
-    file_bytes = np.asarray(bytearray(image_file.read()), dtype=np.uint8)
-    return cv2.imdecode(file_bytes, 1)
+    with image_file.getbuffer() as buffer:
+        return freeze(decode_image(buffer))
 
 
 # opencv preprocessing grayscale
@@ -159,3 +188,362 @@ def crop(img: np.ndarray, left: int = 0, right: int = 0, top: int = 0, bottom: i
     top = int(height * top / 100)
     bottom = int(height * bottom / 100)
     return img[top : height - bottom, left : width - right]
+
+
+def _downscale_gray(img: np.ndarray, max_size: int) -> np.ndarray:
+    if len(img.shape) == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    height, width = img.shape[:2]
+    scale = max_size / max(height, width)
+    if scale < 1:
+        img = cv2.resize(img, (max(1, int(width * scale)), max(1, int(height * scale))), interpolation=cv2.INTER_AREA)
+    return img
+
+
+def estimate_skew(img: np.ndarray, max_angle: float = 15.0, max_size: int = 800) -> float:
+    """Estimate the skew angle of a text image in degrees with projection profiles.
+    Works on a downscaled binary copy: the text lines are horizontal when the row profile
+    of the rotated copy has the sharpest peaks. The result can be passed to rotate().
+    param max_angle: largest skew in degrees which is searched for in both directions
+    """
+    small = _downscale_gray(img, max_size)
+    _, binary = cv2.threshold(small, 0, 1, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    height, width = binary.shape[:2]
+    center = (width / 2, height / 2)
+
+    def score(angle: float) -> float:
+        rotate_matrix = cv2.getRotationMatrix2D(center=center, angle=angle, scale=1)
+        rotated = cv2.warpAffine(binary, rotate_matrix, (width, height), flags=cv2.INTER_NEAREST, borderValue=0)
+        profile = rotated.sum(axis=1, dtype=np.float64)
+        return float(np.sum(np.diff(profile) ** 2))
+
+    # coarse search in 1 degree steps, then refine around the best angle in 0.1 degree steps
+    best = max(np.arange(-max_angle, max_angle + 0.5, 1.0), key=score)
+    best = max(np.arange(best - 1.0, best + 1.05, 0.1), key=score)
+    return round(float(best), 1) + 0.0  # no negative zero
+
+
+@st.cache_data(show_spinner=False)
+def deskew(img: np.ndarray, max_angle: float = 15.0) -> np.ndarray:
+    """Rotate the image by the estimated skew angle, one affine warp at full resolution."""
+    return rotate(img, angle=estimate_skew(img, max_angle=max_angle))
+
+
+def detect_text_regions(
+    img: np.ndarray, level: str = "block", padding: int = 8, max_size: int = 1600
+) -> list[tuple[int, int, int, int]]:
+    """Find text on the image with morphological gradients, returns boxes as (left, top, right, bottom).
+    Works on a downscaled gray copy: the gradient marks the character edges, a horizontal closing joins
+    the characters of a line. Components too tall for a text line (photos, drawings) or too small (specks)
+    are dropped. With level "block" neighbouring lines are grouped to text blocks, with "line" the
+    line boxes are returned, in reading order and padded by padding pixels of the full image.
+    """
+    small = _downscale_gray(img, max_size)
+    height, width = img.shape[:2]
+    small_height, small_width = small.shape[:2]
+    scale_x, scale_y = width / small_width, height / small_height
+    gradient = cv2.morphologyEx(small, cv2.MORPH_GRADIENT, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3)))
+    _, binary = cv2.threshold(gradient, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    # join the characters and words of a line, but not the lines above and below
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (max(9, small_width // 60), 1))
+    closed = cv2.morphologyEx(binary, cv2.MORPH_CLOSE, kernel)
+    _, _, stats, _ = cv2.connectedComponentsWithStats(closed, connectivity=8)
+    lines = []
+    for left, top, w, h, area in stats[1:]:
+        if h < 4 or w < 8 or h > max(12, small_height // 12):
+            continue
+        # text lines are filled densely after the closing, noise and thin rules are not
+        if area < 0.3 * w * h or w < h:
+            continue
+        lines.append((left, top, left + w, top + h))
+    if not lines:
+        return []
+    if level == "block":
+        line_height = int(np.median([bottom - top for _, top, _, bottom in lines]))
+        mask = np.zeros_like(small)
+        for left, top, right, bottom in lines:
+            mask[top:bottom, left:right] = 255
+        # lines closer than about one line height belong to the same block
+        kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (2 * line_height + 1, line_height + 1))
+        mask = cv2.dilate(mask, kernel)
+        contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        blocks = []
+        for contour in contours:
+            x, y, w, h = cv2.boundingRect(contour)
+            inside = [line for line in lines if x <= line[0] and line[2] <= x + w and y <= line[1] and line[3] <= y + h]
+            if inside:
+                blocks.append((min(b[0] for b in inside), min(b[1] for b in inside), max(b[2] for b in inside), max(b[3] for b in inside)))
+        lines = blocks
+    boxes = [
+        (
+            max(0, int(left * scale_x) - padding),
+            max(0, int(top * scale_y) - padding),
+            min(width, int(np.ceil(right * scale_x)) + padding),
+            min(height, int(np.ceil(bottom * scale_y)) + padding),
+        )
+        for left, top, right, bottom in lines
+    ]
+    return sorted(boxes, key=lambda box: (box[1], box[0]))
+
+
+def text_bounds(img: np.ndarray, padding: int = 16) -> tuple[int, int, int, int]:
+    """Bounding box (left, top, right, bottom) of all detected text, the whole image if no text is found."""
+    boxes = detect_text_regions(img, level="line", padding=padding)
+    if not boxes:
+        return (0, 0, img.shape[1], img.shape[0])
+    boxes = np.asarray(boxes)
+    return (int(boxes[:, 0].min()), int(boxes[:, 1].min()), int(boxes[:, 2].max()), int(boxes[:, 3].max()))
+
+
+@st.cache_data(show_spinner=False)
+def autocrop(img: np.ndarray, padding: int = 16) -> np.ndarray:
+    """Crop the image to the detected text, replaces guessing the crop percentages."""
+    left, top, right, bottom = text_bounds(img, padding=padding)
+    return img[top:bottom, left:right]
+
+
+def detect_orientation(img: np.ndarray, timeout: int = 20, max_size: int = 2000) -> int:
+    """Detect the 90 degree steps needed to turn the image upright with tesseract OSD.
+    Returns 0, 90, 180 or 270 (clockwise), 0 if tesseract can not decide.
+    """
+    angle, error = tesseract.detect_orientation(_downscale_gray(img, max_size), timeout=timeout)
+    if error or angle not in angles:
+        return 0
+    return angle
+
+
+# steps which only move or drop pixels, they are run before the pixel filters
+geometric_steps = ("crop", "autocrop", "rotate90")
+# steps which change the geometry so that a later crop can not be moved in front of them
+free_rotation_steps = ("rotate", "rotate_scipy", "deskew", "orient")
+
+
+class _Buffers:
+    """Output buffers of one pipeline run.
+    A step writes into a buffer which does not overlap its input (ping-pong),
+    so a run allocates at most two buffers per image size and never writes into the input image.
+    """
+
+    def __init__(self):
+        self.buffers = []
+
+    def owns(self, img: np.ndarray) -> bool:
+        return any(np.may_share_memory(img, buf) for buf in self.buffers)
+
+    def get(self, src: np.ndarray, shape: tuple) -> np.ndarray:
+        for buf in self.buffers:
+            if buf.shape == shape and not np.may_share_memory(buf, src):
+                return buf
+        buf = np.empty(shape, dtype=np.uint8)
+        self.buffers.append(buf)
+        return buf
+
+
+def _crop(img: np.ndarray, buffers: _Buffers, left: int = 0, right: int = 0, top: int = 0, bottom: int = 0) -> np.ndarray:
+    height, width = img.shape[:2]
+    left = int(width * left / 100)
+    right = int(width * right / 100)
+    top = int(height * top / 100)
+    bottom = int(height * bottom / 100)
+    return img[top : height - bottom, left : width - right]  # view, no copy
+
+
+def _autocrop(img: np.ndarray, buffers: _Buffers, padding: int = 16) -> np.ndarray:
+    left, top, right, bottom = text_bounds(img, padding=padding)
+    return img[top:bottom, left:right]  # view, no copy
+
+
+def _rotate90(img: np.ndarray, buffers: _Buffers, angle: int = 0) -> np.ndarray:
+    code = angles.get(angle)
+    if code is None:
+        return img
+    height, width = img.shape[:2]
+    shape = (height, width) if code == cv2.ROTATE_180 else (width, height)
+    return cv2.rotate(img, code, dst=buffers.get(img, shape + img.shape[2:]))
+
+
+def _rotate(img: np.ndarray, buffers: _Buffers, angle: int = 0) -> np.ndarray:
+    if not angle:
+        return img
+    height, width = img.shape[:2]
+    rotate_matrix = cv2.getRotationMatrix2D(center=(width / 2, height / 2), angle=angle, scale=1)
+    return cv2.warpAffine(
+        src=img,
+        M=rotate_matrix,
+        dsize=(width, height),
+        dst=buffers.get(img, img.shape),
+        borderMode=cv2.BORDER_CONSTANT,
+        borderValue=(255, 255, 255),
+    )
+
+
+def _deskew(img: np.ndarray, buffers: _Buffers, max_angle: float = 15.0) -> np.ndarray:
+    return _rotate(img, buffers, angle=estimate_skew(img, max_angle=max_angle))
+
+
+def _orient(img: np.ndarray, buffers: _Buffers, timeout: int = 20) -> np.ndarray:
+    return _rotate90(img, buffers, angle=detect_orientation(img, timeout=timeout))
+
+
+def _rotate_scipy(img: np.ndarray, buffers: _Buffers, angle: int = 0, reshape: bool = True) -> np.ndarray:
+    if not angle:
+        return img
+    return rotate_image(input=img, angle=angle, reshape=reshape, mode="constant", cval=255)
+
+
+def _grayscale(img: np.ndarray, buffers: _Buffers) -> np.ndarray:
+    if len(img.shape) != 3:
+        return img
+    return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, dst=buffers.get(img, img.shape[:2]))
+
+
+def _remove_noise(img: np.ndarray, buffers: _Buffers) -> np.ndarray:
+    return cv2.medianBlur(img, 5, dst=buffers.get(img, img.shape))
+
+
+def _denoising(img: np.ndarray, buffers: _Buffers, strength: int = 10) -> np.ndarray:
+    dst = buffers.get(img, img.shape)
+    if len(img.shape) == 3:
+        return cv2.fastNlMeansDenoisingColored(img, dst, strength, strength, 7, 21)
+    return cv2.fastNlMeansDenoising(img, dst, strength, 7, 21)
+
+
+def _thresholding(
+    img: np.ndarray, buffers: _Buffers, threshold: int = 128, method: str = "fixed", block_size: int = 31, c: int = 10
+) -> np.ndarray:
+    """Binarize with a fixed level, the level chosen by Otsu's method or a local (adaptive) mean.
+    param block_size: neighbourhood of the adaptive method in pixels, should be a few glyphs high
+    """
+    if len(img.shape) == 3:
+        img = _grayscale(img, buffers)
+    if method == "adaptive":
+        return cv2.adaptiveThreshold(
+            img, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY, block_size | 1, c, dst=buffers.get(img, img.shape)
+        )
+    # threshold works pixel by pixel, so it can run in place on our own buffers
+    dst = img if buffers.owns(img) else buffers.get(img, img.shape)
+    if method == "otsu":
+        cv2.threshold(img, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU, dst=dst)
+    else:
+        cv2.threshold(img, threshold, 255, cv2.THRESH_BINARY, dst=dst)
+    return dst
+
+
+def _morphology(op: int) -> Callable:
+    def step(img: np.ndarray, buffers: _Buffers) -> np.ndarray:
+        kernel = np.ones((5, 5), np.uint8)
+        return cv2.morphologyEx(img, op, kernel, dst=buffers.get(img, img.shape))
+    return step
+
+
+pipeline_steps = {
+    "crop": _crop,
+    "autocrop": _autocrop,
+    "rotate90": _rotate90,
+    "rotate": _rotate,
+    "rotate_scipy": _rotate_scipy,
+    "deskew": _deskew,
+    "orient": _orient,
+    "grayscale": _grayscale,
+    "remove_noise": _remove_noise,
+    "denoising": _denoising,
+    "thresholding": _thresholding,
+    "dilate": _morphology(cv2.MORPH_DILATE),
+    "erode": _morphology(cv2.MORPH_ERODE),
+    "opening": _morphology(cv2.MORPH_OPEN),
+}
+
+
+class Pipeline:
+    """Declarative preprocessing pipeline, replaces calling the cached single steps one by one.
+    param steps: ordered list of (step name, parameter dict), e.g.
+        [("grayscale", {}), ("denoising", {"strength": 10}), ("crop", {"left": 10})]
+    Cheap geometric steps (crop, rotate90) are moved in front of the pixel filters,
+    so the expensive filters touch fewer pixels. A crop is never moved across a free rotation.
+    Intermediate results are written into preallocated buffers, the input image is never modified.
+    Heavy steps (see offload.steps) on large images run on the offload process pool.
+    """
+
+    def __init__(self, steps: list[tuple[str, dict]] | tuple):
+        steps = [(name, dict(params)) for name, params in steps]
+        for name, _ in steps:
+            if name not in pipeline_steps:
+                raise ValueError(f"Unknown preprocessing step {name}, use one of {list(pipeline_steps)}.")
+        self.steps = self.reorder(steps)
+
+    @staticmethod
+    def reorder(steps: list[tuple[str, dict]]) -> list[tuple[str, dict]]:
+        front, rest = [], []
+        for name, params in steps:
+            if name in geometric_steps and not any(n in free_rotation_steps for n, _ in rest):
+                front.append((name, params))
+            else:
+                rest.append((name, params))
+        return front + rest
+
+    @property
+    def pixelwise(self) -> bool:
+        """True if no step changes the geometry, so the pipeline can run on tiles of an image."""
+        return not any(name in geometric_steps + free_rotation_steps for name, _ in self.steps)
+
+    @property
+    def grayscale(self) -> bool:
+        """True if the pipeline converts to gray anyway, so the input can be rendered gray right away."""
+        return any(name in ("grayscale", "thresholding") for name, _ in self.steps)
+
+    @property
+    def spec(self) -> tuple:
+        """Hashable description of the pipeline, used as cache key."""
+        return tuple((name, tuple(sorted(params.items()))) for name, params in self.steps)
+
+    def __call__(self, img: np.ndarray) -> np.ndarray:
+        return self.run(img)
+
+    def __repr__(self) -> str:
+        return f"Pipeline({self.steps!r})"
+
+    def run(self, img: np.ndarray) -> np.ndarray:
+        buffers = _Buffers()
+        index = 0
+        while index < len(self.steps):
+            name, params = self.steps[index]
+            if name in offload.steps and offload.use_pool(img):
+                # consecutive heavy steps go to the worker in one round trip
+                end = index + 1
+                while end < len(self.steps) and self.steps[end][0] in offload.steps:
+                    end += 1
+                heavy = self.steps[index:end]
+                with metrics.timed("opencv.offload." + "+".join(step for step, _ in heavy), img):
+                    img = offload.run_steps(img, heavy)
+                index = end
+                continue
+            with metrics.timed(f"opencv.{name}", img):
+                img = pipeline_steps[name](img, buffers, **params)
+            index += 1
+        return img
+
+
+def image_digest(img: np.ndarray) -> str:
+    """Fast digest of the image pixels, used as cache key instead of hashing the whole array by streamlit."""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(str((img.shape, img.dtype.str)).encode())
+    digest.update(np.ascontiguousarray(img).data)
+    return digest.hexdigest()
+
+
+# set by the cached function on a cache miss, to count the pipeline cache hits and misses
+_pipeline_cache = threading.local()
+
+
+# only the final result of the pipeline is cached, keyed by the input digest and the pipeline spec
+@st.cache_resource(show_spinner=False, max_entries=16)
+def _apply_pipeline(_img: np.ndarray, digest: str, spec: tuple) -> np.ndarray:
+    _pipeline_cache.miss = True
+    return freeze(Pipeline(spec).run(_img))
+
+
+def apply_pipeline(img: np.ndarray, digest: str, spec: tuple) -> np.ndarray:
+    _pipeline_cache.miss = False
+    result = _apply_pipeline(img, digest, spec)
+    metrics.record_cache("pipeline", hit=not _pipeline_cache.miss)
+    return result
@@ -1,3 +1,7 @@
+import math
+import os
+import re
+from collections.abc import Iterator
 from io import BytesIO
 
 import cv2
@@ -9,44 +13,253 @@ from pdf2image.exceptions import PDFPageCountError
 from pdf2image.exceptions import PDFPopplerTimeoutError
 from pdf2image.exceptions import PDFSyntaxError
 
+import helpers.metrics as metrics
 
-@st.cache_data(show_spinner=False)
-def pdftoimage(pdf_file: BytesIO, page: int = 1) -> tuple[np.ndarray, str]:
+
+# adaptive rasterization: the median glyph height of a page is rendered with about target_text_px pixels
+min_dpi = int(os.environ.get("OCR_PDF_MIN_DPI", "150"))
+max_dpi = int(os.environ.get("OCR_PDF_MAX_DPI", "400"))
+target_text_px = 24
+# upper bound for the pixels of one rendered page, large format pages get a lower dpi
+max_page_pixels = int(os.environ.get("OCR_PDF_MAX_PAGE_PIXELS", str(40_000_000)))
+# resolution of the small grayscale render used to estimate the text height
+preview_dpi = 72
+# pages whose previews are rendered in one poppler call
+preview_batch = 16
+
+
+@st.cache_resource(show_spinner=False, max_entries=8)
+def pdftoimage(pdf_file: BytesIO, page: int = 1, grayscale: bool = False, dpi: int = 300) -> tuple[np.ndarray, str]:
+    """Rasterize one page to a BGR image, or directly to a gray image with grayscale=True.
+    The image is read-only, it is shared by all reruns (see opencv.freeze).
+    param dpi: resolution, None to choose it from the page size and text height (see page_dpi)
+    """
     image, error = None, None
     try:
-        image = convert(pdf_file=pdf_file, page=page)
+        if dpi is None:
+            dpi = page_dpi(pdf_file.getvalue(), page)
+        image = convert(pdf_file=pdf_file, page=page, dpi=dpi, grayscale=grayscale)
         if image is not None:
-            image = np.array(image)  # convert image to numpy array
-            image = img2opencv2(image)
+            # the one copy out of the PIL image, the channels are swapped in place
+            image = np.array(image)
+            if not grayscale:
+                cv2.cvtColor(image, cv2.COLOR_RGB2BGR, dst=image)
+            image.setflags(write=False)
         else:
             error = "Invalid PDF page selected."
-    except PDFInfoNotInstalledError:
-        error = "PDFInfoNotInstalledError: PDFInfo is not installed?"
-    except PDFPageCountError:
-        error = "PDFPageCountError: Could not determine number of pages in PDF."
-    except PDFSyntaxError:
-        error = "PDFSyntaxError: PDF is damaged/corrupted?"
-    except PDFPopplerTimeoutError:
-        error = "PDFPopplerTimeoutError: PDF conversion timed out."
     except Exception as e:
-        error = str(e)
+        error = pdf_error(e)
     return (image, error)
 
 
-@st.cache_data(show_spinner=False)
-def convert(pdf_file: BytesIO, page: int = 1) -> np.ndarray:
-    images = pdf2image.convert_from_bytes(
-        pdf_file=pdf_file.read(),
-        dpi=300,
-        single_file=True,
-        output_file=None,
-        output_folder=None,
-        timeout=20,
-        first_page=page,
-    )
+def pdf_error(e: Exception) -> str:
+    """Map pdf2image exceptions to a user readable error message."""
+    if isinstance(e, PDFInfoNotInstalledError):
+        return "PDFInfoNotInstalledError: PDFInfo is not installed?"
+    if isinstance(e, PDFPageCountError):
+        return "PDFPageCountError: Could not determine number of pages in PDF."
+    if isinstance(e, PDFSyntaxError):
+        return "PDFSyntaxError: PDF is damaged/corrupted?"
+    if isinstance(e, PDFPopplerTimeoutError):
+        return "PDFPopplerTimeoutError: PDF conversion timed out."
+    return str(e)
+
+
+# not cached, pdftoimage caches the numpy image and a second cached (pickled) PIL copy only costs memory
+@metrics.instrument("pdf.rasterize")
+def convert(pdf_file: BytesIO, page: int = 1, dpi: int = 300, grayscale: bool = False) -> np.ndarray:
+    # pdf2image only writes the bytes to a temporary file, so the upload buffer is passed without a copy
+    with pdf_file.getbuffer() as buffer:
+        images = pdf2image.convert_from_bytes(
+            pdf_file=buffer,
+            dpi=dpi,
+            grayscale=grayscale,
+            single_file=True,
+            output_file=None,
+            output_folder=None,
+            timeout=20,
+            first_page=page,
+            last_page=page,
+        )
     return images[0] if images else None
 
 
+@st.cache_data(show_spinner=False)
+def get_page_count(pdf_bytes: bytes) -> tuple[int, str]:
+    page_count, error = None, None
+    try:
+        info = pdf2image.pdfinfo_from_bytes(pdf_bytes, timeout=20)
+        page_count = int(info["Pages"])
+    except Exception as e:
+        error = pdf_error(e)
+    return (page_count, error)
+
+
+@st.cache_data(show_spinner=False)
+def get_page_sizes(pdf_bytes: bytes) -> tuple[list[tuple[float, float]], str]:
+    """Displayed size (width, height) of every page in points, rotated pages are swapped."""
+    page_sizes, error = None, None
+    try:
+        page_count, error = get_page_count(pdf_bytes)
+        if error:
+            return (None, error)
+        info = pdf2image.pdfinfo_from_bytes(pdf_bytes, timeout=20, first_page=1, last_page=page_count)
+        sizes, rotations = {}, {}
+        for key, value in info.items():
+            match = re.match(r"Page\s+(\d+) (size|rot)", key)
+            if match and match.group(2) == "size":
+                width, height = re.findall(r"[\d.]+", value)[:2]
+                sizes[int(match.group(1))] = (float(width), float(height))
+            elif match:
+                rotations[int(match.group(1))] = int(float(value))
+        # single page documents have no per page keys
+        default = sizes.get(1)
+        if default is None and "Page size" in info:
+            width, height = re.findall(r"[\d.]+", info["Page size"])[:2]
+            default = (float(width), float(height))
+        page_sizes = []
+        for page in range(1, page_count + 1):
+            width, height = sizes.get(page, default or (595.0, 842.0))
+            if rotations.get(page, 0) % 180 == 90:
+                width, height = height, width
+            page_sizes.append((width, height))
+    except Exception as e:
+        error = pdf_error(e)
+    return (page_sizes, error)
+
+
+def estimate_text_height(gray: np.ndarray) -> float:
+    """Median height in pixels of the glyph like connected components of a gray image, 0 if there are none."""
+    _, binary = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    _, _, stats, _ = cv2.connectedComponentsWithStats(binary, connectivity=8)
+    widths, heights = stats[1:, cv2.CC_STAT_WIDTH], stats[1:, cv2.CC_STAT_HEIGHT]
+    # drop specks, lines and images
+    glyphs = (heights >= 2) & (heights <= gray.shape[0] / 10) & (widths <= 4 * heights)
+    if glyphs.sum() < 10:
+        return 0.0
+    return float(np.median(heights[glyphs]))
+
+
+def choose_dpi(width_pt: float, height_pt: float, text_height_pt: float = None) -> int:
+    """Rasterization resolution of a page: small print gets more pixels, large print fewer.
+    Without a text height (e.g. an empty page) 300 dpi is used. The pixels of a page are capped
+    by max_page_pixels, so memory per page is bounded also for large format pages.
+    """
+    dpi = 72 * target_text_px / text_height_pt if text_height_pt else 300
+    dpi = min(max(dpi, min_dpi), max_dpi)
+    dpi = min(dpi, 72 * math.sqrt(max_page_pixels / max(width_pt * height_pt, 1.0)))
+    return max(int(dpi), 36)
+
+
+def page_dpi(pdf_bytes: bytes, page: int, page_size: tuple[float, float] = None) -> int:
+    """Choose the resolution of a page from its size and the text height on a small grayscale render."""
+    if page_size is None:
+        page_sizes, error = get_page_sizes(pdf_bytes)
+        if error:
+            raise RuntimeError(error)
+        page_size = page_sizes[page - 1]
+    return page_dpis(pdf_bytes, [page], {page: page_size})[page]
+
+
+def page_dpis(pdf_bytes: bytes, pages: list[int], page_sizes: dict[int, tuple[float, float]]) -> dict[int, int]:
+    """Resolution of several pages like page_dpi, the previews of consecutive pages are rendered in one poppler call.
+    param page_sizes: size of every page in points by page number
+    """
+    dpis = {}
+    runs = []
+    for page in sorted(pages):
+        if runs and page == runs[-1][1] + 1:
+            runs[-1][1] = page
+        else:
+            runs.append([page, page])
+    for first, last in runs:
+        with metrics.timed("pdf.preview"):
+            previews = pdf2image.convert_from_bytes(
+                pdf_file=pdf_bytes,
+                dpi=preview_dpi,
+                grayscale=True,
+                timeout=20,
+                first_page=first,
+                last_page=last,
+            )
+        for page in range(first, last + 1):
+            width_pt, height_pt = page_sizes[page]
+            if page - first >= len(previews):
+                dpis[page] = choose_dpi(width_pt, height_pt)
+                continue
+            text_height = estimate_text_height(np.asarray(previews[page - first]))
+            dpis[page] = choose_dpi(width_pt, height_pt, text_height * 72 / preview_dpi if text_height else None)
+    return dpis
+
+
+def iter_pages(
+    pdf_bytes: bytes,
+    first_page: int = 1,
+    last_page: int = None,
+    batch_size: int = 1,
+    dpi: int = 300,
+    pages: list[int] = None,
+    grayscale: bool = False,
+) -> Iterator[tuple[int, np.ndarray]]:
+    """Rasterize the pages of a PDF lazily, batch_size pages per poppler call.
+    Yields (page number, RGB or gray numpy array) in page order, so only one batch of
+    pages is held in memory at a time.
+    param last_page: last page to rasterize, None for the end of the document
+    param dpi: resolution, None to choose it per page from the page size and text height (see page_dpi)
+    param pages: rasterize only these page numbers instead of first_page to last_page
+    param grayscale: render gray images, saves the RGB buffer and conversion if the OCR runs on gray anyway
+    """
+    if pages is None:
+        if last_page is None:
+            last_page, error = get_page_count(pdf_bytes)
+            if error:
+                raise RuntimeError(error)
+        pages = range(first_page, last_page + 1)
+    batch_size = max(1, batch_size)
+    page_sizes = None
+    if dpi is None:
+        page_sizes, error = get_page_sizes(pdf_bytes)
+        if error:
+            raise RuntimeError(error)
+
+    def batches():
+        # consecutive pages with the same resolution are rasterized in one poppler call, up to batch_size pages
+        batch = None
+        pages_sorted = sorted(pages)
+        for start in range(0, len(pages_sorted), preview_batch):
+            chunk = pages_sorted[start : start + preview_batch]
+            if dpi is None:
+                resolutions = page_dpis(pdf_bytes, chunk, {page: page_sizes[page - 1] for page in chunk})
+            else:
+                resolutions = dict.fromkeys(chunk, dpi)
+            for page in chunk:
+                page_resolution = resolutions[page]
+                if batch and page == batch[1] + 1 and page - batch[0] < batch_size and batch[2] == page_resolution:
+                    batch[1] = page
+                    continue
+                if batch:
+                    yield batch
+                batch = [page, page, page_resolution]
+        if batch:
+            yield batch
+
+    for first, last, page_resolution in batches():
+        with metrics.timed("pdf.rasterize"):
+            images = pdf2image.convert_from_bytes(
+                pdf_file=pdf_bytes,
+                dpi=page_resolution,
+                grayscale=grayscale,
+                output_file=None,
+                output_folder=None,
+                timeout=20,
+                first_page=first,
+                last_page=last,
+            )
+        for page, image in enumerate(images, start=first):
+            yield (page, np.asarray(image))
+        del images
+
+
 # convert image to opencv image
 @st.cache_data(show_spinner=False)
 def img2opencv2(pil_image: np.ndarray) -> np.ndarray:
@@ -0,0 +1,174 @@
+import os
+from collections import deque
+from collections.abc import Callable
+from collections.abc import Iterator
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+import helpers.ocrresult as ocrresult
+import helpers.pdfimage as pdfimage
+import helpers.pdftext as pdftext
+import helpers.tiling as tiling
+
+
+# default number of parallel OCR workers, tesseract runs as subprocess so threads are enough
+default_workers = max(1, min(4, os.cpu_count() or 1))
+
+
+def grayscale_rgb(img: np.ndarray) -> np.ndarray:
+    """Default page preprocessing: rasterized PDF pages are RGB, convert them to grayscale."""
+    if len(img.shape) == 3:
+        return cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+    return img
+
+
+def ocr_page(
+    img: np.ndarray,
+    language_short: str,
+    config: str,
+    timeout: int,
+    preprocess: Callable[[np.ndarray], np.ndarray] = None,
+    structured: bool = False,
+) -> tuple[str, str]:
+    """Preprocess and OCR a single rasterized RGB or gray page, returns (text, error).
+    param preprocess: function like opencv.Pipeline, which expects BGR images as all opencv helpers
+    param structured: return an ocrresult.OcrResult with word boxes and confidences instead of the text
+    """
+    try:
+        if preprocess is None:
+            img = grayscale_rgb(img)
+        elif len(img.shape) == 3:
+            img = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
+        # large format pages are OCRed in tiles
+        if structured:
+            return tiling.ocr_image_result(img, language_short=language_short, config=config, timeout=timeout, preprocess=preprocess)
+        return tiling.ocr_image(img, language_short=language_short, config=config, timeout=timeout, preprocess=preprocess)
+    except Exception as e:
+        return (None, str(e))
+
+
+def ocr_mixed_page(
+    img: np.ndarray,
+    triage: pdftext.PageTriage,
+    language_short: str,
+    config: str,
+    timeout: int,
+    preprocess: Callable[[np.ndarray], np.ndarray] = None,
+    structured: bool = False,
+    with_text_layer: bool = True,
+) -> tuple[str, str]:
+    """Embedded text of a page plus the OCR of its image regions, returns (text, error).
+    param with_text_layer: False to return only the OCR of the image regions
+    """
+    # the page may have been rendered with an adaptive resolution, take it from the image size
+    dpi = 72.0 * img.shape[1] / triage.width
+    results, texts = ([triage.result(dpi)], [triage.text.strip()]) if with_text_layer else ([], [])
+    for left, top, right, bottom in triage.pixel_regions(dpi):
+        region = img[top:bottom, left:right]
+        if not region.size:
+            continue
+        result, error = ocr_page(region, language_short, config, timeout, preprocess=preprocess, structured=structured)
+        if error:
+            return (None, error)
+        if structured:
+            results.append(result.offset(left, top))
+        else:
+            texts.append(result.strip())
+    if structured:
+        height, width = img.shape[:2]
+        result = ocrresult.OcrResult.concat(results, image_width=width, image_height=height)
+        # tag the merged result with all engines, e.g. "pdf-text+tesseract"
+        result.engine = "+".join(dict.fromkeys(part.engine for part in results if len(part)))
+        return (result, None)
+    return ("\n\n".join(text for text in texts if text), None)
+
+
+def _done(value) -> Future:
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+def ocr_pdf(
+    pdf_bytes: bytes,
+    language_short: str,
+    config: str,
+    timeout: int,
+    preprocess: Callable[[np.ndarray], np.ndarray] = None,
+    max_workers: int = None,
+    batch_size: int = 1,
+    first_page: int = 1,
+    last_page: int = None,
+    dpi: int | None = 300,
+    structured: bool = False,
+    use_text_layer: bool = True,
+) -> Iterator[tuple[int, str, str, str]]:
+    """OCR all pages of a PDF on a bounded worker pool.
+    Pages with a sufficient text layer (see pdftext) are not rasterized, their embedded text is used.
+    The other pages are rasterized lazily while the workers run OCR on the previous pages.
+    Yields (page number, text, error, source) in page order as soon as a page is done, source is
+    "text", "ocr" or "text+ocr" (see pdftext).
+    At most 2 * max_workers rasterized pages are held in memory at the same time.
+    param preprocess: function applied to every page before OCR (e.g. opencv.Pipeline), default is grayscale
+    param structured: yield ocrresult.OcrResult pages instead of the text
+    param use_text_layer: triage the pages with PyMuPDF (if installed), otherwise every page is OCRed
+    param dpi: rasterization resolution, None to choose it per page (see pdfimage.page_dpi)
+    """
+    max_workers = max_workers or default_workers
+    max_pending = 2 * max_workers
+    triage = {}
+    if use_text_layer and pdftext.available:
+        pages, error = pdftext.triage_pdf(pdf_bytes, first_page=first_page, last_page=last_page)
+        if not error:
+            triage = {page.page: page for page in pages}
+    # pages with a text layer only, in page order
+    text_pages = deque(page for page in triage.values() if page.source == pdftext.TEXT)
+    raster_pages = [page.page for page in triage.values() if page.source != pdftext.TEXT] if triage else None
+    # render gray right away if the page gets converted to gray anyway, no RGB buffer and conversion
+    render_gray = preprocess is None or getattr(preprocess, "grayscale", False)
+    pending = deque()
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="pdfocr")
+
+    def queue_text_pages(before: int):
+        while text_pages and (before is None or text_pages[0].page < before):
+            page = text_pages.popleft()
+            pending.append((page.page, _done((page.result(dpi or 300) if structured else page.text, None)), pdftext.TEXT))
+
+    try:
+        try:
+            for page, img in pdfimage.iter_pages(
+                pdf_bytes, first_page=first_page, last_page=last_page, batch_size=batch_size, dpi=dpi, pages=raster_pages,
+                grayscale=render_gray,
+            ):
+                queue_text_pages(before=page)
+                page_triage = triage.get(page)
+                if page_triage is not None and page_triage.source == pdftext.MIXED:
+                    future = executor.submit(
+                        ocr_mixed_page, img, page_triage, language_short, config, timeout, preprocess, structured
+                    )
+                    pending.append((page, future, pdftext.MIXED))
+                else:
+                    future = executor.submit(ocr_page, img, language_short, config, timeout, preprocess, structured)
+                    pending.append((page, future, pdftext.OCR))
+                del img
+                # wait for the oldest page before rasterizing more pages
+                while len(pending) >= max_pending or (pending and pending[0][1].done()):
+                    done_page, done_future, source = pending.popleft()
+                    yield (done_page, *done_future.result(), source)
+            queue_text_pages(before=None)
+        except Exception as e:
+            # rasterization failed, report the results done so far and the error
+            while pending:
+                done_page, done_future, source = pending.popleft()
+                yield (done_page, *done_future.result(), source)
+            yield (None, None, pdfimage.pdf_error(e), pdftext.OCR)
+            return
+        while pending:
+            done_page, done_future, source = pending.popleft()
+            yield (done_page, *done_future.result(), source)
+    finally:
+        # generator closed early, drop the queued pages
+        executor.shutdown(wait=False, cancel_futures=True)
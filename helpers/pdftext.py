@@ -0,0 +1,138 @@
+'''
+Per-page triage of PDFs ahead of rasterization and OCR.
+Born digital pages already contain their text, pulling it out with PyMuPDF takes
+milliseconds while rasterizing at 300 dpi and OCR take seconds. Every page is
+classified by its text layer and the page area covered by images:
+- "text": the embedded text is used as is, the page is not rasterized
+- "ocr": scanned page (no or unusable text layer), rasterize and OCR the whole page
+- "text+ocr": embedded text plus OCR of the large image regions without text
+Boxes are in PDF points of the displayed (rotated) page, like the rendered images.
+'''
+import math
+import os
+from dataclasses import dataclass
+from dataclasses import field
+
+import helpers.ocrresult as ocrresult
+
+try:
+    import pymupdf
+except ImportError:  # optional dependency, every page is OCRed without it
+    pymupdf = None
+
+
+available = pymupdf is not None
+
+TEXT, OCR, MIXED = "text", "ocr", "text+ocr"
+
+# a page needs at least this many characters of extractable text to skip OCR
+min_text_chars = int(os.environ.get("OCR_PDF_MIN_TEXT_CHARS", "20"))
+# images covering less than this fraction of the page (logos, icons) are not OCRed
+min_image_fraction = float(os.environ.get("OCR_PDF_MIN_IMAGE_FRACTION", "0.05"))
+# a text layer with more unmappable characters (no ToUnicode map in the font) than this is not used
+max_garbage_fraction = 0.1
+# an image with at least this many text layer words inside it has its text already
+min_image_words = 3
+# render mode 3 in the text trace of PyMuPDF, the invisible OCR text layer of a scan
+INVISIBLE = 3
+
+
+@dataclass
+class PageTriage:
+    page: int
+    source: str
+    text: str = ""
+    # words of the text layer as (x0, y0, x1, y1, text, block, line, word) in points
+    words: list = field(default_factory=list)
+    # image regions to OCR as (x0, y0, x1, y1) in points
+    regions: list = field(default_factory=list)
+    width: float = 0.0
+    height: float = 0.0
+
+    def result(self, dpi: int = 300) -> ocrresult.OcrResult:
+        """OcrResult of the text layer in pixels of a page rendered with dpi."""
+        scale = dpi / 72.0
+        lines = {key: i for i, key in enumerate(dict.fromkeys((word[5], word[6]) for word in self.words))}
+        return ocrresult.OcrResult(
+            text=[word[4] for word in self.words],
+            left=[word[0] * scale for word in self.words],
+            top=[word[1] * scale for word in self.words],
+            width=[(word[2] - word[0]) * scale for word in self.words],
+            height=[(word[3] - word[1]) * scale for word in self.words],
+            conf=[1.0] * len(self.words),
+            block=[word[5] for word in self.words],
+            line=[lines[(word[5], word[6])] for word in self.words],
+            word=[word[7] for word in self.words],
+            image_width=math.ceil(self.width * scale),
+            image_height=math.ceil(self.height * scale),
+            engine="pdf-text",
+        )
+
+    def pixel_regions(self, dpi: int = 300) -> list[tuple[int, int, int, int]]:
+        """Image regions as (left, top, right, bottom) in pixels of a page rendered with dpi."""
+        scale = dpi / 72.0
+        return [(int(x0 * scale), int(y0 * scale), int(x1 * scale + 1), int(y1 * scale + 1)) for x0, y0, x1, y1 in self.regions]
+
+
+def _area(box) -> float:
+    return max(0.0, box[2] - box[0]) * max(0.0, box[3] - box[1])
+
+
+def _center_inside(box, word) -> bool:
+    x, y = (word[0] + word[2]) / 2, (word[1] + word[3]) / 2
+    return box[0] <= x <= box[2] and box[1] <= y <= box[3]
+
+
+def _covered(box, text_boxes: list, invisible_boxes: list) -> bool:
+    """True if the text layer already holds the text of an image, e.g. a scan with an OCR text layer.
+    Sparse pages have few words on a large image, so the words are counted instead of their area.
+    Invisible text on an image is its OCR layer, however few words it has.
+    """
+    if any(_center_inside(box, span) for span in invisible_boxes):
+        return True
+    return sum(_center_inside(box, word) for word in text_boxes) >= min_image_words
+
+
+def triage_page(page, page_number: int) -> PageTriage:
+    """Classify an open PyMuPDF page, see the module docstring."""
+    rotation = page.rotation_matrix
+    width, height = page.rect.width, page.rect.height
+    triage = PageTriage(page=page_number, source=OCR, width=width, height=height)
+    text = page.get_text("text")
+    chars = len(text.strip())
+    if chars < min_text_chars or text.count("\ufffd") > max_garbage_fraction * chars:
+        return triage
+    triage.text = text
+    for x0, y0, x1, y1, word, block, line, number in page.get_text("words"):
+        box = pymupdf.Rect(x0, y0, x1, y1) * rotation
+        triage.words.append((box.x0, box.y0, box.x1, box.y1, word, block, line, number))
+    text_boxes = [word[:4] for word in triage.words]
+    invisible_boxes = [tuple(pymupdf.Rect(span["bbox"]) * rotation) for span in page.get_texttrace() if span["type"] == INVISIBLE]
+    page_area = width * height
+    for info in page.get_image_info():
+        box = tuple(pymupdf.Rect(info["bbox"]) * rotation & page.rect)
+        area = _area(box)
+        if area < min_image_fraction * page_area:
+            continue
+        if _covered(box, text_boxes, invisible_boxes):
+            continue
+        triage.regions.append(box)
+    triage.source = MIXED if triage.regions else TEXT
+    return triage
+
+
+def triage_pdf(pdf_bytes: bytes, first_page: int = 1, last_page: int = None) -> tuple[list[PageTriage], str]:
+    """Triage the pages of a PDF, returns ([PageTriage, ...], error).
+    Without PyMuPDF an error is returned and the caller OCRs every page.
+    """
+    if not available:
+        return (None, "ImportError: PyMuPDF is not installed.")
+    pages, error = [], None
+    try:
+        with pymupdf.open(stream=pdf_bytes, filetype="pdf") as doc:
+            last_page = doc.page_count if last_page is None else min(last_page, doc.page_count)
+            for page_number in range(first_page, last_page + 1):
+                pages.append(triage_page(doc[page_number - 1], page_number))
+    except Exception as e:
+        pages, error = None, str(e)
+    return (pages, error)
@@ -0,0 +1,206 @@
+'''
+Fast image quality triage, picks the cheapest preprocessing which is sufficient.
+A few statistics are measured in a few milliseconds, on a small gray copy of the
+image and on a full resolution center crop for the noise (downscaling averages
+the noise away):
+- noise: standard deviation of the pixel noise, from the median absolute Laplacian
+- contrast: spread between the darkest and brightest 2 percent of the pixels
+- bimodality: share of the gray value variance explained by Otsu's two classes
+- uneven: brightness range of the background (shadows, lighting gradients of photos)
+- text_height: median glyph height in pixels at full resolution
+plan() turns them into opencv.Pipeline steps: the expensive fastNlMeansDenoising
+only for noisy images, Otsu thresholding for faded or low contrast images and
+adaptive thresholding for uneven lighting. Clean scans get no filter at all,
+tesseract binarizes them itself. The decisions are counted per step and logged
+with their reasons on the "b_rabbit.quality" logger with OCR_QUALITY_LOG=1.
+'''
+import json
+import logging
+import os
+from dataclasses import asdict
+from dataclasses import dataclass
+
+import cv2
+import numpy as np
+
+import helpers.metrics as metrics
+import helpers.opencv as opencv
+import helpers.pdfimage as pdfimage
+
+
+logger = logging.getLogger("b_rabbit.quality")
+log_decisions = os.environ.get("OCR_QUALITY_LOG", "0") not in ("0", "false", "False", "no", "")
+if log_decisions and not logger.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO)
+
+# noise standard deviation (gray values) above which fastNlMeansDenoising pays off
+noise_high = float(os.environ.get("OCR_QUALITY_NOISE_HIGH", "6"))
+# mild noise between noise_low and noise_high gets a median blur, if the glyphs are large enough for it
+noise_low = 3.0
+median_min_text_height = 20
+# gray value spread below this is low contrast
+low_contrast = 100
+# gray value spread below this is a blank or uniform image, thresholding would turn it black or into noise
+blank_contrast = 8
+# Otsu's classes explain less than this share of the variance: no clean ink/paper separation
+low_bimodality = 0.75
+# background brightness range (fraction of 255) above which one global threshold fails
+uneven_lighting = 0.15
+# text smaller than this (pixels) is read poorly by tesseract
+small_text_height = 10
+
+decisions = metrics.Counter("ocr_quality_decisions_total", "Preprocessing steps chosen by the quality triage.", ("step",))
+metrics.registry.append(decisions)
+
+
+@dataclass
+class Quality:
+    width: int
+    height: int
+    noise: float
+    contrast: float
+    bimodality: float
+    uneven: float
+    text_height: float
+
+    def to_dict(self) -> dict:
+        return {key: round(value, 3) if isinstance(value, float) else value for key, value in asdict(self).items()}
+
+
+def _gray(img: np.ndarray) -> np.ndarray:
+    return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if len(img.shape) == 3 else img
+
+
+def estimate_noise(gray: np.ndarray) -> float:
+    """Standard deviation of gaussian pixel noise in a gray image.
+    The Laplacian kernel below cancels smooth image content, its response to noise has 6 times
+    the noise standard deviation. The median (not the mean) keeps the text edges out of the estimate.
+    """
+    if min(gray.shape[:2]) < 3:
+        return 0.0
+    kernel = np.array([[1, -2, 1], [-2, 4, -2], [1, -2, 1]], dtype=np.float32)
+    response = cv2.filter2D(gray.astype(np.float32), -1, kernel)[1:-1, 1:-1]
+    return float(np.median(np.abs(response)) / (0.6745 * 6))
+
+
+def bimodality(gray: np.ndarray) -> float:
+    """Between class variance of Otsu's threshold relative to the total variance, 1.0 for a binary image."""
+    hist = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
+    levels = np.arange(256, dtype=np.float64)
+    total = hist.sum()
+    mean = (hist * levels).sum() / total
+    variance = (hist * (levels - mean) ** 2).sum() / total
+    if variance == 0:
+        return 1.0
+    weight = np.cumsum(hist) / total
+    mean_low = np.cumsum(hist * levels) / total
+    with np.errstate(divide="ignore", invalid="ignore"):
+        between = (mean * weight - mean_low) ** 2 / (weight * (1 - weight))
+    return float(np.nanmax(between[:-1]) / variance)
+
+
+def measure(img: np.ndarray, max_size: int = 800, crop_size: int = 512) -> Quality:
+    """Measure the statistics of an image (BGR or gray), see the module docstring."""
+    height, width = img.shape[:2]
+    with metrics.timed("quality.measure", img):
+        top, left = max(0, (height - crop_size) // 2), max(0, (width - crop_size) // 2)
+        noise = estimate_noise(_gray(img[top : top + crop_size, left : left + crop_size]))
+        small = _gray(img)
+        scale = min(1.0, max_size / max(height, width))
+        if scale < 1:
+            small = cv2.resize(small, (max(1, int(width * scale)), max(1, int(height * scale))), interpolation=cv2.INTER_AREA)
+        low, high = np.percentile(small, (2, 98))
+        # the background is the brightest value around every pixel, the dark text is filtered out
+        size = max(15, max(small.shape) // 30) | 1
+        background = cv2.blur(cv2.dilate(small, np.ones((size, size), np.uint8)), (size, size))
+        background_low, background_high = np.percentile(background, (5, 95))
+        return Quality(
+            width=width,
+            height=height,
+            noise=noise,
+            contrast=float(high - low),
+            bimodality=bimodality(small),
+            uneven=float(background_high - background_low) / 255,
+            text_height=pdfimage.estimate_text_height(small) / scale,
+        )
+
+
+def plan(quality: Quality) -> tuple[list[tuple[str, dict]], list[str]]:
+    """Preprocessing steps for an image of the given quality and the reason of every decision."""
+    steps, reasons = [], []
+    if quality.noise >= noise_high:
+        strength = int(min(max(round(quality.noise), 3), 30))
+        steps.append(("denoising", {"strength": strength}))
+        reasons.append(f"noise {quality.noise:.1f} >= {noise_high:g}: denoising with strength {strength}")
+    elif quality.noise >= noise_low and quality.text_height >= median_min_text_height:
+        steps.append(("remove_noise", {}))
+        reasons.append(f"mild noise {quality.noise:.1f} on large text: median blur instead of denoising")
+    else:
+        reasons.append(f"noise {quality.noise:.1f} < {noise_high:g}: denoising skipped")
+    if quality.contrast < blank_contrast:
+        reasons.append(f"contrast {quality.contrast:.0f} < {blank_contrast}: blank or uniform image, thresholding skipped")
+    elif quality.uneven >= uneven_lighting:
+        # the neighbourhood covers a few lines of text, so it always contains some background
+        block_size = int(max(31, 4 * quality.text_height)) | 1
+        steps.append(("thresholding", {"method": "adaptive", "block_size": block_size, "c": 10}))
+        reasons.append(f"uneven lighting {quality.uneven:.2f} >= {uneven_lighting:g}: adaptive thresholding, block {block_size}")
+    elif quality.contrast < low_contrast or quality.bimodality < low_bimodality:
+        steps.append(("thresholding", {"method": "otsu"}))
+        reasons.append(f"contrast {quality.contrast:.0f}, bimodality {quality.bimodality:.2f}: Otsu thresholding")
+    else:
+        reasons.append(f"contrast {quality.contrast:.0f}, bimodality {quality.bimodality:.2f}: thresholding skipped")
+    if 0 < quality.text_height < small_text_height:
+        reasons.append(f"text height {quality.text_height:.0f} px is small, a higher resolution would help")
+    return (steps, reasons)
+
+
+def triage(img: np.ndarray) -> tuple[list[tuple[str, dict]], list[str]]:
+    """Measure and plan in one call, the decision is counted and logged."""
+    quality = measure(img)
+    steps, reasons = plan(quality)
+    for name, params in steps:
+        decisions.inc(step=params.get("method", name))
+    if not steps:
+        decisions.inc(step="none")
+    logger.info(json.dumps({"event": "triage", "quality": quality.to_dict(), "steps": steps, "reasons": reasons}))
+    return (steps, reasons)
+
+
+class AutoPipeline:
+    """Drop in for opencv.Pipeline which adds the filter steps planned by triage() per image.
+    param steps: fixed steps (grayscale, rotation, crop) which run on every image
+    """
+
+    def __init__(self, steps: list[tuple[str, dict]] | tuple = ()):
+        self.base = opencv.Pipeline(steps)
+
+    @property
+    def steps(self) -> list[tuple[str, dict]]:
+        return self.base.steps
+
+    @property
+    def pixelwise(self) -> bool:
+        # the planned steps are all pixel filters, tiling plans once on the whole image and runs that plan on every tile
+        return self.base.pixelwise
+
+    @property
+    def grayscale(self) -> bool:
+        return self.base.grayscale
+
+    @property
+    def spec(self) -> tuple:
+        return self.base.spec + (("auto", ()),)
+
+    def plan(self, img: np.ndarray) -> opencv.Pipeline:
+        """The pipeline for img, the same plan can run on parts (tiles) of img."""
+        steps, _ = triage(img)
+        return opencv.Pipeline(self.base.steps + steps)
+
+    def __call__(self, img: np.ndarray) -> np.ndarray:
+        return self.plan(img).run(img)
+
+    def __repr__(self) -> str:
+        return f"AutoPipeline({self.base.steps!r})"
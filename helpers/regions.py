@@ -0,0 +1,76 @@
+'''
+Region of interest OCR.
+Instead of handing the whole page to the recognizer, the text regions are found
+first (see opencv.detect_text_regions) and only their crops are OCRed. Blank
+margins and photos are never seen by tesseract, which saves most of the time on
+sparse pages (forms, receipts, slides). The crops are views into the image, their
+word boxes are mapped back to page coordinates.
+'''
+import os
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import helpers.metrics as metrics
+import helpers.ocrresult as ocrresult
+import helpers.opencv as opencv
+import helpers.tesseract as tesseract
+import helpers.tiling as tiling
+
+
+# with text on more than this fraction of the page one pass over the whole page is cheaper
+max_region_fraction = float(os.environ.get("OCR_REGION_MAX_FRACTION", "0.6"))
+# more blocks than this are not worth one tesseract call each
+max_regions = int(os.environ.get("OCR_REGION_MAX_COUNT", "32"))
+
+
+def region_fraction(boxes: list[tuple[int, int, int, int]], height: int, width: int) -> float:
+    """Fraction of the page covered by the boxes, overlapping boxes are counted once."""
+    mask = np.zeros((height, width), dtype=bool)
+    for left, top, right, bottom in boxes:
+        mask[top:bottom, left:right] = True
+    return float(mask.mean()) if mask.size else 0.0
+
+
+def use_regions(boxes: list[tuple[int, int, int, int]], height: int, width: int) -> bool:
+    return 0 < len(boxes) <= max_regions and region_fraction(boxes, height, width) <= max_region_fraction
+
+
+def _ocr_region(img, box, language_short, config, timeout):
+    left, top, right, bottom = box
+    result, error = tesseract.extract_result(image=img[top:bottom, left:right], language_short=language_short, config=config, timeout=timeout)
+    if error:
+        return (None, error)
+    return (result.offset(left, top), None)
+
+
+def ocr_regions(
+    img: np.ndarray,
+    language_short: str,
+    config: str,
+    timeout: int,
+    preprocess: Callable[[np.ndarray], np.ndarray] = None,
+    boxes: list[tuple[int, int, int, int]] = None,
+    max_workers: int = None,
+) -> tuple[ocrresult.OcrResult, str]:
+    """OCR only the text blocks of an image with tesseract, returns (result, error) in image coordinates.
+    Pages with a lot of text (see use_regions) and pages without detected text are OCRed as a whole.
+    param boxes: text blocks as (left, top, right, bottom), detected on the preprocessed image if None
+    """
+    if preprocess is not None:
+        img = preprocess(img)
+    height, width = img.shape[:2]
+    if boxes is None:
+        with metrics.timed("regions.detect", img):
+            boxes = opencv.detect_text_regions(img, level="block")
+    if not use_regions(boxes, height, width):
+        return tiling.ocr_image_result(img, language_short=language_short, config=config, timeout=timeout)
+    max_workers = max_workers or tiling.default_workers
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ocr-region") as executor:
+        results = list(executor.map(lambda box: _ocr_region(img, box, language_short, config, timeout), boxes))
+    errors = [error for _, error in results if error]
+    if errors:
+        return (None, errors[0])
+    merged = ocrresult.OcrResult.concat([result for result, _ in results], image_width=width, image_height=height)
+    return (merged.assign_lines(), None)
@@ -0,0 +1,142 @@
+'''
+Persistent, content addressed cache for OCR results.
+The key is a hash of the raw upload bytes plus engine, language, config and
+preprocessing spec, so the same document uploaded again is answered from disk,
+also after a restart. The store is a sqlite file with a size cap (LRU eviction)
+and a time to live for the entries.
+'''
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+import helpers.metrics as metrics
+
+
+default_path = os.environ.get("OCR_CACHE_PATH", str(Path.home() / ".cache" / "b-rabbit" / "ocr_results.sqlite3"))
+default_max_bytes = int(float(os.environ.get("OCR_CACHE_MAX_MB", "256")) * 1024 * 1024)
+default_ttl = int(float(os.environ.get("OCR_CACHE_TTL_DAYS", "30")) * 24 * 3600)
+enabled = os.environ.get("OCR_CACHE", "1") not in ("0", "false", "False", "no")
+
+
+def make_key(data: bytes | memoryview, engine: str, language: str, config: str = "", preprocessing: object = None) -> str:
+    """Content address of an OCR result, data are the raw bytes of the uploaded file."""
+    digest = hashlib.blake2b(data, digest_size=20)
+    digest.update(repr((engine, language, config, preprocessing)).encode())
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """OCR result store on disk with LRU eviction by total size and TTL expiry.
+    If the database can not be opened (e.g. read-only filesystem) the cache is disabled
+    and every lookup is a miss.
+    """
+
+    def __init__(self, path: str = default_path, max_bytes: int = default_max_bytes, ttl: int = default_ttl):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = None
+        try:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, "
+                "created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)")
+        except (OSError, sqlite3.Error):
+            self._db = None
+
+    @property
+    def available(self) -> bool:
+        return self._db is not None
+
+    def get(self, key: str) -> str | None:
+        value = None
+        now = time.time()
+        # the counters are shared by the worker threads, they are updated under the lock too
+        with self._lock:
+            if self._db is not None:
+                try:
+                    row = self._db.execute("SELECT value, created FROM results WHERE key = ?", (key,)).fetchone()
+                    if row is not None and self.ttl and row[1] + self.ttl < now:
+                        self._db.execute("DELETE FROM results WHERE key = ?", (key,))
+                    elif row is not None:
+                        value = row[0]
+                        self._db.execute("UPDATE results SET accessed = ? WHERE key = ?", (now, key))
+                except sqlite3.Error:
+                    value = None
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        metrics.record_cache("result", hit=value is not None)
+        return value
+
+    def put(self, key: str, value: str):
+        if self._db is None or value is None:
+            return
+        now = time.time()
+        size = len(value.encode("utf-8"))
+        with self._lock:
+            try:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO results (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                    (key, value, size, now, now),
+                )
+                self._evict(now)
+            except sqlite3.Error:
+                pass
+
+    def _evict(self, now: float):
+        if self.ttl:
+            self._db.execute("DELETE FROM results WHERE created < ?", (now - self.ttl,))
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # drop the least recently used entries until the cache is below 90% of the cap
+        target = total - int(self.max_bytes * 0.9)
+        freed = 0
+        keys = []
+        for key, size in self._db.execute("SELECT key, size FROM results ORDER BY accessed"):
+            keys.append((key,))
+            freed += size
+            if freed >= target:
+                break
+        self._db.executemany("DELETE FROM results WHERE key = ?", keys)
+
+    def stats(self) -> dict:
+        entries, size = 0, 0
+        with self._lock:
+            if self._db is not None:
+                entries, size = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results").fetchone()
+            hits, misses = self.hits, self.misses
+        return {"hits": hits, "misses": misses, "entries": entries, "bytes": size}
+
+    def clear(self):
+        if self._db is not None:
+            with self._lock:
+                self._db.execute("DELETE FROM results")
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_result_cache() -> ResultCache | None:
+    """Process wide result cache, None if disabled by OCR_CACHE=0."""
+    global _cache
+    if not enabled:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResultCache()
+        return _cache
@@ -0,0 +1,193 @@
+'''
+Searchable PDF output based on PyMuPDF.
+Every page without a text layer is rendered, OCRed once and gets the recognized
+words as invisible text on top of the original page content, so the page looks
+exactly as before but can be searched and copied. The text layer comes from the
+same OcrResult as the plain text output, tesseract runs once per page.
+Pages which already have a text layer are left untouched and are not rendered,
+on pages with text and large images (see pdftext) only the images are OCRed.
+'''
+from collections import deque
+from collections.abc import Callable
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import helpers.ocrresult as ocrresult
+import helpers.pdfimage as pdfimage
+import helpers.pdfocr as pdfocr
+import helpers.pdftext as pdftext
+
+try:
+    import pymupdf
+except ImportError:  # optional dependency, searchable PDF output is not available without it
+    pymupdf = None
+
+
+available = pymupdf is not None
+
+# font for the invisible text: Noto Sans of the optional pymupdf-fonts package covers latin with all
+# azerbaijani letters (also the capital Ə), cyrillic and greek. The built in fallback font "cjk" has no
+# glyph for Ə, a text layer written with it is still searchable and extractable through its ToUnicode map.
+text_font = "notos" if available and "notos" in getattr(pymupdf, "fitz_fontdescriptors", {}) else "cjk"
+
+
+def render_page(page, dpi: int = 300, grayscale: bool = True) -> np.ndarray:
+    """Render a PDF page to a gray or RGB numpy array, the array owns a copy of the pixmap samples."""
+    colorspace = pymupdf.csGRAY if grayscale else pymupdf.csRGB
+    pixmap = page.get_pixmap(dpi=dpi, colorspace=colorspace, alpha=False)
+    # samples_mv is a view of the pixmap memory, samples would be one more copy as bytes
+    img = np.frombuffer(pixmap.samples_mv, dtype=np.uint8).reshape(pixmap.height, pixmap.width, pixmap.n)
+    return img[:, :, 0].copy() if pixmap.n == 1 else img.copy()
+
+
+def insert_text_layer(page, result: ocrresult.OcrResult, scale: float, font=None) -> int:
+    """Write the words of an OcrResult as invisible text (render mode 3) onto a page.
+    param scale: PDF points per image pixel, 72 / dpi for a rendered page
+    Returns the number of written words.
+    """
+    if not len(result):
+        return 0
+    font = font or pymupdf.Font(text_font)
+    writer = pymupdf.TextWriter(page.rect)
+    words = 0
+    for i, text in enumerate(result.text):
+        text = str(text)
+        width = float(result.width[i]) * scale
+        height = float(result.height[i]) * scale
+        if not text.strip() or width <= 0 or height <= 0:
+            continue
+        # fit the word into its box, so a search hit highlights the word in the image
+        fontsize = height
+        text_width = font.text_length(text, fontsize=fontsize)
+        if text_width > 0:
+            fontsize = min(fontsize, fontsize * width / text_width)
+        # baseline slightly above the bottom of the box, for the descenders
+        point = pymupdf.Point(float(result.left[i]) * scale, (float(result.top[i]) + float(result.height[i])) * scale - 0.2 * height)
+        if page.rotation:
+            # the words are in the coordinates of the rendered (rotated) page, the text is written
+            # unrotated and turned around its own start point, one word at a time
+            point = point * page.derotation_matrix
+            word_writer = pymupdf.TextWriter(page.rect)
+            word_writer.append(point, text, font=font, fontsize=fontsize)
+            word_writer.write_text(page, render_mode=3, morph=(point, pymupdf.Matrix(page.rotation)))
+        else:
+            writer.append(point, text, font=font, fontsize=fontsize)
+        words += 1
+    if not page.rotation:
+        writer.write_text(page, render_mode=3)
+    return words
+
+
+def page_dpi(page) -> int:
+    """Rendering resolution of a page from its size and the text height on a small render, see pdfimage.choose_dpi."""
+    preview = render_page(page, dpi=pdfimage.preview_dpi, grayscale=True)
+    text_height = pdfimage.estimate_text_height(preview)
+    text_height_pt = text_height * 72 / pdfimage.preview_dpi if text_height else None
+    return pdfimage.choose_dpi(page.rect.width, page.rect.height, text_height_pt)
+
+
+def image_to_pdf(data: bytes, filetype: str) -> bytes:
+    """Convert an image file (png, jpg, tiff, ...) to a PDF with one page per image frame."""
+    with pymupdf.open(stream=data, filetype=filetype) as doc:
+        return doc.convert_to_pdf()
+
+
+def ocr_pages(
+    doc,
+    language_short: str,
+    config: str,
+    timeout: int,
+    preprocess: Callable[[np.ndarray], np.ndarray] = None,
+    max_workers: int = None,
+    dpi: int | None = 300,
+) -> Iterator[tuple[int, ocrresult.OcrResult, str]]:
+    """Render and OCR the pages of an open document without a text layer on a bounded worker pool.
+    Yields (page number, result, error) in page order, result is None for skipped pages.
+    Rendering stays in the calling thread (PyMuPDF documents are not thread safe), the workers only run OCR.
+    param dpi: rendering resolution, None to choose it per page (see page_dpi)
+    """
+    max_workers = max_workers or pdfocr.default_workers
+    render_gray = preprocess is None or getattr(preprocess, "grayscale", False)
+    pending = deque()
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="searchablepdf")
+    try:
+        for index in range(doc.page_count):
+            page = doc[index]
+            triage = pdftext.triage_page(page, index + 1)
+            if triage.source == pdftext.TEXT:
+                pending.append((index + 1, None))
+            else:
+                img = render_page(page, dpi=dpi or page_dpi(page), grayscale=render_gray)
+                if triage.source == pdftext.MIXED:
+                    # the page has its text already, only the large images get a text layer
+                    future = executor.submit(
+                        pdfocr.ocr_mixed_page, img, triage, language_short, config, timeout, preprocess, True, False
+                    )
+                else:
+                    future = executor.submit(pdfocr.ocr_page, img, language_short, config, timeout, preprocess, True)
+                pending.append((index + 1, future))
+                del img
+            # at most 2 * max_workers rendered pages in memory
+            while len(pending) >= 2 * max_workers or (pending and pending[0][1] is None):
+                page_number, future = pending.popleft()
+                yield (page_number, *(future.result() if future is not None else (None, None)))
+        while pending:
+            page_number, future = pending.popleft()
+            yield (page_number, *(future.result() if future is not None else (None, None)))
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def make_searchable(
+    pdf_bytes: bytes,
+    output: str,
+    language_short: str,
+    config: str,
+    timeout: int,
+    preprocess: Callable[[np.ndarray], np.ndarray] = None,
+    max_workers: int = None,
+    dpi: int | None = 300,
+    progress: Callable[[int, int], None] = None,
+) -> tuple[dict, str]:
+    """Add an invisible OCR text layer to all pages of a PDF without one and write it to output (path or file object).
+    The text layer of a page is added as soon as its OCR is done, in page order. The original page
+    content (images, vector graphics) is kept as is, the output is written once at the end.
+    Returns ({"pages", "ocr_pages", "skipped_pages", "words"}, error).
+    param progress: called with (page number, page count) after every page
+    """
+    if not available:
+        return (None, "ImportError: PyMuPDF is not installed.")
+    if preprocess is not None and not getattr(preprocess, "pixelwise", False):
+        # the words must stay at their place on the page, so no crop or rotation
+        return (None, "ValueError: Searchable PDF output only supports pixel wise preprocessing (no crop or rotation).")
+    stats = {"pages": 0, "ocr_pages": 0, "skipped_pages": 0, "words": 0}
+    try:
+        with pymupdf.open(stream=pdf_bytes, filetype="pdf") as doc:
+            stats["pages"] = doc.page_count
+            font = pymupdf.Font(text_font)
+            pages = ocr_pages(doc, language_short, config, timeout, preprocess=preprocess, max_workers=max_workers, dpi=dpi)
+            try:
+                for page_number, result, error in pages:
+                    if error:
+                        return (stats, f"Page {page_number}: {error}")
+                    if result is None:
+                        stats["skipped_pages"] += 1
+                    else:
+                        stats["ocr_pages"] += 1
+                        page = doc[page_number - 1]
+                        # points per pixel, the resolution may have been chosen per page
+                        scale = page.rect.width / result.image_width if result.image_width else 72.0 / (dpi or 300)
+                        stats["words"] += insert_text_layer(page, result, scale, font=font)
+                    if progress is not None:
+                        progress(page_number, doc.page_count)
+            finally:
+                pages.close()
+            if stats["ocr_pages"]:
+                # only the used glyphs of the text font are embedded
+                doc.subset_fonts()
+            doc.save(output, garbage=3, deflate=True)
+    except Exception as e:
+        return (stats, str(e))
+    return (stats, None)
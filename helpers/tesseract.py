@@ -1,11 +1,24 @@
+import os
 import shutil
+import tempfile
+from contextlib import contextmanager
 
+import cv2
+import numpy as np
 import pytesseract
 import streamlit as st
 
+import helpers.metrics as metrics
+import helpers.ocrresult as ocrresult
+import helpers.tesserapi as tesserapi
+
 
 pytesseract.pytesseract.tesseract_cmd = None
 
+# "pytesseract" runs a tesseract process per call, "tesserocr" keeps in-process API handles
+backends = ["pytesseract", "tesserocr"]
+backend = os.environ.get("TESSERACT_BACKEND", "pytesseract")
+
 oem = [
     "Original Tesseract only",
     "Neural nets LSTM only  ",
@@ -74,6 +87,44 @@ def get_tesseract_languages() -> tuple[list[str], str]:
     return (installed_languages, error)
 
 
+def set_tesseract_backend(name: str):
+    global backend
+    if name not in backends:
+        raise ValueError(f"Unknown tesseract backend {name}, use one of {backends}.")
+    backend = name
+
+
+@contextmanager
+def image_file(image):
+    """Path of a temporary PNM file with the pixels of a gray or BGR numpy image, for the tesseract binary.
+    pytesseract would copy the array into a PIL image and compress a PNG, the PNM header is
+    followed by the raw rows written straight from the array buffer instead. Color rows are
+    swapped to RGB one at a time through a single row buffer. Other images are yielded unchanged.
+    """
+    if not (isinstance(image, np.ndarray) and image.dtype == np.uint8 and (image.ndim == 2 or image.shape[2] == 3)):
+        yield image
+        return
+    height, width = image.shape[:2]
+    fd, path = tempfile.mkstemp(prefix="tess_", suffix=".pnm")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(f"{'P5' if image.ndim == 2 else 'P6'}\n{width} {height}\n255\n".encode("ascii"))
+            if image.ndim == 2 and image.flags.c_contiguous:
+                file.write(image.data)
+            elif image.ndim == 2:
+                # crops and tiles are views, their rows are contiguous
+                for row in image:
+                    file.write(np.ascontiguousarray(row).data)
+            else:
+                rgb = np.empty((1, width, 3), dtype=np.uint8)
+                for row in image:
+                    cv2.cvtColor(row[None], cv2.COLOR_BGR2RGB, dst=rgb)
+                    file.write(rgb.data)
+        yield path
+    finally:
+        os.remove(path)
+
+
 # create custom oem and psm config string
 @st.cache_resource(show_spinner=False)
 def get_tesseract_config(oem_index: int, psm_index: int) -> str:
@@ -87,15 +138,29 @@ def image_to_string(image: bytes,
                     config : str,
                     timeout : int
                     ) -> tuple[str, str]:
+    return extract_text(image=image, language_short=language_short, config=config, timeout=timeout)
+
+
+# same as image_to_string, but without the streamlit cache
+# used from worker threads and batch jobs, where caching every page would grow memory
+@metrics.instrument("tesseract.image_to_string")
+def extract_text(image: bytes,
+                 language_short : str,
+                 config : str,
+                 timeout : int
+                 ) -> tuple[str, str]:
+    if backend == "tesserocr" and tesserapi.available:
+        return tesserapi.image_to_string(image=image, language_short=language_short, config=config, timeout=timeout)
     text, error = None, None
     try:
-        text = pytesseract.image_to_string(
-                        image=image,
-                        lang=language_short,
-                        output_type=pytesseract.Output.STRING,
-                        config=config,
-                        timeout=timeout
-                    )
+        with image_file(image) as path:
+            text = pytesseract.image_to_string(
+                            image=path,
+                            lang=language_short,
+                            output_type=pytesseract.Output.STRING,
+                            config=config,
+                            timeout=timeout
+                        )
     except pytesseract.TesseractError:
         error = "TesseractError: Tesseract reported an error during text extraction."
     except pytesseract.TesseractNotFoundError:
@@ -106,3 +171,71 @@ def image_to_string(image: bytes,
         error = str(e)
 
     return (text, error)
+
+
+# word level result with boxes and confidences, uncached like extract_text
+@metrics.instrument("tesseract.image_to_data")
+def extract_data(image: bytes,
+                 language_short : str,
+                 config : str,
+                 timeout : int
+                 ) -> tuple[dict, str]:
+    if backend == "tesserocr" and tesserapi.available:
+        return tesserapi.image_to_data(image=image, language_short=language_short, config=config, timeout=timeout)
+    data, error = None, None
+    try:
+        with image_file(image) as path:
+            data = pytesseract.image_to_data(
+                            image=path,
+                            lang=language_short,
+                            output_type=pytesseract.Output.DICT,
+                            config=config,
+                            timeout=timeout
+                        )
+    except pytesseract.TesseractError:
+        error = "TesseractError: Tesseract reported an error during text extraction."
+    except pytesseract.TesseractNotFoundError:
+        error = "TesseractNotFoundError: Tesseract is not installed. Please install Tesseract."
+    except RuntimeError:
+        error = "RuntimeError: Tesseract timed out during text extraction."
+    except Exception as e:
+        error = str(e)
+    return (data, error)
+
+
+# structured result (words, boxes, confidences, line and block ids) of one image_to_data pass,
+# plain text, hOCR, TSV and JSON are derived from it without running tesseract again
+def extract_result(image: bytes,
+                   language_short : str,
+                   config : str,
+                   timeout : int
+                   ) -> tuple[ocrresult.OcrResult, str]:
+    data, error = extract_data(image=image, language_short=language_short, config=config, timeout=timeout)
+    if error:
+        return (None, error)
+    height, width = image.shape[:2] if hasattr(image, "shape") else (image.height, image.width)
+    return (ocrresult.OcrResult.from_tesseract(data, image_width=width, image_height=height), None)
+
+
+# tesseract orientation detection (PSM 0), returns the clockwise rotation needed to make the image upright
+@metrics.instrument("tesseract.osd")
+def detect_orientation(image: bytes, timeout: int = 20) -> tuple[int, str]:
+    rotate, error = None, None
+    try:
+        with image_file(image) as path:
+            osd = pytesseract.image_to_osd(
+                image=path,
+                config="--psm 0",  # orientation and script detection only
+                output_type=pytesseract.Output.DICT,
+                timeout=timeout,
+            )
+        rotate = int(osd.get("rotate", 0)) % 360
+    except pytesseract.TesseractError:
+        error = "TesseractError: Tesseract could not detect the orientation, too few characters?"
+    except pytesseract.TesseractNotFoundError:
+        error = "TesseractNotFoundError: Tesseract is not installed. Please install Tesseract."
+    except RuntimeError:
+        error = "RuntimeError: Tesseract timed out during orientation detection."
+    except Exception as e:
+        error = str(e)
+    return (rotate, error)
@@ -0,0 +1,195 @@
+'''
+In-process tesseract backend based on tesserocr.
+Keeps long lived tesseract API handles per language/OEM/PSM in a pool, so the
+language data is loaded once instead of spawning a tesseract process per call.
+A call checks a handle out of the pool and returns it, the worker threads of the
+short lived executors of the callers share the handles. At most pool_size idle
+handles are kept per config, and handles are recycled after recycle_pages pages
+to bound the memory.
+'''
+import os
+import shlex
+import threading
+from contextlib import contextmanager
+
+import cv2
+import numpy as np
+
+try:
+    import tesserocr
+except ImportError:  # optional dependency, pytesseract is used if not installed
+    tesserocr = None
+
+
+available = tesserocr is not None
+
+# number of pages after which a tesseract API handle is closed and recreated
+recycle_pages = int(os.environ.get("TESSERACT_RECYCLE_PAGES", "200"))
+# idle handles kept per config, the default is the worker count of the OCR executors
+pool_size = int(os.environ.get("TESSERACT_POOL_SIZE", str(max(1, min(4, os.cpu_count() or 1)))))
+
+# all open handles (idle and checked out) and the idle handles per config
+_handles = set()
+_idle = {}
+_handles_lock = threading.Lock()
+
+
+def parse_tesseract_config(config: str) -> tuple[int, int, dict[str, str]]:
+    """Parse a pytesseract config string like "--oem 3 --psm 6 -c key=value".
+    Returns (oem, psm, variables), unknown options are ignored.
+    """
+    oem, psm, variables = 3, 3, {}
+    args = shlex.split(config or "")
+    for i, arg in enumerate(args):
+        value = args[i + 1] if i + 1 < len(args) else None
+        if arg == "--oem" and value is not None:
+            oem = int(value)
+        elif arg == "--psm" and value is not None:
+            psm = int(value)
+        elif arg == "-c" and value is not None and "=" in value:
+            key, val = value.split("=", 1)
+            variables[key] = val
+    return (oem, psm, variables)
+
+
+class _Handle:
+    """A tesseract API handle and the number of pages it has processed."""
+
+    def __init__(self, language_short: str, oem: int, psm: int, variables: dict[str, str]):
+        self.api = tesserocr.PyTessBaseAPI(lang=language_short, oem=oem, psm=psm)
+        for key, value in variables.items():
+            self.api.SetVariable(key, value)
+        self.pages = 0
+        self.closed = False
+        # set by close_all while the handle is checked out, it is closed when it is returned
+        self.retired = False
+        with _handles_lock:
+            _handles.add(self)
+
+    def close(self):
+        with _handles_lock:
+            _handles.discard(self)
+            if self.closed:
+                return
+            self.closed = True
+        self.api.End()
+
+
+@contextmanager
+def _checkout(language_short: str, oem: int, psm: int, variables: dict[str, str]):
+    """Check an idle handle of the config out of the pool, or open a new one, and return it after the call."""
+    key = (language_short, oem, psm, tuple(sorted(variables.items())))
+    with _handles_lock:
+        idle = _idle.get(key)
+        handle = idle.pop() if idle else None
+    if handle is None:
+        handle = _Handle(language_short, oem, psm, variables)
+    try:
+        yield handle
+    finally:
+        with _handles_lock:
+            idle = _idle.setdefault(key, [])
+            keep = not handle.retired and handle.pages < recycle_pages and len(idle) < pool_size
+            if keep:
+                idle.append(handle)
+        if not keep:
+            handle.close()
+
+
+def _set_image(api, image):
+    """Hand the raw pixel buffer of a numpy image to tesseract, no image file is encoded."""
+    if not isinstance(image, np.ndarray):
+        api.SetImage(image)  # PIL image
+        return
+    if image.ndim == 3 and image.shape[2] == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    elif image.ndim == 3 and image.shape[2] == 4:
+        image = cv2.cvtColor(image, cv2.COLOR_BGRA2RGBA)
+    image = np.ascontiguousarray(image, dtype=np.uint8)
+    height, width = image.shape[:2]
+    bytes_per_pixel = 1 if image.ndim == 2 else image.shape[2]
+    api.SetImageBytes(image.tobytes(), width, height, bytes_per_pixel, width * bytes_per_pixel)
+
+
+def image_to_string(image: np.ndarray,
+                    language_short: str,
+                    config: str,
+                    timeout: int
+                    ) -> tuple[str, str]:
+    """Same contract as tesseract.extract_text, but runs in-process with a pooled handle."""
+    text, error = None, None
+    if not available:
+        return (text, "ImportError: tesserocr is not installed.")
+    try:
+        oem, psm, variables = parse_tesseract_config(config)
+        with _checkout(language_short, oem, psm, variables) as handle:
+            api = handle.api
+            _set_image(api, image)
+            handle.pages += 1
+            if not api.Recognize(max(1, int(timeout * 1000)) if timeout else 0):
+                error = "RuntimeError: Tesseract timed out during text extraction."
+            else:
+                text = api.GetUTF8Text()
+            api.Clear()
+    except RuntimeError as e:
+        error = f"TesseractError: {e}"
+    except Exception as e:
+        error = str(e)
+    return (text, error)
+
+
+tsv_int_columns = ("level", "page_num", "block_num", "par_num", "line_num", "word_num", "left", "top", "width", "height")
+
+
+def tsv_to_dict(tsv: str) -> dict[str, list]:
+    """Parse tesseract TSV rows (without header) into the pytesseract Output.DICT layout."""
+    data = {key: [] for key in tsv_int_columns + ("conf", "text")}
+    for row in tsv.splitlines():
+        fields = row.split("\t")
+        if len(fields) < 11:
+            continue
+        for key, value in zip(tsv_int_columns, fields):
+            data[key].append(int(value))
+        data["conf"].append(float(fields[10]))
+        data["text"].append(fields[11] if len(fields) > 11 else "")
+    return data
+
+
+def image_to_data(image: np.ndarray,
+                  language_short: str,
+                  config: str,
+                  timeout: int
+                  ) -> tuple[dict, str]:
+    """Same contract as tesseract.extract_data, but runs in-process with a pooled handle."""
+    data, error = None, None
+    if not available:
+        return (data, "ImportError: tesserocr is not installed.")
+    try:
+        oem, psm, variables = parse_tesseract_config(config)
+        with _checkout(language_short, oem, psm, variables) as handle:
+            api = handle.api
+            _set_image(api, image)
+            handle.pages += 1
+            if not api.Recognize(max(1, int(timeout * 1000)) if timeout else 0):
+                error = "RuntimeError: Tesseract timed out during text extraction."
+            else:
+                data = tsv_to_dict(api.GetTSVText(0))
+            api.Clear()
+    except RuntimeError as e:
+        error = f"TesseractError: {e}"
+    except Exception as e:
+        error = str(e)
+    return (data, error)
+
+
+def close_all():
+    """Close all tesseract API handles. Idle handles are closed at once, handles in use
+    when their call returns them, the next calls open new handles.
+    """
+    with _handles_lock:
+        idle = [handle for handles in _idle.values() for handle in handles]
+        _idle.clear()
+        for handle in _handles:
+            handle.retired = True
+    for handle in idle:
+        handle.close()
@@ -0,0 +1,209 @@
+'''
+Tiled OCR for very large scans.
+The image is split into overlapping tiles, every tile is preprocessed and OCRed on
+its own and the word boxes are mapped back to image coordinates. Words touching
+an inner tile border are cut, tesseract read only a part of them. The words are
+merged in this order, a word overlapping an already kept complete word is dropped:
+- complete words whose center is in the tile core (the tile without half of the overlap)
+- complete words outside the core, e.g. if the owning tile read them differently or missed them
+- cut words in the core, for words which are not complete in any tile
+Words narrower and lower than the overlap are complete in at least one tile, they
+are neither lost nor duplicated. Longer words crossing a seam are kept as the cut
+parts of both tiles, a few characters in the overlap may be lost or doubled.
+Tiles are views into the image and only a bounded number of tiles is in flight,
+so the working memory depends on the tile size and not on the image size.
+'''
+import os
+from collections import deque
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import helpers.ocrresult as ocrresult
+import helpers.tesseract as tesseract
+
+
+# images with more pixels than this are OCRed in tiles
+max_pixels = int(os.environ.get("OCR_TILE_MAX_PIXELS", str(40_000_000)))
+default_tile_size = 2048
+# the overlap must be larger than the highest text line and the longest word, 256 px are ~20 mm at 300 dpi
+default_overlap = 256
+# words within this many pixels of an inner tile border are cut by it
+edge_margin = 2
+# a word overlapping a kept word by more than this fraction of the smaller box is the same word
+same_word_overlap = 0.5
+default_workers = max(1, min(4, os.cpu_count() or 1))
+
+
+def needs_tiling(img: np.ndarray) -> bool:
+    return img.shape[0] * img.shape[1] > max_pixels
+
+
+def tile_boxes(height: int, width: int, tile_size: int = default_tile_size, overlap: int = default_overlap):
+    """Split the image into overlapping tiles.
+    Returns a list of (tile, core), both as (left, top, right, bottom). The cores
+    partition the image without gaps or overlap.
+    """
+    step = max(1, tile_size - overlap)
+
+    def starts(size):
+        positions = list(range(0, max(1, size - overlap), step))
+        if positions[-1] + tile_size < size:
+            positions.append(size - tile_size)
+        return positions
+
+    xs, ys = starts(width), starts(height)
+    tiles = []
+    for iy, top in enumerate(ys):
+        bottom = min(top + tile_size, height)
+        core_top = 0 if iy == 0 else (top + min(ys[iy - 1] + tile_size, height)) // 2
+        core_bottom = height if iy == len(ys) - 1 else (ys[iy + 1] + bottom) // 2
+        for ix, left in enumerate(xs):
+            right = min(left + tile_size, width)
+            core_left = 0 if ix == 0 else (left + min(xs[ix - 1] + tile_size, width)) // 2
+            core_right = width if ix == len(xs) - 1 else (xs[ix + 1] + right) // 2
+            tiles.append(((left, top, right, bottom), (core_left, core_top, core_right, core_bottom)))
+    return tiles
+
+
+def _ocr_tile(img, tile, language_short, config, timeout, preprocess):
+    left, top, right, bottom = tile
+    tile_img = img[top:bottom, left:right]
+    if preprocess is not None:
+        tile_img = preprocess(tile_img)
+    result, error = tesseract.extract_result(image=tile_img, language_short=language_short, config=config, timeout=timeout)
+    if error:
+        return (None, error)
+    return (result.offset(left, top), None)
+
+
+def _boxes(result: ocrresult.OcrResult) -> np.ndarray:
+    return np.stack([result.left, result.top, result.left + result.width, result.top + result.height], axis=1).astype(np.float64)
+
+
+def _cut(result: ocrresult.OcrResult, tile: tuple[int, int, int, int], width: int, height: int) -> np.ndarray:
+    """Words touching a tile border which is not an image border."""
+    left, top, right, bottom = tile
+    x0, y0, x1, y1 = _boxes(result).T
+    return (
+        ((left > 0) & (x0 <= left + edge_margin))
+        | ((top > 0) & (y0 <= top + edge_margin))
+        | ((right < width) & (x1 >= right - edge_margin))
+        | ((bottom < height) & (y1 >= bottom - edge_margin))
+    )
+
+
+def _overlaps(box: np.ndarray, boxes: np.ndarray) -> bool:
+    if not len(boxes):
+        return False
+    inter = (
+        np.clip(np.minimum(box[2], boxes[:, 2]) - np.maximum(box[0], boxes[:, 0]), 0, None)
+        * np.clip(np.minimum(box[3], boxes[:, 3]) - np.maximum(box[1], boxes[:, 1]), 0, None)
+    )
+    areas = np.minimum((box[2] - box[0]) * (box[3] - box[1]), (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1]))
+    return bool((inter > same_word_overlap * np.maximum(areas, 1.0)).any())
+
+
+def merge_tiles(tiles: list[tuple[ocrresult.OcrResult, tuple, tuple]], width: int, height: int) -> ocrresult.OcrResult:
+    """Merge the results of (result, tile, core), see the module docstring."""
+    complete, outside, cut_parts = [], [], []
+    for result, tile, core in tiles:
+        cut = _cut(result, tile, width, height)
+        core_left, core_top, core_right, core_bottom = core
+        center_x, center_y = result.center_x, result.center_y
+        in_core = (core_left <= center_x) & (center_x < core_right) & (core_top <= center_y) & (center_y < core_bottom)
+        complete.append(result.select(~cut & in_core))
+        outside.append(result.select(~cut & ~in_core))
+        cut_parts.append(result.select(cut & in_core))
+    kept = list(complete)
+    kept_boxes = np.concatenate([_boxes(result) for result in kept]) if kept else np.zeros((0, 4))
+    # only the words near the seams are left, one by one is fast enough
+    for result in outside:
+        keep = np.zeros(len(result), dtype=bool)
+        for index, box in enumerate(_boxes(result)):
+            if not _overlaps(box, kept_boxes):
+                keep[index] = True
+                kept_boxes = np.vstack([kept_boxes, box])
+        kept.append(result.select(keep))
+    # the cut parts of a long word overlap each other, both are kept
+    for result in cut_parts:
+        kept.append(result.select(np.array([not _overlaps(box, kept_boxes) for box in _boxes(result)], dtype=bool)))
+    return ocrresult.OcrResult.concat(kept, image_width=width, image_height=height)
+
+
+def ocr_tiled(
+    img: np.ndarray,
+    language_short: str,
+    config: str,
+    timeout: int,
+    preprocess: Callable[[np.ndarray], np.ndarray] = None,
+    tile_size: int = default_tile_size,
+    overlap: int = default_overlap,
+    max_workers: int = None,
+) -> tuple[ocrresult.OcrResult, str]:
+    """OCR a large image in overlapping tiles in parallel, returns (result, error).
+    The words of all tiles are in image coordinates and sorted into reading order.
+    param preprocess: pixel wise preprocessing for each tile, must not change the tile geometry
+    """
+    max_workers = max_workers or default_workers
+    height, width = img.shape[:2]
+    boxes = tile_boxes(height, width, tile_size=tile_size, overlap=overlap)
+    results, pending = [], deque()
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ocr-tile") as executor:
+        for tile, _ in boxes:
+            pending.append(executor.submit(_ocr_tile, img, tile, language_short, config, timeout, preprocess))
+            # bounded number of preprocessed tiles in memory
+            while len(pending) >= 2 * max_workers:
+                results.append(pending.popleft().result())
+        while pending:
+            results.append(pending.popleft().result())
+    errors = [error for _, error in results if error]
+    if errors:
+        return (None, errors[0])
+    merged = merge_tiles([(result, tile, core) for (result, _), (tile, core) in zip(results, boxes)], width, height)
+    # tesseract lines end at the tile borders, group the words to lines again
+    return (merged.assign_lines(), None)
+
+
+def ocr_image_result(
+    img: np.ndarray,
+    language_short: str,
+    config: str,
+    timeout: int,
+    preprocess: Callable[[np.ndarray], np.ndarray] = None,
+) -> tuple[ocrresult.OcrResult, str]:
+    """Preprocess and OCR an image in one tesseract pass per image or tile, returns (result, error).
+    Images with more than max_pixels pixels are OCRed in tiles. A preprocessing which
+    changes the geometry (see opencv.Pipeline.pixelwise) runs on the whole image first.
+    """
+    if not needs_tiling(img):
+        if preprocess is not None:
+            img = preprocess(img)
+        return tesseract.extract_result(image=img, language_short=language_short, config=config, timeout=timeout)
+    if preprocess is not None and not getattr(preprocess, "pixelwise", False):
+        img, preprocess = preprocess(img), None
+    if hasattr(preprocess, "plan"):
+        # quality.AutoPipeline: planned on the whole image, so all tiles get the same filters and no seams
+        preprocess = preprocess.plan(img)
+    return ocr_tiled(img, language_short=language_short, config=config, timeout=timeout, preprocess=preprocess)
+
+
+def ocr_image(
+    img: np.ndarray,
+    language_short: str,
+    config: str,
+    timeout: int,
+    preprocess: Callable[[np.ndarray], np.ndarray] = None,
+) -> tuple[str, str]:
+    """Preprocess and OCR an image, returns (text, error).
+    Text only variant of ocr_image_result, small images use tesseract's own text layout.
+    """
+    if not needs_tiling(img):
+        if preprocess is not None:
+            img = preprocess(img)
+        return tesseract.extract_text(image=img, language_short=language_short, config=config, timeout=timeout)
+    result, error = ocr_image_result(img, language_short=language_short, config=config, timeout=timeout, preprocess=preprocess)
+    if error:
+        return (None, error)
+    return (result.to_text(), None)
@@ -0,0 +1,599 @@
+'''
+HTTP OCR service next to the streamlit apps, for programmatic access.
+
+Example:
+    python service.py --port 8000
+    curl -F file=@scan.png -F engine=tesseract -F language=aze http://localhost:8000/ocr
+    curl -F file=@book.pdf -F engine=easyocr http://localhost:8000/ocr   # one JSON line per page
+
+POST /ocr takes a multipart form with the file (image or PDF) and the optional
+fields engine (see engines.engine_names), language (tesseract code, e.g. aze),
+psm, preprocess (JSON list of opencv.Pipeline steps, e.g. [["grayscale", {}]], or
+auto to let quality.AutoPipeline choose the filters per image),
+regions (1 to OCR only detected text regions), format (txt, tsv, hocr or json)
+and timeout (seconds). Images are answered in the requested format, PDFs are
+streamed as JSON lines in page order as soon as a page is done, pages with a text
+layer are answered from it without OCR.
+Concurrent requests for the same engine and language are micro-batched onto one
+warm engine, EasyOCR reads the crops of all batched images in shared recognizer
+batches. Requests over the size limit are rejected with 413, requests beyond
+the in-flight limit and PDFs beyond the limit of concurrently rasterized PDFs
+are shed with 503 and requests over their timeout get 504.
+GET /health and GET /metrics (Prometheus text) are for the load balancer.
+LocalClient calls the app in process, without a server, for tests and notebooks.
+'''
+import argparse
+import asyncio
+import json
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import cv2
+import numpy as np
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.responses import PlainTextResponse
+from starlette.responses import Response
+from starlette.responses import StreamingResponse
+from starlette.routing import Route
+
+import helpers.engines as engines
+import helpers.jobs as jobs
+import helpers.metrics as metrics
+import helpers.ocrresult as ocrresult
+import helpers.offload as offload
+import helpers.opencv as opencv
+import helpers.pdfimage as pdfimage
+import helpers.pdftext as pdftext
+import helpers.quality as quality
+import helpers.tesseract as tesseract
+
+
+# same limit as the upload of the apps
+max_bytes = int(os.environ.get("OCR_SERVICE_MAX_BYTES", str(200 * 1024 * 1024)))
+# default and largest per request timeout in seconds
+default_timeout = float(os.environ.get("OCR_SERVICE_TIMEOUT", "60"))
+max_timeout = float(os.environ.get("OCR_SERVICE_MAX_TIMEOUT", "300"))
+# requests in flight beyond this are shed with 503, a streamed PDF is in flight until its last page is sent
+max_inflight = int(os.environ.get("OCR_SERVICE_MAX_INFLIGHT", "64"))
+# images per engine batch and how long the first image waits for others
+batch_size = int(os.environ.get("OCR_SERVICE_BATCH_SIZE", "8"))
+batch_wait = float(os.environ.get("OCR_SERVICE_BATCH_WAIT", "0.02"))
+workers = int(os.environ.get("OCR_SERVICE_WORKERS", str(jobs.default_workers)))
+# PDFs rasterized at the same time, each has a poppler thread, further PDFs are shed with 503
+max_pdfs = int(os.environ.get("OCR_SERVICE_MAX_PDFS", str(workers)))
+# engines loaded at startup, e.g. "easyocr:aze,tesseract:eng"
+warmup = os.environ.get("OCR_SERVICE_WARMUP", "")
+
+service_requests = metrics.Counter("ocr_service_requests_total", "Requests of the HTTP service by status code.", ("status",))
+batch_sizes = metrics.Histogram(
+    "ocr_service_batch_size", "Images per engine batch of the HTTP service.", ("engine",), (1, 2, 4, 8, 16, 32, 64)
+)
+metrics.registry.extend([service_requests, batch_sizes])
+
+
+class Overloaded(Exception):
+    """Raised when a request can not be queued, answered with 503."""
+
+
+class Batcher:
+    """Micro-batching of concurrent OCR calls onto one shared engine.
+    The first queued image waits up to max_wait seconds for more images, then up to max_batch
+    images run as one engine call on the thread pool. Several consumers keep the pool busy.
+    """
+
+    def __init__(self, engine: engines.Engine, language: str, executor: ThreadPoolExecutor,
+                 max_batch: int = batch_size, max_wait: float = batch_wait, consumers: int = workers):
+        self.engine = engine
+        self.language = language
+        self.executor = executor
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max_wait
+        self.consumers = max(1, consumers)
+        self.max_queued = 4 * self.max_batch * self.consumers
+        self._queue = None
+        self._tasks = []
+
+    def _start(self):
+        # the queue belongs to the event loop of the first request
+        self._queue = asyncio.Queue()
+        self._tasks = [asyncio.get_running_loop().create_task(self._consume()) for _ in range(self.consumers)]
+
+    async def submit(self, image: np.ndarray, timeout: float) -> tuple[ocrresult.OcrResult, str]:
+        """OCR the image within timeout seconds, the engine call gets the time left when it starts."""
+        if self._queue is None:
+            self._start()
+        if self._queue.qsize() >= self.max_queued:
+            raise Overloaded(f"{self.engine.name} queue is full")
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((image, future, time.monotonic() + timeout))
+        return await future
+
+    async def _consume(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            # requests which timed out while queued are not OCRed anymore
+            batch = [(image, future, deadline) for image, future, deadline in batch if not future.done()]
+            if not batch:
+                continue
+            batch_sizes.observe(len(batch), engine=self.engine.name)
+            try:
+                results = await loop.run_in_executor(
+                    self.executor, self._run, [image for image, _, _ in batch], [deadline for _, _, deadline in batch]
+                )
+            except Exception as e:
+                results = [(None, str(e))] * len(batch)
+            for (_, future, _), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def _run(self, images: list[np.ndarray], deadlines: list[float]) -> list[tuple[ocrresult.OcrResult, str]]:
+        recognize_many = getattr(self.engine, "recognize_many", None)
+        if recognize_many is not None and len(images) > 1:
+            # with regions the lines are detected per image like recognize does, only the recognizer is batched
+            boxes = [self.engine.region_boxes(image) for image in images] if self.engine.regions else None
+            results, error = recognize_many(images, self.language, boxes=boxes)
+            if not error:
+                return [(result, None) for result in results]
+        # one image at a time, so a bad image fails only its own request
+        results = []
+        for image, deadline in zip(images, deadlines):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                # answered with 504 already, the thread is not spent on it
+                results.append((None, "OCR timed out."))
+            else:
+                results.append(self.engine.recognize(image, self.language, timeout=remaining))
+        return results
+
+
+class ClosingStreamingResponse(StreamingResponse):
+    """StreamingResponse which calls the on_close callbacks when the stream ends, sent completely or not."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.on_close = []
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            for callback in self.on_close:
+                callback()
+
+
+class OcrService:
+    """Shared state of the app: warm engines, their batchers, the worker pool and the in-flight count.
+    param engine_factory: creates the engines, like engines.get_engine
+    """
+
+    def __init__(self, max_workers: int = workers, engine_factory=engines.get_engine, pdf_producers: int = max_pdfs):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ocr-service")
+        self.max_workers = max_workers
+        self.engine_factory = engine_factory
+        self.inflight = 0
+        self.pdf_producers = threading.Semaphore(max(1, pdf_producers))
+        self._engines = {}
+        self._batchers = {}
+        self._lock = threading.Lock()
+
+    def engine(self, name: str, config: str, regions: bool) -> engines.Engine:
+        key = (name, config, regions)
+        with self._lock:
+            if key not in self._engines:
+                # the largest timeout, every call passes the time left of its request
+                self._engines[key] = self.engine_factory(name, config=config, timeout=int(max_timeout), regions=regions)
+            return self._engines[key]
+
+    def release(self):
+        self.inflight -= 1
+
+    def batcher(self, name: str, language: str, config: str, regions: bool) -> Batcher:
+        key = (name, language, config, regions)
+        if key not in self._batchers:
+            self._batchers[key] = Batcher(self.engine(name, config, regions), language, self.executor, consumers=self.max_workers)
+        return self._batchers[key]
+
+    async def warmup(self, spec: str = warmup):
+        """Load the engines of spec ("engine:language,...") with one OCR call on a blank image."""
+        blank = np.full((64, 64), 255, dtype=np.uint8)
+        for item in filter(None, (part.strip() for part in spec.split(","))):
+            name, _, language = item.partition(":")
+            engine = self.engine(name, tesseract.get_tesseract_config(oem_index=3, psm_index=3), False)
+            await asyncio.get_running_loop().run_in_executor(self.executor, engine.recognize, blank, language or "eng")
+
+
+def decode(data: bytes, pipeline: opencv.Pipeline | quality.AutoPipeline) -> np.ndarray:
+    image = opencv.decode_image(data)
+    if pipeline.steps:
+        image = pipeline(image)
+    # the engines expect RGB like the apps
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB) if image.ndim == 3 else image
+
+
+def page_line(page: int, result: ocrresult.OcrResult, error: str, source: str) -> str:
+    """One JSON line per page, like the pages of the cli JSON output."""
+    return json.dumps({
+        "page": page,
+        "source": source,
+        "text": result.to_text() if result is not None else None,
+        "words": result.to_dict() if result is not None else None,
+        "error": error,
+    }, ensure_ascii=False) + "\n"
+
+
+def error_response(status: int, message: str, headers: dict = None) -> JSONResponse:
+    service_requests.inc(status=str(status))
+    return JSONResponse({"error": message}, status_code=status, headers=headers)
+
+
+async def parse_request(request: Request) -> tuple[dict, Response]:
+    """Read and check the multipart form, returns (options, error response)."""
+    length = request.headers.get("content-length")
+    if length and int(length) > max_bytes:
+        return (None, error_response(413, f"Request exceeds the {max_bytes // (1024 * 1024)} MB limit."))
+    try:
+        form = await request.form(max_files=1, max_fields=16)
+    except Exception as e:
+        return (None, error_response(400, f"Invalid multipart form: {e}"))
+    upload = form.get("file")
+    if upload is None or isinstance(upload, str):
+        return (None, error_response(400, "The form needs a file field."))
+    if upload.size is not None and upload.size > max_bytes:
+        return (None, error_response(413, f"File exceeds the {max_bytes // (1024 * 1024)} MB limit."))
+    options = {
+        "data": await upload.read(),
+        "filename": upload.filename or "upload",
+        "engine": form.get("engine", "tesseract"),
+        "language": form.get("language", "eng"),
+        "format": form.get("format", "json"),
+        "regions": form.get("regions", "0") in ("1", "true", "yes"),
+    }
+    try:
+        options["timeout"] = min(float(form.get("timeout", default_timeout)), max_timeout)
+        options["config"] = tesseract.get_tesseract_config(oem_index=3, psm_index=int(form.get("psm", 3)))
+        preprocess = form.get("preprocess", "[]")
+        if preprocess == "auto":
+            options["pipeline"] = quality.AutoPipeline([("grayscale", {})])
+        else:
+            options["pipeline"] = opencv.Pipeline(json.loads(preprocess))
+    except (ValueError, TypeError) as e:
+        return (None, error_response(400, str(e)))
+    if options["engine"] not in engines.engine_names:
+        return (None, error_response(400, f"Unknown engine {options['engine']}, use one of {engines.engine_names}."))
+    if options["format"] not in ocrresult.formats:
+        return (None, error_response(400, f"Unknown format {options['format']}, use one of {ocrresult.formats}."))
+    return (options, None)
+
+
+async def ocr_image(service: OcrService, options: dict) -> Response:
+    loop = asyncio.get_running_loop()
+    batcher = service.batcher(options["engine"], options["language"], options["config"], options["regions"])
+    try:
+        image = await loop.run_in_executor(service.executor, decode, options["data"], options["pipeline"])
+        result, error = await asyncio.wait_for(batcher.submit(image, options["timeout"]), options["timeout"])
+    except asyncio.TimeoutError:
+        return error_response(504, f"OCR did not finish within {options['timeout']:g} seconds.")
+    except Overloaded as e:
+        return error_response(503, str(e), headers={"Retry-After": "1"})
+    except Exception as e:
+        return error_response(400, str(e))
+    if error:
+        return error_response(422, error)
+    service_requests.inc(status="200")
+    if options["format"] == "json":
+        return Response(page_line(1, result, None, pdftext.OCR), media_type="application/json")
+    return Response(ocrresult.render_pages([result], options["format"]), media_type=ocrresult.mime_types[options["format"]])
+
+
+def _produce_pages(pdf_bytes: bytes, pipeline: opencv.Pipeline | quality.AutoPipeline, put, stop: threading.Event, slots: threading.Semaphore):
+    """Worker thread: triage the pages and rasterize those without text layer, hands them to put in page order."""
+    try:
+        triage, pages, error = {}, None, None
+        if pdftext.available:
+            pages, error = pdftext.triage_pdf(pdf_bytes)
+        if pages:
+            page_count = len(pages)
+            triage = {page.page: page for page in pages if page.source == pdftext.TEXT}
+        else:
+            page_count, error = pdfimage.get_page_count(pdf_bytes)
+            if error:
+                put(("error", 0, error))
+                return
+        raster_pages = [page for page in range(1, page_count + 1) if page not in triage]
+        rendered = pdfimage.iter_pages(pdf_bytes, dpi=None, pages=raster_pages, grayscale=pipeline.grayscale or not pipeline.steps)
+        for page in range(1, page_count + 1):
+            # at most a few rasterized pages wait for OCR
+            while not slots.acquire(timeout=0.5):
+                if stop.is_set():
+                    return
+            if stop.is_set():
+                return
+            if page in triage:
+                put(("text", page, triage[page].result()))
+                continue
+            _, img = next(rendered)
+            if pipeline.steps:
+                # the pages are RGB, the pipeline runs on BGR like the opencv helpers, the engines expect RGB again
+                if img.ndim == 3:
+                    img = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
+                img = pipeline(img)
+                if img.ndim == 3:
+                    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+            put(("image", page, img))
+        rendered.close()
+    except Exception as e:
+        put(("error", 0, pdfimage.pdf_error(e)))
+    finally:
+        put(("end", 0, None))
+
+
+async def ocr_pdf(service: OcrService, options: dict) -> Response:
+    if not service.pdf_producers.acquire(blocking=False):
+        return error_response(503, "Too many PDFs in progress, please retry.", headers={"Retry-After": "1"})
+    loop = asyncio.get_running_loop()
+    batcher = service.batcher(options["engine"], options["language"], options["config"], options["regions"])
+    deadline = loop.time() + options["timeout"]
+    items = asyncio.Queue()
+    stop = threading.Event()
+    slots = threading.Semaphore(2 * batcher.max_batch)
+
+    def produce(*args):
+        try:
+            _produce_pages(*args)
+        finally:
+            # the slot is free once poppler is done, not when the client went away
+            service.pdf_producers.release()
+
+    producer = threading.Thread(
+        target=produce,
+        args=(options["data"], options["pipeline"], lambda item: loop.call_soon_threadsafe(items.put_nowait, item), stop, slots),
+        name=f"ocr-service-pdf-{uuid.uuid4().hex[:8]}",
+        daemon=True,
+    )
+
+    async def pages():
+        producer.start()
+        # (page, text layer result or None, OCR task or None) in page order
+        pending = deque()
+        getter, finished = None, False
+        try:
+            while not finished or pending:
+                # emit the finished pages in page order
+                while pending and (pending[0][2] is None or pending[0][2].done()):
+                    page, text_result, task = pending.popleft()
+                    slots.release()
+                    if task is None:
+                        yield page_line(page, text_result, None, pdftext.TEXT)
+                        continue
+                    try:
+                        result, error = task.result()
+                    except Overloaded as e:
+                        result, error = None, str(e)
+                    yield page_line(page, result, error, pdftext.OCR)
+                if finished and not pending:
+                    break
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    yield json.dumps({"error": f"OCR did not finish within {options['timeout']:g} seconds."}) + "\n"
+                    return
+                waiters = {pending[0][2]} if pending and pending[0][2] is not None else set()
+                if not finished:
+                    # the getter survives the loop, so no page is lost by cancelling it
+                    getter = getter or loop.create_task(items.get())
+                    waiters.add(getter)
+                await asyncio.wait(waiters, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+                if getter is None or not getter.done():
+                    continue
+                kind, page, payload = getter.result()
+                getter = None
+                if kind == "end":
+                    finished = True
+                elif kind == "error":
+                    yield json.dumps({"page": page or None, "error": payload}) + "\n"
+                elif kind == "text":
+                    pending.append((page, payload, None))
+                else:
+                    pending.append((page, None, loop.create_task(batcher.submit(payload, deadline - loop.time()))))
+        finally:
+            stop.set()
+            if getter is not None:
+                getter.cancel()
+            for _, _, task in pending:
+                if task is not None:
+                    task.cancel()
+
+    def close():
+        stop.set()
+        if producer.ident is None:
+            # the stream ended before its first page was asked for, the producer never ran
+            service.pdf_producers.release()
+
+    service_requests.inc(status="200")
+    response = ClosingStreamingResponse(pages(), media_type="application/x-ndjson")
+    response.on_close.append(close)
+    return response
+
+
+def make_app(service: OcrService = None) -> Starlette:
+    """The ASGI app, serve it with uvicorn or call it in process with LocalClient."""
+    service = service or OcrService()
+
+    async def ocr(request: Request) -> Response:
+        if service.inflight >= max_inflight:
+            return error_response(503, "Too many requests in flight, please retry.", headers={"Retry-After": "1"})
+        service.inflight += 1
+        streamed = False
+        try:
+            options, error = await parse_request(request)
+            if error is not None:
+                return error
+            is_pdf = options["data"][:5] == b"%PDF-" or options["filename"].lower().endswith(".pdf")
+            with metrics.timed("service.ocr"):
+                response = await (ocr_pdf if is_pdf else ocr_image)(service, options)
+            if isinstance(response, ClosingStreamingResponse):
+                # the pages are OCRed while they are streamed, the request is in flight until the stream ends
+                response.on_close.append(service.release)
+                streamed = True
+            return response
+        finally:
+            if not streamed:
+                service.release()
+
+    async def health(request: Request) -> Response:
+        return JSONResponse({"status": "ok", "inflight": service.inflight, "max_inflight": max_inflight})
+
+    async def metrics_text(request: Request) -> Response:
+        return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+    @asynccontextmanager
+    async def lifespan(app: Starlette):
+        offload.start()
+        await service.warmup()
+        yield
+
+    app = Starlette(
+        routes=[Route("/ocr", ocr, methods=["POST"]), Route("/health", health), Route("/metrics", metrics_text)],
+        lifespan=lifespan,
+        max_body_size=max_bytes + 1024 * 1024,  # the file plus the form fields
+    )
+    app.state.service = service
+    return app
+
+
+def encode_multipart(fields: dict, files: dict) -> tuple[bytes, str]:
+    """Multipart form body of fields {name: value} and files {name: (filename, bytes)}, returns (body, content type)."""
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, (filename, data) in files.items():
+        header = (
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+            "Content-Type: application/octet-stream\r\n\r\n"
+        )
+        parts.append(header.encode() + data + b"\r\n")
+    parts.append(f"--{boundary}--\r\n".encode())
+    return (b"".join(parts), f"multipart/form-data; boundary={boundary}")
+
+
+class LocalResponse:
+    def __init__(self, status: int, headers: dict, chunks: list[bytes]):
+        self.status = status
+        self.headers = headers
+        # the body parts as sent, one per page for streamed PDFs
+        self.chunks = chunks
+        self.body = b"".join(chunks)
+
+    def json(self):
+        return json.loads(self.body)
+
+    def lines(self) -> list[dict]:
+        return [json.loads(line) for line in self.body.decode().splitlines() if line.strip()]
+
+
+class LocalClient:
+    """Calls the ASGI app in process on its own event loop, no server or network needed.
+    client = LocalClient(make_app()); client.post("/ocr", files={"file": ("scan.png", data)}, data={"engine": "tesseract"})
+    """
+
+    def __init__(self, app: Starlette):
+        self.app = app
+        # one loop for all requests, the batchers of the app live on it
+        self.loop = asyncio.new_event_loop()
+
+    def close(self):
+        # stop the batcher consumers of the app before the loop goes away
+        tasks = asyncio.all_tasks(self.loop)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        self.loop.close()
+
+    def __enter__(self) -> "LocalClient":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def get(self, path: str) -> LocalResponse:
+        return self.request("GET", path)
+
+    def post(self, path: str, data: dict = None, files: dict = None) -> LocalResponse:
+        body, content_type = encode_multipart(data or {}, files or {})
+        return self.request("POST", path, body, {"content-type": content_type})
+
+    def request(self, method: str, path: str, body: bytes = b"", headers: dict = None) -> LocalResponse:
+        return self.loop.run_until_complete(self._request(method, path, body, headers or {}))
+
+    async def _request(self, method: str, path: str, body: bytes, headers: dict) -> LocalResponse:
+        url = urlsplit(path)
+        headers = {**headers, "content-length": str(len(body)), "host": "localhost"}
+        scope = {
+            "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": method, "scheme": "http",
+            "path": url.path, "raw_path": url.path.encode(), "query_string": url.query.encode(), "root_path": "",
+            "headers": [(key.lower().encode(), value.encode()) for key, value in headers.items()],
+            "client": ("127.0.0.1", 0), "server": ("localhost", 80), "app": self.app,
+        }
+        sent, finished = False, asyncio.Event()
+        status, response_headers, chunks = 500, {}, []
+
+        async def receive():
+            nonlocal sent
+            if not sent:
+                sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            await finished.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            nonlocal status, response_headers
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                response_headers = {key.decode(): value.decode() for key, value in message.get("headers", [])}
+            elif message["type"] == "http.response.body":
+                if message.get("body"):
+                    chunks.append(message["body"])
+                if not message.get("more_body", False):
+                    finished.set()
+
+        await self.app(scope, receive, send)
+        finished.set()
+        return LocalResponse(status, response_headers, chunks)
+
+
+def main(argv: list[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="HTTP OCR service with request batching.")
+    parser.add_argument("--host", default="0.0.0.0", help="bind address (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=8000, help="port (default: %(default)s)")
+    options = parser.parse_args(argv)
+    import uvicorn
+
+    tesseract.set_tesseract_binary()
+    start = time.perf_counter()
+    app = make_app()
+    print(f"OCR service ready in {time.perf_counter() - start:.2f} s, listening on {options.host}:{options.port}")
+    uvicorn.run(app, host=options.host, port=options.port)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
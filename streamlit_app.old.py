@@ -1,9 +1,24 @@
+import uuid
+from io import BytesIO
+
 import streamlit as st
 
 import helpers.constants as constants
+import helpers.incremental as incremental
+import helpers.jobs as jobs
+import helpers.metrics as metrics
+import helpers.ocrresult as ocrresult
+import helpers.offload as offload
 import helpers.opencv as opencv
 import helpers.pdfimage as pdfimage
+import helpers.pdfocr as pdfocr
+import helpers.pdftext as pdftext
+import helpers.quality as quality
+import helpers.regions as regions
+import helpers.resultcache as resultcache
+import helpers.searchablepdf as searchablepdf
 import helpers.tesseract as tesseract
+import helpers.tiling as tiling
 
 language_options_list = list(constants.languages_sorted.values())
 
@@ -35,6 +50,8 @@ def init_sidebar_values():
         st.session_state.timeout = 20
     if "cGrayscale" not in st.session_state:
         st.session_state.cGrayscale = True
+    if "cAutoPreprocess" not in st.session_state:
+        st.session_state.cAutoPreprocess = True
     if "cDenoising" not in st.session_state:
         st.session_state.cDenoising = False
     if "cDenoisingStrength" not in st.session_state:
@@ -43,6 +60,8 @@ def init_sidebar_values():
         st.session_state.cThresholding = False
     if "cThresholdLevel" not in st.session_state:
         st.session_state.cThresholdLevel = 128
+    if "cAutoRotate" not in st.session_state:
+        st.session_state.cAutoRotate = False
     if "cRotate90" not in st.session_state:
         st.session_state.cRotate90 = False
     if "angle90" not in st.session_state:
@@ -53,16 +72,153 @@ def init_sidebar_values():
         st.session_state.angle = 0
 
 
+@st.cache_data(show_spinner=False, max_entries=16)
+def plan_preprocessing(_image, digest):
+    '''Denoising and thresholding steps chosen by the quality triage and their reasons, planned once per image.
+    '''
+    return quality.triage(_image)
+
+
+def incremental_view(raw_image, digest, split_steps, shape):
+    '''Base image (preprocessing without crop and rotate90) and the view of it which is the preprocessed image.
+    Returns (None, None) if the pipeline produced an image of another size, e.g. autocrop before the filters.
+    '''
+    base_steps, view_steps = split_steps
+    base = opencv.apply_pipeline(raw_image, digest, opencv.Pipeline(base_steps).spec)
+    view = incremental.locate(base, view_steps)
+    left, top, right, bottom = view.box
+    if (bottom - top, right - left) != tuple(shape[:2]):
+        return (None, None)
+    return (base, view)
+
+
+def remember_full_pass(pages, base_key, cache_key, raw_image, digest, split_steps, shape):
+    '''Keep the OCR result of a full pass over a single image for incremental re-OCR after crop and rotate edits.
+    '''
+    snapshot = st.session_state.get("ocr_snapshot")
+    if not base_key or len(pages) != 1 or pages[0].engine != "tesseract" or (snapshot and snapshot[1] == cache_key):
+        return
+    base, view = incremental_view(raw_image, digest, split_steps, shape)
+    if base is not None:
+        st.session_state.ocr_snapshot = (base_key, cache_key, incremental.snapshot(pages[0], view, base.shape))
+
+
+def ocr_image_job(job, image, language_short, config, timeout, cache_key, text_regions=False):
+    '''Background job: OCR of a single preprocessed image, returns (pages, errors).
+    '''
+    job.set_progress(0.0, "Extracting Text...")
+    if text_regions:
+        # only the detected text blocks are OCRed, blank margins and photos are skipped
+        result, error = regions.ocr_regions(image, language_short=language_short, config=config, timeout=timeout)
+    else:
+        # one tesseract pass for text, boxes and confidences, very large scans are OCRed in overlapping tiles in parallel
+        result, error = tiling.ocr_image_result(image, language_short=language_short, config=config, timeout=timeout)
+    if error:
+        raise RuntimeError(error)
+    result_cache = resultcache.get_result_cache()
+    if result_cache:
+        result_cache.put(cache_key, ocrresult.pages_to_json([result]))
+    return ([result], [])
+
+
+def ocr_pdf_job(job, pdf_bytes, page_count, language_short, config, timeout, preprocess, use_text_layer, cache_key):
+    '''Background job: OCR of all pages of a PDF, returns (pages, errors).
+    Stops early if the job gets cancelled, e.g. by a newer job of the same session.
+    '''
+    pages, errors = [], []
+    results = pdfocr.ocr_pdf(
+        pdf_bytes=pdf_bytes,
+        language_short=language_short,
+        config=config,
+        timeout=timeout,
+        preprocess=preprocess,
+        structured=True,
+        use_text_layer=use_text_layer,
+        dpi=None,
+    )
+    try:
+        for page_number, result, error, source in results:
+            if job.cancelled:
+                return (None, [])
+            if error:
+                errors.append(f"Page {page_number}: {error}" if page_number else error)
+                continue
+            pages.append(result)
+            job.set_progress(page_number / page_count, f"Page {page_number} of {page_count} done ({source})")
+    finally:
+        results.close()
+    if errors and not pages:
+        raise RuntimeError("\n".join(errors))
+    result_cache = resultcache.get_result_cache()
+    if result_cache and not errors:
+        result_cache.put(cache_key, ocrresult.pages_to_json(pages))
+    return (pages, errors)
+
+
+def searchable_pdf_job(job, pdf_bytes, language_short, config, timeout, preprocess):
+    '''Background job: add an invisible OCR text layer to all pages of a PDF, returns (pdf bytes, stats).
+    '''
+    output = BytesIO()
+    stats, error = searchablepdf.make_searchable(
+        pdf_bytes,
+        output,
+        language_short=language_short,
+        config=config,
+        timeout=timeout,
+        preprocess=preprocess,
+        dpi=None,
+        progress=lambda page, count: job.set_progress(page / count, f"Page {page} of {count} done"),
+    )
+    if error:
+        raise RuntimeError(error)
+    return (output.getvalue(), stats)
+
+
+def show_searchable_pdf(pdf_out, stats, file_name):
+    st.success(f"{stats['ocr_pages']} pages OCRed, {stats['skipped_pages']} pages with text layer kept as they are.")
+    st.download_button(
+        label="Download Searchable PDF",
+        data=pdf_out,
+        file_name=file_name.rsplit(".", 1)[0] + ".ocr.pdf",
+        mime="application/pdf",
+    )
+
+
+def show_extracted_text(pages, errors, file_name):
+    for error in errors:
+        st.error(error)
+    text = ocrresult.render_pages(pages, "txt")
+    # which path produced the pages: embedded PDF text ("pdf-text") or OCR ("tesseract")
+    engines = [page.engine for page in pages]
+    if any(engine != "tesseract" for engine in engines):
+        st.caption(", ".join(f"Page {number}: {engine}" for number, engine in enumerate(engines, start=1)))
+    if text and text.strip():
+        st.text_area(label="Extracted Text", value=text, height=500)
+        # text, TSV, hOCR and JSON are all derived from the same OCR result
+        download_format = st.selectbox(label="Download format", options=ocrresult.formats)
+        st.download_button(
+            label="Download Extracted Text",
+            data=ocrresult.render_pages(pages, download_format).encode("utf-8"),
+            file_name=f"{file_name}.{download_format}",
+            mime=ocrresult.mime_types[download_format],
+        )
+    else:
+        st.warning("No text was extracted.")
+
+
 def reset_sidebar_values():
     '''Reset all sidebar values of buttons/sliders to default values.
     '''
     st.session_state.psm = tesseract.psm[3]
     st.session_state.timeout = 20
+    st.session_state.cTextRegions = True
     st.session_state.cGrayscale = True
+    st.session_state.cAutoPreprocess = True
     st.session_state.cDenoising = False
     st.session_state.cDenoisingStrength = 10
     st.session_state.cThresholding = False
     st.session_state.cThresholdLevel = 128
+    st.session_state.cAutoRotate = False
     st.session_state.cRotate90 = False
     st.session_state.angle90 = 0
     st.session_state.cRotateFree = False
@@ -78,6 +234,10 @@ st.set_page_config(
 
 # init tesseract
 tesseract_version = init_tesseract()
+# serve the metrics on OCR_METRICS_PORT, if it is set
+metrics.start_exporter()
+# spawn the preprocessing worker processes now, not on the first large upload
+offload.start()
 init_sidebar_values()
 
 # apply custom css
@@ -95,14 +255,21 @@ with st.sidebar:
     # oem = st.selectbox(label="OCR Engine mode (not working)", options=constants.oem, index=3, disabled=True)
     psm = st.selectbox(label="Page segmentation mode", options=tesseract.psm, key="psm")
     timeout = st.slider(label="Tesseract OCR timeout [sec]", min_value=1, max_value=60, value=20, step=1, key="timeout")
+    cTextRegions = st.checkbox(label="OCR only detected text regions", value=True, key="cTextRegions",
+                               help="Skips blank margins and photos, faster on sparse pages.")
     st.markdown("---")
     st.header("Image Preprocessing")
     st.write("Check the boxes below to apply preprocessing to the image.")
     cGrayscale = st.checkbox(label="Grayscale", value=True, key="cGrayscale")
-    cDenoising = st.checkbox(label="Denoising", value=False, key="cDenoising")
-    cDenoisingStrength = st.slider(label="Denoising Strength", min_value=1, max_value=40, value=10, step=1, key="cDenoisingStrength")
-    cThresholding = st.checkbox(label="Thresholding", value=False, key="cThresholding")
-    cThresholdLevel = st.slider(label="Threshold Level", min_value=0, max_value=255, value=128, step=1, key="cThresholdLevel")
+    cAutoPreprocess = st.checkbox(label="Automatic denoising and thresholding", value=True, key="cAutoPreprocess",
+                                  help="Measures noise, contrast and lighting of the image and applies only the filters it needs.")
+    cDenoising = st.checkbox(label="Denoising", value=False, key="cDenoising", disabled=cAutoPreprocess)
+    cDenoisingStrength = st.slider(label="Denoising Strength", min_value=1, max_value=40, value=10, step=1, key="cDenoisingStrength",
+                                   disabled=cAutoPreprocess)
+    cThresholding = st.checkbox(label="Thresholding", value=False, key="cThresholding", disabled=cAutoPreprocess)
+    cThresholdLevel = st.slider(label="Threshold Level", min_value=0, max_value=255, value=128, step=1, key="cThresholdLevel",
+                                disabled=cAutoPreprocess)
+    cAutoRotate = st.checkbox(label="Auto orientation and deskew", value=False, key="cAutoRotate")
     cRotate90 = st.checkbox(label="Rotate in 90° steps", value=False, key="cRotate90")
     angle90 = st.slider("Rotate rectangular [Degree]", min_value=0, max_value=270, value=0, step=90, key="angle90")
     cRotateFree = st.checkbox(label="Rotate in free degrees", value=False, key="cRotateFree")
@@ -124,6 +291,8 @@ if error:
     st.stop()
 
 raw_image, image = None, None
+auto_reasons = []
+pdf_bytes, page, page_count, cAllPages, cUseTextLayer = None, None, None, False, False
 
 col_upload_1, col_upload_2 = st.columns(spec=2, gap="small")
 with col_upload_2:
@@ -140,16 +309,17 @@ with col_upload_2:
     # add 4 columns with a slider each for cropping the image from the top, bottom, left, and right
     st.subheader("Image Cropping :scissors:")
     cCrop = st.checkbox("Crop Image", value=False)
-    with st.expander("Cropping by 0-40 percent from each side", expanded=cCrop):
+    with st.expander("Cropping to the text or by 0-40 percent from each side", expanded=cCrop):
+        cAutoCrop = st.checkbox("Auto crop to text", value=True, key="cAutoCrop")
         col_left, col_top, col_right, col_bottom = st.columns(spec=4, gap="small")
         with col_left:
-            crop_left = st.slider("Left %", min_value=0, max_value=40, step=1, key="crop_left")
+            crop_left = st.slider("Left %", min_value=0, max_value=40, step=1, key="crop_left", disabled=cAutoCrop)
         with col_top:
-            crop_top = st.slider("Top %", min_value=0, max_value=40, step=1, key="crop_top")
+            crop_top = st.slider("Top %", min_value=0, max_value=40, step=1, key="crop_top", disabled=cAutoCrop)
         with col_right:
-            crop_right = st.slider("Right %", min_value=0, max_value=40, step=1, key="crop_right")
+            crop_right = st.slider("Right %", min_value=0, max_value=40, step=1, key="crop_right", disabled=cAutoCrop)
         with col_bottom:
-            crop_bottom = st.slider("Bottom %", min_value=0, max_value=40, step=1, key="crop_bottom")
+            crop_bottom = st.slider("Bottom %", min_value=0, max_value=40, step=1, key="crop_bottom", disabled=cAutoCrop)
 
 with col_upload_1:
     # upload image
@@ -161,8 +331,18 @@ with col_upload_1:
     if uploaded_file is not None:
         # check if uploaded file is pdf
         if uploaded_file.name.lower().endswith(".pdf"):
-            page = st.number_input("Select Page of PDF", min_value=1, max_value=100, value=1, step=1)
-            raw_image, error = pdfimage.pdftoimage(pdf_file=uploaded_file, page=page)
+            pdf_bytes = uploaded_file.getvalue()
+            page_count, error = pdfimage.get_page_count(pdf_bytes)
+            if error:
+                st.error(error)
+                st.stop()
+            page = st.number_input("Select Page of PDF", min_value=1, max_value=page_count, value=1, step=1)
+            cAllPages = st.checkbox(f"OCR all {page_count} pages of the PDF", value=False)
+            cUseTextLayer = st.checkbox(
+                "Use the embedded text of pages with a text layer (no OCR)", value=pdftext.available, disabled=not pdftext.available
+            )
+            # rendered gray right away if the pipeline converts to gray anyway, resolution from page size and text height
+            raw_image, error = pdfimage.pdftoimage(pdf_file=uploaded_file, page=page, grayscale=cGrayscale, dpi=None)
             if error:
                 st.error(error)
                 st.stop()
@@ -180,21 +360,35 @@ with col_upload_1:
                 st.stop()
         try:
             with st.spinner("Preprocessing Image..."):
-                image = raw_image.copy()
-                # apply image preprocessing
+                # collect the selected preprocessing steps, the pipeline runs them in one pass
+                steps = []
+                digest = opencv.image_digest(raw_image)
                 if cGrayscale:
-                    image = opencv.grayscale(img=image)
-                if cDenoising:
-                    image = opencv.denoising(img=image, strength=cDenoisingStrength)
-                if cThresholding:
-                    image = opencv.thresholding(img=image, threshold=cThresholdLevel)
+                    steps.append(("grayscale", {}))
+                if cAutoPreprocess:
+                    # the expensive filters only if the measured noise, contrast and lighting need them
+                    auto_steps, auto_reasons = plan_preprocessing(raw_image, digest)
+                    steps.extend(auto_steps)
+                else:
+                    if cDenoising:
+                        steps.append(("denoising", {"strength": cDenoisingStrength}))
+                    if cThresholding:
+                        steps.append(("thresholding", {"threshold": cThresholdLevel}))
+                if cAutoRotate:
+                    # tesseract OSD for 90 degree steps, then the skew angle estimated on a small copy
+                    steps.append(("orient", {"timeout": timeout}))
+                    steps.append(("deskew", {}))
                 if cRotate90:
-                    angle90 = opencv.angles.get(angle90, None)  # convert angle to opencv2 enum
-                    image = opencv.rotate90(img=image, rotate=angle90)
+                    steps.append(("rotate90", {"angle": angle90}))
                 if cRotateFree:
-                    image = opencv.rotate_scipy(img=image, angle=angle, reshape=True)
-                if cCrop:
-                    image = opencv.crop(img=image, left=crop_left, right=crop_right, top=crop_top, bottom=crop_bottom)
+                    steps.append(("rotate_scipy", {"angle": angle, "reshape": True}))
+                if cCrop and cAutoCrop:
+                    # bounding box of the detected text lines, no guessing of percentages
+                    steps.append(("autocrop", {}))
+                elif cCrop:
+                    steps.append(("crop", {"left": crop_left, "right": crop_right, "top": crop_top, "bottom": crop_bottom}))
+                pipeline = opencv.Pipeline(steps)
+                image = opencv.apply_pipeline(raw_image, digest, pipeline.spec)
         except Exception as e:
             st.error(str(e))
             st.stop()
@@ -207,38 +401,145 @@ col1, col2 = st.columns(spec=2, gap="small")
 with col1:
     st.subheader("Preview after Upload :eye:")
     if raw_image is not None:
-        raw_image = opencv.convert_to_rgb(raw_image)  # convert BGR to RGB
-        st.image(raw_image, caption="Image Preview after Upload", use_column_width=True)
+        # streamlit swaps the channels while encoding the preview, no RGB copy of the image is kept
+        st.image(raw_image, caption="Image Preview after Upload", use_column_width=True, channels="BGR")
 
 with col2:
     st.subheader("Preview after Preprocessing :eye:")
     if image is not None:
-        image = opencv.convert_to_rgb(image) # convert BGR to RGB
-        st.image(image, caption="Image Preview after Preprocessing", use_column_width=True)
+        st.image(image, caption="Image Preview after Preprocessing", use_column_width=True, channels="BGR")
+        if auto_reasons:
+            st.caption("Automatic preprocessing: " + "; ".join(auto_reasons))
 
 if image is not None:
     st.markdown("---")
     st.subheader("Run OCR on preprocessed image :mag_right:")
 
-    if st.button("Extract Text"):
-        with st.spinner("Extracting Text..."):
-            text, error = tesseract.image_to_string(
-                image=image,
-                language_short=language_short,
-                config=custom_oem_psm_config,
-                timeout=timeout,
-            )
+    # OCR runs as background job, the script only polls its status and stays responsive
+    job_queue = jobs.get_job_queue()
+    if "session_id" not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex
+    # persistent result cache, keyed by the uploaded bytes and all OCR settings
+    result_cache = resultcache.get_result_cache()
+    cache_key = resultcache.make_key(
+        uploaded_file.getbuffer(),
+        "tesseract.result",
+        language_short,
+        custom_oem_psm_config,
+        ("all" if cAllPages else page, pipeline.spec, cUseTextLayer, cTextRegions and not cAllPages),
+    )
+    ocr_job = st.session_state.get("ocr_job")
+    if ocr_job and ocr_job[1] != cache_key:
+        # settings changed since the job was submitted, its result is not needed anymore
+        job_queue.cancel(ocr_job[0])
+        st.session_state.ocr_job = ocr_job = None
+
+    # crop and rotate90 edits of a single image are answered from the last full OCR pass over the same base image
+    split_steps = incremental.split_steps(steps) if not cAllPages else None
+    base_key = None
+    if split_steps:
+        base_key = resultcache.make_key(
+            uploaded_file.getbuffer(),
+            "tesseract.base",
+            language_short,
+            custom_oem_psm_config,
+            (page, opencv.Pipeline(split_steps[0]).spec, cUseTextLayer, cTextRegions),
+        )
+    ocr_snapshot = st.session_state.get("ocr_snapshot")
+    ocr_cached = st.session_state.get("ocr_cached")
+    if (base_key and ocr_snapshot and ocr_snapshot[0] == base_key and ocr_snapshot[1] != cache_key and not ocr_job
+            and not (ocr_cached and ocr_cached[0] == cache_key)):
+        base, view = incremental_view(raw_image, digest, split_steps, image.shape)
+        if base is not None:
+            with st.spinner("Updating the text of the last OCR..."):
+                result, reread, error = incremental.derive(
+                    ocr_snapshot[2], base, view, language_short, custom_oem_psm_config, timeout
+                )
             if error:
-                st.error(error)
+                st.warning(error)
+            elif result is not None:
+                # not stored in the result cache, "Extract Text" still runs a full OCR of the new view
+                st.session_state.ocr_cached = (cache_key, [result])
+                st.session_state.ocr_derived = (cache_key, reread)
+
+    if st.button("Extract Text"):
+        st.session_state.ocr_derived = None
+        pages = None
+        if cUseTextLayer and not cAllPages:
+            # a born digital page needs no rasterization and OCR, its text is read from the PDF directly
+            triage, error = pdftext.triage_pdf(pdf_bytes, first_page=page, last_page=page)
+            if not error and triage and triage[0].source == pdftext.TEXT:
+                pages = [triage[0].result()]
+        if pages is None:
+            cached = result_cache.get(cache_key) if result_cache else None
+            pages = ocrresult.pages_from_json(cached) if cached is not None else None
+        if pages is not None:
+            st.session_state.ocr_job = ocr_job = None
+            # kept in the session, so changing the download format does not hide the result
+            st.session_state.ocr_cached = (cache_key, pages)
+            remember_full_pass(pages, base_key, cache_key, raw_image, digest, split_steps, image.shape)
+        else:
+            try:
+                if cAllPages:
+                    # whole document mode, pages are rasterized and OCRed in parallel
+                    job_id = job_queue.submit(
+                        ocr_pdf_job, pdf_bytes, page_count, language_short, custom_oem_psm_config, timeout, pipeline,
+                        cUseTextLayer, cache_key, priority=1, group=st.session_state.session_id,
+                    )
+                else:
+                    job_id = job_queue.submit(
+                        ocr_image_job, image, language_short, custom_oem_psm_config, timeout, cache_key, cTextRegions,
+                        group=st.session_state.session_id,
+                    )
+            except jobs.JobQueueFull as e:
+                st.warning(str(e))
                 st.stop()
-            elif text:
-                st.text_area(label="Extracted Text", value=text, height=500)
-                st.download_button(
-                    label="Download Extracted Text",
-                    data=text.encode("utf-8"),
-                    file_name=uploaded_file.name + ".txt",
-                    mime="text/plain",
+            st.session_state.ocr_job = ocr_job = (job_id, cache_key, "text")
+            st.session_state.ocr_cached = None
+
+    if pdf_bytes is not None and searchablepdf.available:
+        # the whole PDF with an invisible text layer, from the same single OCR pass per page
+        if st.button("Create Searchable PDF", disabled=not pipeline.pixelwise,
+                     help="Not available with cropping or rotation, the text layer must match the original pages."):
+            try:
+                job_id = job_queue.submit(
+                    searchable_pdf_job, pdf_bytes, language_short, custom_oem_psm_config, timeout,
+                    pipeline if pipeline.steps else None, priority=1, group=st.session_state.session_id,
                 )
-            else:
-                st.warning("No text was extracted.")
+            except jobs.JobQueueFull as e:
+                st.warning(str(e))
                 st.stop()
+            st.session_state.ocr_job = ocr_job = (job_id, cache_key, "pdf")
+            st.session_state.ocr_cached = None
+
+    ocr_cached = st.session_state.get("ocr_cached")
+    if not ocr_job and ocr_cached and ocr_cached[0] == cache_key:
+        ocr_derived = st.session_state.get("ocr_derived")
+        if ocr_derived and ocr_derived[0] == cache_key:
+            st.caption(f"Derived from the last OCR, {ocr_derived[1]} lines cut by the crop were read again. "
+                       "Extract Text runs a full OCR.")
+        show_extracted_text(ocr_cached[1], [], uploaded_file.name)
+
+    if ocr_job:
+        job = job_queue.poll(ocr_job[0])
+        if job is None:
+            st.session_state.ocr_job = None
+        else:
+            if not job.finished:
+                progress = st.progress(job.progress, text=job.message or "Extracting Text...")
+                st.button("Cancel", on_click=job_queue.cancel, args=(job.id,))
+                # a rerun stops this loop at the next streamlit call, the job keeps running
+                while not job.wait(0.25):
+                    progress.progress(job.progress, text=job.message or "Extracting Text...")
+                progress.empty()
+            if job.status == jobs.DONE and ocr_job[2] == "pdf":
+                show_searchable_pdf(*job.result, uploaded_file.name)
+            elif job.status == jobs.DONE:
+                pages, errors = job.result
+                show_extracted_text(pages, errors, uploaded_file.name)
+                if not errors:
+                    remember_full_pass(pages, base_key, cache_key, raw_image, digest, split_steps, image.shape)
+            elif job.status == jobs.CANCELLED:
+                st.info("Text extraction was cancelled.")
+            else:
+                st.error(job.error)
@@ -1,9 +1,15 @@
 import streamlit as st
-from PIL import Image
-import os
-import tempfile
-import easyocr
+import uuid
+import cv2
+import numpy as np
 import helpers.constants as constants
+import helpers.easy_ocr as easy_ocr
+import helpers.engines as engines
+import helpers.jobs as jobs
+import helpers.metrics as metrics
+import helpers.ocrresult as ocrresult
+import helpers.opencv as opencv
+import helpers.resultcache as resultcache
 import helpers.tesseract as tesseract
 
 language_options_list = list(constants.languages_sorted.values())
@@ -25,27 +31,61 @@ def init_tesseract():
         st.stop()
     return tess_version
 
-def read_text_from_image(image_path, language='az'):
+def read_result_from_image(image: np.ndarray, language='az'):
     """
-    Read text from an image file using EasyOCR.
+    Read words with boxes and confidences from an image using EasyOCR.
 
     Args:
-    - image_path (str): Path to the image file.
+    - image (np.ndarray): Decoded RGB image.
     - language (str): Language code (e.g., 'en' for English, 'az' for Azerbaijani).
 
     Returns:
-    - text (str): Extracted text from the image.
+    - result (OcrResult): Words, boxes, confidences and lines of the image.
     """
-    # Initialize the EasyOCR reader
-    reader = easyocr.Reader([language])
+    # Get the shared EasyOCR reader, it is loaded only once per process
+    reader = easy_ocr.easyocr_reader(language)
 
     # Process the image
-    result = reader.readtext(image_path)
+    with metrics.timed("easyocr.readtext", image):
+        result = reader.readtext(image)
+
+    # Keep boxes and confidences, text and the other formats are derived from it
+    return easy_ocr.easyocr_get_ocr_result(result, image)
+
+def read_text_from_image(image: np.ndarray, language='az'):
+    """
+    Read text from an image using EasyOCR.
 
-    # Extract text from the result
-    text = ' '.join([box[1] for box in result])
+    Args:
+    - image (np.ndarray): Decoded RGB image.
+    - language (str): Language code (e.g., 'en' for English, 'az' for Azerbaijani).
+
+    Returns:
+    - text (str): Extracted text from the image.
+    """
+    return read_result_from_image(image, language=language).to_text()
 
-    return text
+def easyocr_job(job, data, language, cache_key, engine_name="easyocr", text_regions=False):
+    """
+    Background job: decode the uploaded bytes in memory and read the text with the chosen engine.
+    EasyOCR alone, Tesseract alone, both with per region voting ("ensemble") or Tesseract with
+    EasyOCR only for its low confidence lines ("fast_path"), see helpers/engines.py.
+    """
+    job.set_progress(0.0, "Processing...")
+    # Decode the upload buffer in memory, no temporary file is written
+    image = opencv.decode_image(data)
+    # EasyOCR expects RGB arrays, convert in place
+    cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=image)
+    if engine_name == "easyocr" and not text_regions:
+        result = read_result_from_image(image, language=constants.languages_easyocr[language])
+    else:
+        result, error = engines.get_engine(engine_name, regions=text_regions).recognize(image, language)
+        if error:
+            raise RuntimeError(error)
+    result_cache = resultcache.get_result_cache()
+    if result_cache:
+        result_cache.put(cache_key, result.to_json())
+    return result
 
 # Streamlit config
 st.set_page_config(
@@ -58,6 +98,15 @@ st.set_page_config(
 # Init Tesseract (if needed for other purposes)
 tesseract_version = init_tesseract()
 
+# Serve the metrics on OCR_METRICS_PORT, if it is set
+metrics.start_exporter()
+
+# Torch threads per OCR job worker, so concurrent jobs do not oversubscribe the cores
+easy_ocr.configure_torch_threads(workers=jobs.default_workers)
+
+# Warm up the EasyOCR reader, so the first upload does not pay for loading the model
+easy_ocr.registry.warmup('az')
+
 # Streamlit app
 st.title("B-Rabbit: OCR for 🇦🇿")
 
@@ -67,27 +116,65 @@ uploaded_file = st.file_uploader(
     accept_multiple_files=False
 )
 lang = 'aze'  # Fixed language option
+engine_labels = {
+    "easyocr": "EasyOCR",
+    "tesseract": "Tesseract",
+    "ensemble": "Ensemble (Tesseract + EasyOCR, best per region)",
+    "fast_path": "Fast path (Tesseract, EasyOCR for low confidence lines)",
+}
+engine_name = st.selectbox("OCR engine", engines.engine_names, format_func=engine_labels.get)
+# Blank margins and photos are skipped, only the detected text lines are read
+text_regions = st.checkbox("Read only detected text regions (faster on sparse pages)", value=False)
 
 if uploaded_file is not None:
     if uploaded_file.size > 200 * 1024 * 1024:  # 200 MB limit
         st.error("File size exceeds 200 MB limit. Please upload a smaller file.")
     else:
-        with st.spinner("Processing..."):
-            # Process image file
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".png") as temp_image:
-                temp_image.write(uploaded_file.getbuffer())
-                temp_image_path = temp_image.name
-            extracted_text = read_text_from_image(temp_image_path, language='az')
-            os.remove(temp_image_path)
+        # Repeated uploads are answered from the persistent result cache
+        result_cache = resultcache.get_result_cache()
+        # the EasyOCR models differ per backend (torch or the exported ONNX models), so does their result
+        engine_key = engine_name if engine_name == "tesseract" else f"{engine_name}.{easy_ocr.backend}"
+        cache_key = resultcache.make_key(uploaded_file.getbuffer(), f"{engine_key}.result", lang, preprocessing=("regions",) if text_regions else None)
+        cached = result_cache.get(cache_key) if result_cache else None
+        ocr_result = ocrresult.OcrResult.from_json(cached) if cached is not None else None
+        if ocr_result is None:
+            # OCR runs as background job, the script only polls it, a new upload supersedes the old job
+            job_queue = jobs.get_job_queue()
+            if "session_id" not in st.session_state:
+                st.session_state.session_id = uuid.uuid4().hex
+            ocr_job = st.session_state.get("ocr_job")
+            if not ocr_job or ocr_job[1] != cache_key or job_queue.poll(ocr_job[0]) is None:
+                try:
+                    job_id = job_queue.submit(
+                        easyocr_job, uploaded_file.getvalue(), lang, cache_key, engine_name, text_regions, group=st.session_state.session_id
+                    )
+                except jobs.JobQueueFull as e:
+                    st.warning(str(e))
+                    st.stop()
+                st.session_state.ocr_job = ocr_job = (job_id, cache_key)
+            job = job_queue.poll(ocr_job[0])
+            if not job.finished:
+                progress = st.progress(job.progress, text="Processing...")
+                # a rerun stops this loop at the next streamlit call, the job keeps running
+                while not job.wait(0.25):
+                    progress.progress(job.progress, text="Processing...")
+                progress.empty()
+            if job.status != jobs.DONE:
+                st.error("Exception during Text Extraction")
+                st.error(f"Error Message: {job.error}")
+                st.stop()
+            ocr_result = job.result
+        extracted_text = ocr_result.to_text()
         
         # Display the extracted text
         st.subheader("Extracted Text")
         st.text_area("", extracted_text, height=400)
         
-        # Option to download the extracted text
+        # Option to download the extracted text, or the words with boxes and confidences
+        download_format = st.selectbox("Download format", list(ocrresult.formats))
         st.download_button(
             label="Download Text",
-            data=extracted_text,
-            file_name="extracted_text.txt",
-            mime="text/plain"
+            data=ocrresult.render_pages([ocr_result], download_format),
+            file_name=f"extracted_text.{download_format}",
+            mime=ocrresult.mime_types[download_format]
         )
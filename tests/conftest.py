@@ -0,0 +1,6 @@
+import os
+import sys
+
+
+# the tests import the helpers like the apps do, from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
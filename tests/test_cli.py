@@ -0,0 +1,37 @@
+import io
+import tarfile
+import zipfile
+
+import cli
+
+
+def write_archives(tmp_path, members: dict) -> tuple[str, str]:
+    tar_path, zip_path = tmp_path / "scans.tar.gz", tmp_path / "scans.zip"
+    with tarfile.open(tar_path, "w:gz") as archive:
+        for name, data in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+    with zipfile.ZipFile(zip_path, "w") as archive:
+        for name, data in members.items():
+            archive.writestr(name, data)
+    return (str(tar_path), str(zip_path))
+
+
+def test_archive_members_are_read_once(tmp_path, monkeypatch):
+    members = {f"page{i}.png": f"pixels {i}".encode() for i in range(5)}
+    members["notes.txt"] = b"not an image"
+    tar_path, zip_path = write_archives(tmp_path, members)
+    opened = []
+    open_tar, open_zip = cli.tarfile.open, cli.zipfile.ZipFile
+    monkeypatch.setattr(cli.tarfile, "open", lambda *args, **kwargs: opened.append("tar") or open_tar(*args, **kwargs))
+    monkeypatch.setattr(cli.zipfile, "ZipFile", lambda *args, **kwargs: opened.append("zip") or open_zip(*args, **kwargs))
+
+    tasks = list(cli.collect_tasks([tar_path, zip_path]))
+    assert sorted(task.relname for task in tasks) == sorted(
+        f"{archive}/page{i}.png" for archive in ("scans.tar.gz", "scans.zip") for i in range(5)
+    )
+    for task in tasks:
+        assert cli.read_task(task) == members[task.member]
+    # one pass over the tar, the zip is listed once and opened once more for all reads
+    assert opened == ["tar", "zip", "zip"]
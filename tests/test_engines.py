@@ -0,0 +1,56 @@
+import numpy as np
+import pytesseract
+import pytest
+
+import helpers.engines as engines
+import helpers.ocrresult as ocrresult
+import helpers.tesseract as tesseract
+
+
+def first_pixel(image, lang, output_type, config, timeout):
+    """Reads the color of the first pixel of the PNM file as hex word."""
+    with open(image, "rb") as file:
+        pixels = file.read().split(b"\n", 3)[3]
+    return {
+        "level": [5], "text": [pixels[:3].hex()], "conf": [90], "left": [0], "top": [0], "width": [1], "height": [1],
+        "block_num": [1], "par_num": [1], "line_num": [1], "word_num": [1],
+    }
+
+
+def test_tesseract_engine_reads_rgb(monkeypatch):
+    monkeypatch.setattr(tesseract, "backend", "pytesseract")
+    monkeypatch.setattr(pytesseract, "image_to_data", first_pixel)
+    red = np.zeros((8, 8, 3), dtype=np.uint8)
+    red[..., 0] = 255
+    result, error = engines.TesseractEngine().recognize(red, "eng")
+    assert error is None
+    assert result.text.tolist() == ["ff0000"]
+    # the helpers themselves take BGR
+    result, _ = tesseract.extract_result(image=red[..., ::-1], language_short="eng", config="", timeout=1)
+    assert result.text.tolist() == ["ff0000"]
+
+
+def test_engine_is_abstract():
+    class Incomplete(engines.Engine):
+        pass
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def test_ensemble_keeps_its_executor():
+    class Fixed(engines.Engine):
+        def __init__(self, name, conf):
+            self.name, self.conf = name, conf
+
+        def recognize(self, image, language_short, timeout=None):
+            return (ocrresult.OcrResult(["word"], [0], [0], [10], [10], [self.conf], image_width=10, image_height=10, engine=self.name), None)
+
+    ensemble = engines.EnsembleEngine(Fixed("a", 0.5), Fixed("b", 0.9))
+    executor = ensemble._executor
+    for _ in range(3):
+        result, error = ensemble.recognize(np.zeros((10, 10), dtype=np.uint8), "eng")
+        assert error is None
+        assert result.engine == "a+b"
+        assert result.conf.tolist() == [np.float32(0.9)]
+    assert ensemble._executor is executor
@@ -0,0 +1,74 @@
+import threading
+
+import pytest
+
+import helpers.jobs as jobs
+
+
+def blocker():
+    """A job function which runs until the returned event is set."""
+    release, started = threading.Event(), threading.Event()
+
+    def run(job):
+        started.set()
+        release.wait(5)
+        return "blocked"
+
+    return run, release, started
+
+
+def test_lower_priority_values_run_first():
+    queue = jobs.JobQueue(workers=1)
+    run, release, started = blocker()
+    first = queue.submit(run)
+    assert started.wait(5)
+    order = []
+    ids = [
+        queue.submit(lambda job, name: order.append(name), name, priority=priority)
+        for name, priority in (("low", 5), ("high", 1), ("mid", 3))
+    ]
+    release.set()
+    for job_id in [first] + ids:
+        queue.result(job_id, timeout=5)
+    assert order == ["high", "mid", "low"]
+
+
+def test_newer_job_of_a_group_cancels_the_older():
+    queue = jobs.JobQueue(workers=1)
+    run, release, started = blocker()
+    running = queue.submit(run, group="session-1")
+    assert started.wait(5)
+    queued = queue.submit(lambda job: "old", group="session-1")
+    latest = queue.submit(lambda job: "new", group="session-1")
+    assert queue.poll(queued).status == jobs.CANCELLED
+    assert queue.poll(running).cancelled
+    release.set()
+    assert queue.result(latest, timeout=5) == ("new", None)
+    assert queue.poll(running).status == jobs.CANCELLED
+    assert queue.result(queued, timeout=5) == (None, "Job was cancelled.")
+
+
+def test_full_queue_rejects_jobs():
+    queue = jobs.JobQueue(workers=1, max_queued=2)
+    run, release, started = blocker()
+    queue.submit(run)
+    assert started.wait(5)
+    queue.submit(lambda job: None)
+    queue.submit(lambda job: None)
+    with pytest.raises(jobs.JobQueueFull):
+        queue.submit(lambda job: None)
+    release.set()
+
+
+def test_superseded_jobs_free_the_queue():
+    queue = jobs.JobQueue(workers=1, max_queued=4)
+    run, release, started = blocker()
+    queue.submit(run)
+    assert started.wait(5)
+    payload = b"upload" * 1000
+    ids = [queue.submit(lambda job, data: len(data), payload, group="session-1") for _ in range(10)]
+    assert queue.queued() == 1
+    assert list(queue._calls) == [ids[-1]]
+    release.set()
+    assert queue.result(ids[-1], timeout=5) == (len(payload), None)
+    assert queue.queued() == 0
@@ -0,0 +1,29 @@
+import cv2
+import numpy as np
+
+import helpers.offload as offload
+import helpers.opencv as opencv
+
+
+def test_cheap_steps_run_inline(monkeypatch):
+    monkeypatch.setattr(offload, "max_workers", 2)
+    dispatched = []
+    monkeypatch.setattr(offload, "run_steps", lambda img, steps: dispatched.append([name for name, _ in steps]) or img)
+    img = np.full((2000, 1500), 255, dtype=np.uint8)
+    assert offload.use_pool(img)
+    opencv.Pipeline([("dilate", {}), ("erode", {}), ("opening", {}), ("denoising", {"strength": 5})]).run(img)
+    assert dispatched == [["denoising"]]
+
+
+def test_app_threads_are_configured_with_the_workers(monkeypatch):
+    default, workers, threads = cv2.getNumThreads(), offload.max_workers, offload.threads
+    monkeypatch.setattr(offload, "_get_pool", lambda: type("Pool", (), {"submit": lambda self, fn: None})())
+    try:
+        offload.configure(workers=2, threads_per_process=1)
+        offload.start()
+        assert cv2.getNumThreads() == 1
+        offload.configure(workers=0)
+        assert cv2.getNumThreads() == default
+    finally:
+        offload.configure(workers=workers, threads_per_process=threads)
+        cv2.setNumThreads(default)
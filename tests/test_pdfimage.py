@@ -0,0 +1,20 @@
+import numpy as np
+from PIL import Image
+
+import helpers.pdfimage as pdfimage
+
+
+def test_previews_of_a_batch_in_one_call(monkeypatch):
+    calls = []
+
+    def convert_from_bytes(pdf_file, dpi, first_page, last_page, grayscale=False, **kwargs):
+        calls.append((dpi, first_page, last_page))
+        return [Image.fromarray(np.full((60, 40), 255, dtype=np.uint8)) for _ in range(first_page, last_page + 1)]
+
+    monkeypatch.setattr(pdfimage.pdf2image, "convert_from_bytes", convert_from_bytes)
+    monkeypatch.setattr(pdfimage, "get_page_sizes", lambda pdf_bytes: ([(595.0, 842.0)] * 40, None))
+    pages = [page for page in range(1, 41) if page != 20]
+    assert [page for page, _ in pdfimage.iter_pages(b"%PDF-", dpi=None, pages=pages, batch_size=8)] == pages
+    previews = [(first, last) for dpi, first, last in calls if dpi == pdfimage.preview_dpi]
+    # chunks of preview_batch pages, split at the missing page 20
+    assert previews == [(1, 16), (17, 19), (21, 33), (34, 40)]
@@ -0,0 +1,19 @@
+import numpy as np
+import pymupdf
+
+import helpers.pdftext as pdftext
+
+
+def test_caption_on_photo_is_ocred():
+    """A visible caption over a large photo does not hide the photo from OCR."""
+    doc = pymupdf.open()
+    page = doc.new_page(width=595, height=842)
+    page.insert_text((50, 60), "A text page with a photo and a caption on top of it.")
+    pixmap = pymupdf.Pixmap(pymupdf.csGRAY, pymupdf.IRect(0, 0, 400, 300), False)
+    pixmap.set_rect(pixmap.irect, (128,))
+    page.insert_image(pymupdf.Rect(50, 100, 545, 470), pixmap=pixmap)
+    page.insert_text((60, 460), "Photo")
+    pages, error = pdftext.triage_pdf(doc.tobytes())
+    assert error is None
+    assert pages[0].source == pdftext.MIXED
+    assert np.allclose(pages[0].regions[0], (50, 100, 545, 470), atol=1)
@@ -0,0 +1,39 @@
+import cv2
+import numpy as np
+
+import helpers.ocrresult as ocrresult
+import helpers.quality as quality
+import helpers.tesseract as tesseract
+import helpers.tiling as tiling
+
+
+def test_blank_page_is_not_thresholded():
+    for gray in (255, 250, 0):
+        steps, reasons = quality.plan(quality.measure(np.full((1200, 900), gray, dtype=np.uint8)))
+        assert not any(name == "thresholding" for name, _ in steps), reasons
+    blank = np.full((1200, 900), 255, dtype=np.uint8)
+    assert (quality.AutoPipeline()(blank) == 255).all()
+
+
+def test_low_contrast_page_is_thresholded():
+    page = np.full((1200, 900), 150, dtype=np.uint8)
+    for row in range(100, 1100, 60):
+        cv2.putText(page, "faded text line", (50, row), cv2.FONT_HERSHEY_SIMPLEX, 1.2, 110, 2)
+    steps, reasons = quality.plan(quality.measure(page))
+    assert ("thresholding", {"method": "otsu"}) in steps, reasons
+
+
+def test_tiles_share_one_plan(monkeypatch):
+    monkeypatch.setattr(tiling, "max_pixels", 1_000_000)
+    # left half clean, right half faded: planned per tile they would get different filters
+    page = np.full((1500, 3000), 255, dtype=np.uint8)
+    page[:, 1500:] = 150
+    planned, tiles = [], []
+    triage = quality.triage
+    monkeypatch.setattr(quality, "triage", lambda img: planned.append(img.shape) or triage(img))
+    monkeypatch.setattr(tesseract, "extract_result", lambda image, **kwargs: tiles.append(image) or (ocrresult.OcrResult(
+        image_width=image.shape[1], image_height=image.shape[0]), None))
+    result, error = tiling.ocr_image_result(page, "eng", "", 1, preprocess=quality.AutoPipeline())
+    assert error is None
+    assert planned == [page.shape]
+    assert len(tiles) > 1
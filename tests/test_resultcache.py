@@ -0,0 +1,12 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import helpers.resultcache as resultcache
+
+
+def test_counters_from_many_threads(tmp_path):
+    cache = resultcache.ResultCache(path=str(tmp_path / "results.sqlite"))
+    cache.put("hit", "text")
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda i: cache.get("hit" if i % 2 else "miss"), range(2000)))
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (1000, 1000, 1)
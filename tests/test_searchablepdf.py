@@ -0,0 +1,59 @@
+import io
+
+import pymupdf
+
+import helpers.ocrresult as ocrresult
+import helpers.pdfocr as pdfocr
+import helpers.pdftext as pdftext
+import helpers.searchablepdf as searchablepdf
+
+
+def scanned_pdf() -> bytes:
+    """One A4 page covered by a blank scan image, without any text."""
+    doc = pymupdf.open()
+    page = doc.new_page(width=595, height=842)
+    pixmap = pymupdf.Pixmap(pymupdf.csGRAY, pymupdf.IRect(0, 0, 1240, 1754), False)
+    pixmap.set_rect(pixmap.irect, (255,))
+    page.insert_image(page.rect, pixmap=pixmap)
+    return doc.tobytes()
+
+
+def fake_ocr_page(img, language_short, config, timeout, preprocess=None, structured=False):
+    """A sparse page: two short lines of words on a large image."""
+    height, width = img.shape[:2]
+    result = ocrresult.OcrResult(
+        text=["Invoice", "No", "42", "Total:", "17.50"],
+        left=[200, 500, 600, 200, 500], top=[200, 200, 200, 2000, 2000], width=[280, 80, 80, 240, 200], height=[50] * 5,
+        conf=[0.9] * 5, line=[0, 0, 0, 1, 1], word=[0, 1, 2, 0, 1], image_width=width, image_height=height, engine="tesseract",
+    )
+    return (result, None)
+
+
+def test_make_searchable_round_trip(monkeypatch):
+    monkeypatch.setattr(pdfocr, "ocr_page", fake_ocr_page)
+    first = io.BytesIO()
+    stats, error = searchablepdf.make_searchable(scanned_pdf(), first, "eng", "", 1, max_workers=1)
+    assert error is None
+    assert (stats["ocr_pages"], stats["words"]) == (1, 5)
+
+    pages, error = pdftext.triage_pdf(first.getvalue())
+    assert error is None
+    assert pages[0].source == pdftext.TEXT
+    assert pages[0].regions == []
+
+    second = io.BytesIO()
+    stats, error = searchablepdf.make_searchable(first.getvalue(), second, "eng", "", 1, max_workers=1)
+    assert error is None
+    assert (stats["ocr_pages"], stats["skipped_pages"]) == (0, 1)
+    with pymupdf.open(stream=second.getvalue(), filetype="pdf") as doc:
+        assert doc[0].get_text("text").split() == ["Invoice", "No", "42", "Total:", "17.50"]
+
+
+
+def test_text_layer_keeps_azerbaijani_letters():
+    words = ["Əli", "şəhər", "Ağdam"]
+    result = ocrresult.OcrResult(words, [10, 200, 400], [10, 10, 10], [150, 150, 150], [40, 40, 40], [0.9] * 3, image_width=600, image_height=100)
+    with pymupdf.open() as doc:
+        page = doc.new_page(width=300, height=50)
+        assert searchablepdf.insert_text_layer(page, result, scale=0.5) == 3
+        assert page.get_text("text").split() == words
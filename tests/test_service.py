@@ -0,0 +1,203 @@
+import asyncio
+import threading
+import time
+
+import cv2
+import numpy as np
+import pymupdf
+import pytest
+
+import helpers.engines as engines
+import helpers.ocrresult as ocrresult
+import helpers.pdfimage as pdfimage
+import service
+
+
+class StubEngine(engines.Engine):
+    """Reads every image as one word after delay seconds."""
+
+    name = "stub"
+
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.calls = 0
+        self.timeouts = []
+
+    def recognize(self, image, language_short, timeout=None):
+        self.calls += 1
+        self.image = image
+        self.timeouts.append(timeout)
+        time.sleep(self.delay)
+        height, width = image.shape[:2]
+        return (ocrresult.OcrResult(text=["stub"], left=[0], top=[0], width=[width], height=[height], conf=[0.9],
+                                    image_width=width, image_height=height, engine=self.name), None)
+
+
+def make_client(delay: float = 0.0, workers: int = 2) -> tuple[service.LocalClient, StubEngine]:
+    engine = StubEngine(delay)
+    app = service.make_app(service.OcrService(max_workers=workers, engine_factory=lambda *args, **kwargs: engine))
+    return (service.LocalClient(app), engine)
+
+
+def png() -> bytes:
+    return cv2.imencode(".png", np.full((32, 48), 255, dtype=np.uint8))[1].tobytes()
+
+
+def pdf() -> bytes:
+    """Page 1 and 3 are scans without text, page 2 has a text layer."""
+    doc = pymupdf.open()
+    for number in (1, 2, 3):
+        page = doc.new_page(width=200, height=200)
+        if number == 2:
+            page.insert_text((20, 50), "A page with its own text layer.")
+    return doc.tobytes()
+
+
+def fake_iter_pages(pdf_bytes, dpi=300, pages=None, grayscale=False, delay=0.0, **kwargs):
+    # rasterizing needs poppler, blank pages do for the stub engine
+    for page in pages:
+        time.sleep(delay)
+        yield (page, np.full((100, 100), 255, dtype=np.uint8))
+
+
+def slow_iter_pages(*args, **kwargs):
+    return fake_iter_pages(*args, delay=0.3, **kwargs)
+
+
+def test_image():
+    client, engine = make_client()
+    with client:
+        response = client.post("/ocr", files={"file": ("scan.png", png())}, data={"format": "txt"})
+        assert response.status == 200
+        assert response.body.decode().strip() == "stub"
+        assert client.get("/health").json()["inflight"] == 0
+
+
+def test_too_large(monkeypatch):
+    monkeypatch.setattr(service, "max_bytes", 100)
+    client, engine = make_client()
+    with client:
+        response = client.post("/ocr", files={"file": ("scan.png", png())})
+    assert response.status == 413
+    assert engine.calls == 0
+
+
+def test_overloaded(monkeypatch):
+    monkeypatch.setattr(service, "max_inflight", 0)
+    client, _ = make_client()
+    with client:
+        response = client.post("/ocr", files={"file": ("scan.png", png())})
+    assert response.status == 503
+    assert response.headers["retry-after"] == "1"
+
+
+def test_timeout():
+    client, _ = make_client(delay=1.0)
+    with client:
+        response = client.post("/ocr", files={"file": ("scan.png", png())}, data={"timeout": "0.1"})
+    assert response.status == 504
+
+
+def test_timed_out_requests_free_the_workers():
+    client, engine = make_client(delay=0.5, workers=1)
+    config = service.tesseract.get_tesseract_config(oem_index=3, psm_index=3)
+    # both requests end up in one batch
+    client.app.state.service.batcher("tesseract", "eng", config, False).max_wait = 0.1
+    body, content_type = service.encode_multipart({"timeout": "0.3"}, {"file": ("scan.png", png())})
+
+    async def both():
+        return await asyncio.gather(*(client._request("POST", "/ocr", body, {"content-type": content_type}) for _ in range(2)))
+
+    with client:
+        responses = client.loop.run_until_complete(both())
+        assert [response.status for response in responses] == [504, 504]
+        time.sleep(0.5)
+    # the engine call got the time left of the request, the second image was not read after the timeout
+    assert engine.calls == 1
+    assert 0 < engine.timeouts[0] <= 0.3
+
+
+def test_batched_regions():
+    class Reader:
+        def readtext_batch(self, images, lang, boxes=None, batch_size=None):
+            self.boxes = boxes
+            return [ocrresult.OcrResult(image_width=image.shape[1], image_height=image.shape[0]) for image in images]
+
+    # easyocr is not needed, only its batch reader is called
+    engine = object.__new__(engines.EasyOcrEngine)
+    engine._easy_ocr, engine.batch_size, engine.regions = Reader(), 8, True
+    image = np.full((800, 800), 255, dtype=np.uint8)
+    cv2.putText(image, "Some text here", (40, 100), cv2.FONT_HERSHEY_SIMPLEX, 1.0, 0, 2)
+    batcher = service.Batcher(engine, "eng", executor=None)
+    results = batcher._run([image, image], [time.monotonic() + 10] * 2)
+    assert [error for _, error in results] == [None, None]
+    # the same boxes as a single recognize call reads, no CRAFT detection
+    assert engine._easy_ocr.boxes == [engine.region_boxes(image)] * 2
+    assert engine._easy_ocr.boxes[0]
+
+
+def test_pdf_stream(monkeypatch):
+    monkeypatch.setattr(pdfimage, "iter_pages", fake_iter_pages)
+    client, engine = make_client()
+    with client:
+        response = client.post("/ocr", files={"file": ("book.pdf", pdf())})
+        assert response.status == 200
+        lines = response.lines()
+        assert [(line["page"], line["source"]) for line in lines] == [(1, "ocr"), (2, "text"), (3, "ocr")]
+        assert lines[1]["text"].strip() == "A page with its own text layer."
+        assert engine.calls == 2
+        assert client.get("/health").json()["inflight"] == 0
+
+
+def test_pdf_colour_page(monkeypatch):
+    def red_pages(pdf_bytes, dpi=300, pages=None, grayscale=False, **kwargs):
+        assert not grayscale
+        for page in pages:
+            img = np.zeros((100, 100, 3), dtype=np.uint8)
+            img[..., 0] = 255
+            yield (page, img)
+
+    monkeypatch.setattr(pdfimage, "iter_pages", red_pages)
+    client, engine = make_client()
+    with client:
+        response = client.post("/ocr", files={"file": ("book.pdf", pdf())}, data={"preprocess": '[["crop", {"left": 10}]]'})
+    assert response.status == 200
+    # still red, the engines take RGB images
+    assert engine.image.shape == (100, 90, 3)
+    assert engine.image[0, 0].tolist() == [255, 0, 0]
+
+
+@pytest.mark.parametrize("limit", ["inflight", "pdfs"])
+def test_streamed_pdf_counts_until_done(monkeypatch, limit):
+    if limit == "inflight":
+        # the OCR of the pages is slow
+        monkeypatch.setattr(pdfimage, "iter_pages", fake_iter_pages)
+        monkeypatch.setattr(service, "max_inflight", 1)
+        client, _ = make_client(delay=0.3)
+    else:
+        # the rasterization is slow
+        monkeypatch.setattr(pdfimage, "iter_pages", slow_iter_pages)
+        client, _ = make_client()
+        client.app.state.service.pdf_producers = threading.Semaphore(1)
+
+    async def second_request():
+        # sent while the pages of the first PDF are OCRed
+        await asyncio.sleep(0.1)
+        return await client._request("POST", "/ocr", *encode({"file": ("other.pdf", pdf())}))
+
+    async def both():
+        return await asyncio.gather(client._request("POST", "/ocr", *encode({"file": ("book.pdf", pdf())})), second_request())
+
+    with client:
+        first, second = client.loop.run_until_complete(both())
+        assert first.status == 200
+        assert len(first.lines()) == 3
+        assert second.status == 503
+        assert client.get("/health").json()["inflight"] == 0
+        # both slots are free again
+        assert client.post("/ocr", files={"file": ("book.pdf", pdf())}).status == 200
+
+
+def encode(files: dict) -> tuple[bytes, dict]:
+    body, content_type = service.encode_multipart({}, files)
+    return (body, {"content-type": content_type})
@@ -0,0 +1,27 @@
+import numpy as np
+import pytesseract
+
+import helpers.tesseract as tesseract
+
+
+def fake_image_to_data(image, lang, output_type, config, timeout):
+    """One word spanning the image, read from the PNM file the way the tesseract binary would."""
+    assert isinstance(image, str)
+    with open(image, "rb") as file:
+        magic, size, _ = file.read().split(b"\n", 3)[:3]
+    width, height = (int(value) for value in size.split())
+    return {
+        "level": [5], "text": [magic.decode()], "conf": [90], "left": [0], "top": [0], "width": [width], "height": [height],
+        "block_num": [1], "par_num": [1], "line_num": [1], "word_num": [1],
+    }
+
+
+def test_extract_result_twice_on_the_same_pixels(monkeypatch):
+    monkeypatch.setattr(tesseract, "backend", "pytesseract")
+    monkeypatch.setattr(pytesseract, "image_to_data", fake_image_to_data)
+    image = np.full((40, 60), 255, dtype=np.uint8)
+    for pixels in (image, image.copy(), image[:, :30]):
+        result, error = tesseract.extract_result(image=pixels, language_short="eng", config="", timeout=1)
+        assert error is None
+        assert result.text.tolist() == ["P5"]
+        assert (result.image_width, result.image_height) == pixels.shape[::-1]
@@ -0,0 +1,98 @@
+import threading
+import types
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import helpers.tesserapi as tesserapi
+
+
+class FakeApi:
+    """Stands in for tesserocr.PyTessBaseAPI, Recognize blocks while the gate is closed."""
+
+    gate = None
+    started = None
+
+    def __init__(self, lang, oem, psm):
+        self.ended = False
+
+    def SetVariable(self, key, value):
+        pass
+
+    def SetImageBytes(self, *args):
+        assert not self.ended
+
+    def Recognize(self, timeout):
+        FakeApi.started.set()
+        FakeApi.gate.wait(5)
+        assert not self.ended
+        return True
+
+    def GetUTF8Text(self):
+        assert not self.ended
+        return "text"
+
+    def Clear(self):
+        pass
+
+    def End(self):
+        self.ended = True
+
+
+def fake_tesserocr(monkeypatch):
+    monkeypatch.setattr(tesserapi, "tesserocr", types.SimpleNamespace(PyTessBaseAPI=FakeApi))
+    monkeypatch.setattr(tesserapi, "available", True)
+    FakeApi.gate, FakeApi.started = threading.Event(), threading.Event()
+
+
+def test_close_all_keeps_busy_handles(monkeypatch):
+    fake_tesserocr(monkeypatch)
+    image = np.zeros((8, 8), dtype=np.uint8)
+    results = []
+    worker = threading.Thread(target=lambda: results.append(tesserapi.image_to_string(image, "eng", "", 0)))
+    worker.start()
+    assert FakeApi.started.wait(5)
+    (busy,) = list(tesserapi._handles)
+    tesserapi.close_all()
+    assert not busy.api.ended
+    FakeApi.gate.set()
+    worker.join(5)
+    assert results == [("text", None)]
+    assert busy.api.ended and busy not in tesserapi._handles
+
+    # an idle handle is ended at once, the next call opens a new one
+    assert tesserapi.image_to_string(image, "eng", "", 0) == ("text", None)
+    (idle,) = list(tesserapi._handles)
+    tesserapi.close_all()
+    assert idle.api.ended and not tesserapi._handles
+    assert tesserapi.image_to_string(image, "eng", "", 0) == ("text", None)
+    tesserapi.close_all()
+
+
+def test_handles_are_shared_by_executors(monkeypatch):
+    fake_tesserocr(monkeypatch)
+    monkeypatch.setattr(tesserapi, "pool_size", 3)
+    FakeApi.gate.set()
+    image = np.zeros((8, 8), dtype=np.uint8)
+    for _ in range(2):
+        # a new executor per document, like the callers use
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            results = list(executor.map(lambda _: tesserapi.image_to_string(image, "eng", "", 0), range(12)))
+        assert results == [("text", None)] * 12
+        assert len(tesserapi._handles) <= 3
+    tesserapi.close_all()
+    assert not tesserapi._handles
+
+
+def test_handles_are_recycled(monkeypatch):
+    fake_tesserocr(monkeypatch)
+    monkeypatch.setattr(tesserapi, "recycle_pages", 2)
+    FakeApi.gate.set()
+    image = np.zeros((8, 8), dtype=np.uint8)
+    for _ in range(2):
+        tesserapi.image_to_string(image, "eng", "", 0)
+    # closed when it is returned after its second page
+    assert not tesserapi._handles
+    tesserapi.image_to_string(image, "eng", "", 0)
+    assert len(tesserapi._handles) == 1
+    tesserapi.close_all()
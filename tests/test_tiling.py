@@ -0,0 +1,50 @@
+import numpy as np
+
+import helpers.ocrresult as ocrresult
+import helpers.tesseract as tesseract
+import helpers.tiling as tiling
+
+
+# (text, left, top, width, height), the seams of 1024 px tiles with 256 px overlap are near 896 and 1664
+words = [
+    ("short", 100, 100, 120, 40),
+    ("seam", 860, 300, 80, 40),
+    ("widerthanhalfoverlap", 760, 500, 240, 40),
+    ("corner", 850, 850, 90, 40),
+    ("vertical", 400, 870, 160, 50),
+    ("far", 2000, 2000, 100, 40),
+]
+
+
+def fake_reader(page: np.ndarray, words: list = words):
+    """extract_result which reads the words inside a tile view of page, a word crossing the tile border only in part."""
+    def extract_result(image, language_short, config, timeout):
+        top, left = divmod(image.__array_interface__["data"][0] - page.__array_interface__["data"][0], page.shape[1])
+        height, width = image.shape[:2]
+        read = []
+        for text, x, y, w, h in words:
+            x0, y0, x1, y1 = max(x, left), max(y, top), min(x + w, left + width), min(y + h, top + height)
+            if x1 > x0 and y1 > y0:
+                chars = slice(round((x0 - x) / w * len(text)), round((x1 - x) / w * len(text)))
+                read.append((text[chars], x0 - left, y0 - top, x1 - x0, y1 - y0))
+        columns = list(zip(*read)) or [()] * 5
+        return (ocrresult.OcrResult(*columns, conf=[0.9] * len(read), line=range(len(read)), image_width=width, image_height=height), None)
+    return extract_result
+
+
+def test_words_on_seams_are_kept_once(monkeypatch):
+    page = np.full((2400, 2400), 255, dtype=np.uint8)
+    monkeypatch.setattr(tesseract, "extract_result", fake_reader(page))
+    result, error = tiling.ocr_tiled(page, "eng", "", 1, tile_size=1024, overlap=256, max_workers=2)
+    assert error is None
+    assert sorted(result.text.tolist()) == sorted(word[0] for word in words)
+
+
+def test_word_longer_than_the_overlap_is_kept_in_parts(monkeypatch):
+    page = np.full((1500, 2400), 255, dtype=np.uint8)
+    long_word = [("averyveryverylongwordacrosstheseam", 700, 300, 400, 40)]
+    monkeypatch.setattr(tesseract, "extract_result", fake_reader(page, long_word))
+    result, error = tiling.ocr_tiled(page, "eng", "", 1, tile_size=1024, overlap=256, max_workers=2)
+    assert error is None
+    # the part read by each tile, the characters in the overlap are doubled
+    assert result.text.tolist() == ["averyveryverylongwordacrosst", "eryverylongwordacrosstheseam"]